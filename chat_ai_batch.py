@@ -0,0 +1,110 @@
+import json
+import re
+
+# AIポジティブ変換のマイクロバッチ
+#
+# 変換リクエストを短い時間窓 (window 秒) または max_items 件まで溜め、
+# まとめて1回のGemini呼び出しで変換する。プロンプトの定型部分と履歴の文脈を
+# 1回分で済ませられるため、API呼び出し回数とトークン数が減る。
+# TransformBatcher はイベントループのスレッドで使う（タイマーはループの call_later）。
+
+DEFAULT_BATCH_WINDOW = 0.05  # 秒
+DEFAULT_BATCH_MAX_ITEMS = 8
+
+
+class PendingTransform:
+    """変換待ちの1件"""
+
+    __slots__ = ("client_socket", "username", "original_message", "cache_key", "room")
+
+    def __init__(self, client_socket, username, original_message, cache_key, room=None):
+        self.client_socket = client_socket
+        self.username = username
+        self.original_message = original_message
+        self.cache_key = cache_key
+        self.room = room  # 依頼時に所属していたルーム（文脈と配信先）
+
+
+class TransformBatcher:
+    def __init__(self, flush_callback, call_later, window=DEFAULT_BATCH_WINDOW, max_items=DEFAULT_BATCH_MAX_ITEMS):
+        self.flush_callback = flush_callback  # flush_callback(items) で溜まった分を渡す
+        self.call_later = call_later
+        self.window = window
+        self.max_items = max_items
+        self._pending = []
+        self._timer = None
+        self.batches = 0
+        self.items = 0
+
+    def add(self, item):
+        self._pending.append(item)
+        if len(self._pending) >= self.max_items:
+            self.flush()
+        elif self._timer is None:
+            self._timer = self.call_later(self.window, self.flush)
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        items, self._pending = self._pending, []
+        self.batches += 1
+        self.items += len(items)
+        self.flush_callback(items)
+
+
+def build_batch_prompt(items, context_history):
+    """複数の発言をまとめて変換するプロンプト"""
+    lines = []
+    for index, item in enumerate(items, 1):
+        lines.append(f"{index}. 送信者: {item.username} / 変換前のメッセージ: 「{item.original_message}」")
+    numbered = "\n".join(lines)
+    return f"""あなたは、チャット参加者の発言を、どんな悪口やネガティブな表現でも非常にポジティブな言い回しに変換するAIです。自然で簡潔な応答をしてください。
+絵文字は使用しないでください。
+
+過去のチャット履歴（文脈参考用）:
+{context_history}
+
+変換対象のメッセージ一覧（番号ごとに別々の発言です）:
+{numbered}
+
+上記の履歴と文脈を踏まえて、それぞれの発言を変換してください。
+ポジティブな表現にする上で表現方法は変わる可能性がありますが、元々のメッセージの内容は変えず表現方法を
+変えるだけにしてください。例えば、悪口やネガティブな表現をポジティブな表現に変換することが求められます。
+
+例：
+変換前：「うるさい」
+変換後：「盛り上げてくれてありがとう」
+
+出力は次の形式のJSON配列だけにしてください（説明文やコードブロックは不要です）:
+[{{"id": 1, "text": "変換後のメッセージ"}}, {{"id": 2, "text": "変換後のメッセージ"}}]
+"""
+
+
+def parse_batch_response(text, count):
+    """バッチ応答を解析し、番号 (1始まり) -> 変換後テキスト の辞書を返す
+
+    解析できなかった番号は含まれない（呼び出し側で個別に変換し直す）。
+    """
+    # ```json ... ``` で囲まれて返ってくる場合がある
+    match = re.search(r"\[.*\]", text, re.S)
+    if not match:
+        return {}
+    try:
+        entries = json.loads(match.group(0))
+    except ValueError:
+        return {}
+    results = {}
+    for entry in entries:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            index = int(entry.get("id"))
+        except (TypeError, ValueError):
+            continue
+        value = entry.get("text")
+        if 1 <= index <= count and isinstance(value, str) and value.strip():
+            results[index] = value.strip()
+    return results
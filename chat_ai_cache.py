@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+import threading
+import time
+import unicodedata
+
+from cachetools import TTLCache
+
+# AIポジティブ変換結果のキャッシュ
+#
+# 「うるさい」「疲れた」のような短い定型の発言は何度も送られるため、
+# 変換結果を (正規化したメッセージ, 文脈フィンガープリント) をキーに保持し、
+# 同じ発言はGeminiを呼ばずに返す。
+# 件数 (LRU) と有効期限 (TTL) で古いエントリを捨て、任意でファイルに保存して
+# 再起動後も引き継ぐ。
+
+DEFAULT_CACHE_SIZE = 1024
+DEFAULT_CACHE_TTL = 6 * 60 * 60   # 秒
+DEFAULT_MAX_TEXT_LENGTH = 64      # これより長い発言はキャッシュしない（再利用されにくいため）
+
+
+def normalize_message(text):
+    """表記ゆれ（全角/半角、前後・連続する空白、大文字/小文字）を吸収する"""
+    text = unicodedata.normalize("NFKC", text)
+    return " ".join(text.split()).lower()
+
+
+def context_fingerprint(*parts):
+    """変換結果に影響する文脈（モデル名、プロンプトの版、直近の履歴など）の要約ハッシュ"""
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update(str(part).encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+class TransformCache:
+    def __init__(self, maxsize=DEFAULT_CACHE_SIZE, ttl=DEFAULT_CACHE_TTL, path=None,
+                 max_text_length=DEFAULT_MAX_TEXT_LENGTH):
+        self.path = path
+        self.ttl = ttl
+        self.max_text_length = max_text_length
+        # 永続化のため、期限は実時刻で管理する
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl, timer=time.time)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if path:
+            self.load()
+
+    def make_key(self, message, fingerprint):
+        """キャッシュ対象外の発言なら None を返す"""
+        normalized = normalize_message(message)
+        if not normalized or len(normalized) > self.max_text_length:
+            return None
+        return (normalized, fingerprint)
+
+    def get(self, key):
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._cache.get(key)
+            # 値と一緒に格納時刻を持ち、ファイルから復元したエントリも元の時刻で期限切れにする
+            if entry is not None and time.time() - entry[1] >= self.ttl:
+                del self._cache[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        if key is None:
+            return
+        with self._lock:
+            self._cache[key] = (value, time.time())
+
+    def __len__(self):
+        return len(self._cache)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def load(self):
+        """保存済みのエントリを読み込む（期限切れのものは捨てる）"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        with self._lock:
+            for normalized, fingerprint, value, stored_at in entries:
+                if 0 <= now - stored_at < self.ttl:
+                    self._cache[(normalized, fingerprint)] = (value, stored_at)
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            self._cache.expire()
+            entries = [[key[0], key[1], value, stored_at] for key, (value, stored_at) in self._cache.items()]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
@@ -0,0 +1,123 @@
+import heapq
+import itertools
+import threading
+import time
+
+# AI (Gemini) 呼び出しのジョブスケジューラ
+#
+# リクエストごとにスレッドを作らず、固定数のワーカースレッドが上限付きの
+# 優先度付きキューからジョブを取り出して実行する。
+#   - 同時に実行されるAPI呼び出しはワーカー数までに制限される
+#   - キューが一杯のときは submit() が失敗し、呼び出し側が利用者に混雑を通知する
+#   - 期限 (deadline) を過ぎたジョブは実行せずに on_expired を呼ぶ
+#   - 停止時に実行中だったジョブのワーカーは、ジョブが終わると（再び起動していても）そのまま終了する
+
+PRIORITY_INTERACTIVE = 0   # ポジティブ変換・質問など、利用者が応答を待っているもの
+PRIORITY_BACKGROUND = 10   # 要約など、多少遅れてもよいもの
+
+DEFAULT_AI_WORKERS = 4
+DEFAULT_AI_QUEUE_SIZE = 100
+DEFAULT_JOB_TIMEOUT = 30.0  # 秒
+
+
+class AIJob:
+    __slots__ = ("priority", "seq", "deadline", "func", "args", "on_expired", "name")
+
+    def __init__(self, priority, seq, deadline, func, args, on_expired, name):
+        self.priority = priority
+        self.seq = seq
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.on_expired = on_expired
+        self.name = name
+
+    def __lt__(self, other):
+        # 優先度が同じなら投入順
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class AIJobScheduler:
+    def __init__(self, workers=DEFAULT_AI_WORKERS, max_queue=DEFAULT_AI_QUEUE_SIZE, log=None):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.log = log or (lambda message, level="INFO": None)
+
+        self._heap = []
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._threads = []
+        self._running = False
+        self._generation = 0     # start() のたびに増やす。古い世代のワーカーは新しいジョブを取らない
+        self.active_jobs = 0     # 実行中のジョブ数
+        self.completed_jobs = 0
+        self.expired_jobs = 0
+        self.rejected_jobs = 0
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+            self._generation += 1
+            generation = self._generation
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, args=(generation,), name=f"ai-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=1.0):
+        """ワーカーを停止する。未実行のジョブは破棄される
+
+        実行中のジョブは中断できないため、timeout 秒待っても終わらないワーカーは残るが、
+        ジョブが終わった時点で終了し、再び start() した後のジョブは取らない。
+        """
+        with self._cond:
+            self._running = False
+            self._heap.clear()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        self._threads = []
+
+    def queue_depth(self):
+        """実行待ちのジョブ数"""
+        return len(self._heap)
+
+    def submit(self, func, *args, priority=PRIORITY_INTERACTIVE, timeout=DEFAULT_JOB_TIMEOUT,
+               on_expired=None, name=""):
+        """ジョブを投入する。キューが一杯、または停止中の場合は False を返す"""
+        with self._cond:
+            if not self._running or len(self._heap) >= self.max_queue:
+                self.rejected_jobs += 1
+                return False
+            deadline = time.monotonic() + timeout if timeout else None
+            heapq.heappush(self._heap, AIJob(priority, next(self._seq), deadline, func, args, on_expired, name))
+            self._cond.notify()
+            return True
+
+    def _worker(self, generation):
+        while True:
+            with self._cond:
+                while self._running and self._generation == generation and not self._heap:
+                    self._cond.wait()
+                if not self._running or self._generation != generation:
+                    return
+                job = heapq.heappop(self._heap)
+                self.active_jobs += 1
+            expired = job.deadline is not None and time.monotonic() > job.deadline
+            try:
+                if expired:
+                    if job.on_expired:
+                        job.on_expired()
+                else:
+                    job.func(*job.args)
+            except Exception as e:
+                self.log(f"AIジョブの実行中にエラーが発生しました ({job.name}): {e}", "ERROR")
+            finally:
+                with self._cond:
+                    self.active_jobs -= 1
+                    if expired:
+                        self.expired_jobs += 1
+                    else:
+                        self.completed_jobs += 1
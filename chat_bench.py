@@ -0,0 +1,599 @@
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+from chat_protocol import (
+    FrameDecoder, ProtocolError, encode_frame, decode_text, decode_sequenced_payload,
+    FRAME_HELLO, FRAME_CHAT, FRAME_PRIVATE, FRAME_SYSTEM, FRAME_HISTORY, FRAME_SEQUENCED, FRAME_AI_POSITIVE,
+    FRAME_SHUTDOWN, FRAME_PING, FRAME_PONG,
+)
+
+# チャットサーバーの負荷試験・レイテンシ計測ツール
+#
+# GUIを使わないボット接続を多数（複数プロセスに分けて）張り、ブロードキャスト、
+# 個人メッセージ (/w)、/users、/positive_transform を指定の比率で送り続ける。
+# 送信時刻をメッセージに埋め込み、受信側で配信までの時間を計測する。
+#
+#   python chat_bench.py --spawn-server --clients 1000 --processes 4 --rate 500 --duration 30
+#   python chat_bench.py --port 50000 --server-pid 12345 --save-baseline baseline.json
+#   python chat_bench.py --spawn-server --compare baseline.json
+#
+# 時刻は CLOCK_MONOTONIC (time.monotonic_ns) を使うため、ボットは同じマシン上で動かすこと。
+
+OPERATIONS = ("broadcast", "pm", "users", "positive")
+DEFAULT_MIX = "broadcast=70,pm=20,users=5,positive=5"
+BENCH_MARKER = "bench"
+# /positive_transform で送る発言（キャッシュが効く程度に同じ発言を繰り返す）
+POSITIVE_PHRASES = ("うるさい", "疲れた", "つまらない", "遅い", "面倒くさい", "眠い", "難しすぎる", "もう嫌だ")
+RESERVOIR_SIZE = 200000  # 種類ごとに保持するレイテンシのサンプル数の上限
+# 比較時に「大きいほど良い」指標
+HIGHER_IS_BETTER = ("sent_per_sec", "delivered_per_sec")
+
+
+def parse_mix(text):
+    """"broadcast=70,pm=20" 形式の比率を {操作: 重み} に変換する"""
+    mix = {}
+    for part in text.split(","):
+        if not part.strip():
+            continue
+        name, _, weight = part.partition("=")
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError(f"未知の操作です: {name}")
+        mix[name] = float(weight)
+    if not mix or sum(mix.values()) <= 0:
+        raise ValueError("比率の合計が0です")
+    return mix
+
+
+class Reservoir:
+    """サンプル数に上限のあるリザーバーサンプリング"""
+
+    def __init__(self, size=RESERVOIR_SIZE, rng=None):
+        self.size = size
+        self.samples = []
+        self.count = 0
+        self._random = rng or random.Random()
+
+    def add(self, value):
+        self.count += 1
+        if len(self.samples) < self.size:
+            self.samples.append(value)
+        else:
+            index = self._random.randrange(self.count)
+            if index < self.size:
+                self.samples[index] = value
+
+
+class BotClient:
+    """1接続分のボット"""
+
+    __slots__ = ("sock", "username", "decoder", "outbuf", "connect_started", "connected", "joined",
+                 "pending_users", "pending_positive", "writing")
+
+    def __init__(self, username):
+        self.sock = None
+        self.username = username
+        self.decoder = FrameDecoder()
+        self.outbuf = bytearray()
+        self.connect_started = 0
+        self.connected = False
+        self.joined = False
+        self.pending_users = []     # /users の送信時刻（応答が届いた順に対応付ける）
+        self.pending_positive = []  # /positive_transform の送信時刻
+        self.writing = False
+
+
+class BotRunner:
+    """1プロセス分のボット群を selectors で動かす"""
+
+    def __init__(self, host, port, usernames, all_usernames, mix, rate, seed):
+        self.host = host
+        self.port = port
+        self.bots = [BotClient(name) for name in usernames]
+        self.all_usernames = all_usernames
+        self.operations = list(mix)
+        self.weights = [mix[name] for name in self.operations]
+        self.rate = rate
+        self.random = random.Random(seed)
+        self.selector = selectors.DefaultSelector()
+        self.latencies = {name: Reservoir(rng=self.random) for name in OPERATIONS}
+        self.connect_times = Reservoir(rng=self.random)
+        self.sent = dict.fromkeys(OPERATIONS, 0)
+        self.received_frames = 0
+        self.received_bytes = 0
+        self.ai_rejected = 0
+        self.omitted_notices = 0
+        self.errors = 0
+        self.disconnected = 0
+
+    # --- 接続 ---
+
+    def connect_all(self, connect_rate, timeout):
+        """全ボットを接続し、入室通知を受け取るまで待つ"""
+        interval = 1.0 / connect_rate if connect_rate > 0 else 0.0
+        deadline = time.monotonic() + timeout
+        next_connect = time.monotonic()
+        for bot in self.bots:
+            now = time.monotonic()
+            if now < next_connect:
+                self.poll(next_connect - now)
+            next_connect = max(now, next_connect) + interval
+            self.start_connect(bot)
+            self.poll(0)
+        while time.monotonic() < deadline and not all(bot.joined or bot.sock is None for bot in self.bots):
+            self.poll(0.05)
+        return sum(1 for bot in self.bots if bot.joined)
+
+    def start_connect(self, bot):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        bot.sock = sock
+        bot.connect_started = time.monotonic_ns()
+        err = sock.connect_ex((self.host, self.port))
+        if err not in (0, 115, 36, 10035):  # EINPROGRESS (Linux / macOS / Windows)
+            self.fail(bot)
+            return
+        bot.writing = True
+        self.selector.register(sock, selectors.EVENT_READ | selectors.EVENT_WRITE, bot)
+        self.queue(bot, encode_frame(FRAME_HELLO, bot.username))
+
+    def fail(self, bot):
+        self.errors += 1
+        self.close(bot)
+
+    def close(self, bot):
+        if bot.sock is None:
+            return
+        try:
+            self.selector.unregister(bot.sock)
+        except (KeyError, ValueError):
+            pass
+        bot.sock.close()
+        bot.sock = None
+
+    # --- 送受信 ---
+
+    def queue(self, bot, frame):
+        if bot.sock is None:
+            return
+        bot.outbuf += frame
+        if bot.connected:
+            self.flush(bot)
+        if bot.outbuf and not bot.writing and bot.sock is not None:
+            bot.writing = True
+            self.selector.modify(bot.sock, selectors.EVENT_READ | selectors.EVENT_WRITE, bot)
+
+    def flush(self, bot):
+        try:
+            sent = bot.sock.send(bot.outbuf)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.fail(bot)
+            return
+        del bot.outbuf[:sent]
+
+    def poll(self, timeout):
+        for key, mask in self.selector.select(timeout):
+            bot = key.data
+            if mask & selectors.EVENT_WRITE and bot.sock is not None:
+                if not bot.connected:
+                    if bot.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR):
+                        self.fail(bot)
+                        continue
+                    bot.connected = True
+                self.flush(bot)
+                if bot.sock is not None and not bot.outbuf:
+                    bot.writing = False
+                    self.selector.modify(bot.sock, selectors.EVENT_READ, bot)
+            if mask & selectors.EVENT_READ and bot.sock is not None:
+                self.read(bot)
+
+    def read(self, bot):
+        try:
+            data = bot.sock.recv(65536)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.fail(bot)
+            return
+        if not data:
+            self.disconnected += 1
+            self.close(bot)
+            return
+        self.received_bytes += len(data)
+        try:
+            frames = bot.decoder.feed(data)
+            # ルームへの配信は通し番号付き。ボットは再接続しないため番号は使わない
+            frames = [decode_sequenced_payload(payload)[1:] if frame_type == FRAME_SEQUENCED else (frame_type, payload)
+                      for frame_type, payload in frames]
+        except ProtocolError:
+            self.fail(bot)
+            return
+        now = time.monotonic_ns()
+        for frame_type, payload in frames:
+            self.received_frames += 1
+            if frame_type == FRAME_HISTORY:
+                continue  # 入室時の履歴（圧縮されている場合があるため文字列にしない）
+            self.handle_frame(bot, frame_type, decode_text(payload), now)
+
+    def handle_frame(self, bot, frame_type, text, now):
+        if frame_type == FRAME_CHAT:
+            # "送信者: bench <送信時刻>"
+            _, _, body = text.partition(": ")
+            self.record("broadcast", body, now)
+        elif frame_type == FRAME_PRIVATE:
+            if text.startswith("(個人 from "):
+                _, _, body = text.partition("): ")
+                self.record("pm", body, now)
+        elif frame_type == FRAME_AI_POSITIVE:
+            if text.startswith(f"{bot.username} : ") and bot.pending_positive:
+                self.latencies["positive"].add(now - bot.pending_positive.pop(0))
+        elif frame_type == FRAME_SYSTEM:
+            if not bot.joined and text == f"{bot.username} さんが入室しました。":
+                bot.joined = True
+                self.connect_times.add(now - bot.connect_started)
+            elif text.startswith("接続中のユーザー") and bot.pending_users:
+                self.latencies["users"].add(now - bot.pending_users.pop(0))
+            elif "混み合って" in text or "利用できません" in text:
+                self.ai_rejected += 1
+                if bot.pending_positive:
+                    bot.pending_positive.pop(0)
+            elif "省略しました" in text:
+                self.omitted_notices += 1
+        elif frame_type == FRAME_PING:
+            self.queue(bot, encode_frame(FRAME_PONG, text))
+        elif frame_type == FRAME_SHUTDOWN:
+            self.close(bot)
+
+    def record(self, operation, body, now):
+        marker, _, sent_at = body.partition(" ")
+        if marker != BENCH_MARKER:
+            return
+        try:
+            self.latencies[operation].add(now - int(sent_at))
+        except ValueError:
+            pass
+
+    # --- 負荷 ---
+
+    def send_one(self, bot):
+        operation = self.random.choices(self.operations, self.weights)[0]
+        now = time.monotonic_ns()
+        if operation == "broadcast":
+            message = f"{BENCH_MARKER} {now}"
+        elif operation == "pm":
+            target = self.random.choice(self.all_usernames)
+            if target == bot.username:
+                return
+            message = f"/w {target} {BENCH_MARKER} {now}"
+        elif operation == "users":
+            bot.pending_users.append(now)
+            message = "/users"
+        else:
+            bot.pending_positive.append(now)
+            message = f"/positive_transform {self.random.choice(POSITIVE_PHRASES)}"
+        self.sent[operation] += 1
+        self.queue(bot, encode_frame(FRAME_CHAT, message))
+
+    def drive(self, duration, drain):
+        """duration 秒間、合計 rate 件/秒で送信し、drain 秒だけ受信を続ける"""
+        bots = [bot for bot in self.bots if bot.joined]
+        start = time.monotonic()
+        end = start + duration
+        issued = 0
+        while bots:
+            now = time.monotonic()
+            if now >= end:
+                break
+            due = int((now - start) * self.rate)
+            while issued < due:
+                bot = self.random.choice(bots)
+                if bot.sock is not None:
+                    self.send_one(bot)
+                issued += 1
+            self.poll(min(0.005, max(0.0, end - now)))
+        load_elapsed = time.monotonic() - start
+        drain_end = time.monotonic() + drain
+        while time.monotonic() < drain_end:
+            self.poll(0.05)
+        return load_elapsed, time.monotonic() - start
+
+    def result(self, load_elapsed, elapsed):
+        return {
+            "connected": sum(1 for bot in self.bots if bot.joined),
+            "load_elapsed": load_elapsed,
+            "elapsed": elapsed,
+            "sent": self.sent,
+            "received_frames": self.received_frames,
+            "received_bytes": self.received_bytes,
+            "latencies": {name: reservoir.samples for name, reservoir in self.latencies.items()},
+            "delivered": {name: reservoir.count for name, reservoir in self.latencies.items()},
+            "connect_times": self.connect_times.samples,
+            "ai_rejected": self.ai_rejected,
+            "omitted_notices": self.omitted_notices,
+            "errors": self.errors,
+            "disconnected": self.disconnected,
+        }
+
+    def close_all(self):
+        for bot in self.bots:
+            self.close(bot)
+        self.selector.close()
+
+
+def raise_fd_limit():
+    """多数の接続を張れるように、開けるファイル数の上限を引き上げる"""
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def run_worker(index, options, usernames, all_usernames, barrier, results):
+    """子プロセス: ボットを接続し、全プロセスが揃ってから負荷をかける"""
+    raise_fd_limit()
+    runner = BotRunner(options["host"], options["port"], usernames, all_usernames,
+                       options["mix"], options["rate"], options["seed"] + index)
+    try:
+        runner.connect_all(options["connect_rate"], options["connect_timeout"])
+        barrier.wait()  # 全プロセスの接続完了
+        barrier.wait()  # 親がRSSの基準値を計測し終えた
+        load_elapsed, elapsed = runner.drive(options["duration"], options["drain"])
+        results.put(runner.result(load_elapsed, elapsed))
+    finally:
+        runner.close_all()
+
+
+def read_rss(pid):
+    """プロセスの常駐メモリ (バイト)。取得できない場合は None"""
+    try:
+        with open(f"/proc/{pid}/status", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize_latencies(samples_ns):
+    values = sorted(samples_ns)
+    if not values:
+        return None
+    return {
+        "p50_ms": percentile(values, 0.50) / 1e6,
+        "p95_ms": percentile(values, 0.95) / 1e6,
+        "p99_ms": percentile(values, 0.99) / 1e6,
+        "max_ms": values[-1] / 1e6,
+    }
+
+
+def merge_results(results, rss_samples):
+    load_elapsed = max(result["load_elapsed"] for result in results)
+    elapsed = max(result["elapsed"] for result in results)
+    sent = {name: sum(result["sent"][name] for result in results) for name in OPERATIONS}
+    delivered = {name: sum(result["delivered"][name] for result in results) for name in OPERATIONS}
+    report = {
+        "connected": sum(result["connected"] for result in results),
+        "elapsed": elapsed,
+        "sent": sent,
+        "delivered": delivered,
+        "sent_per_sec": sum(sent.values()) / load_elapsed if load_elapsed else 0.0,
+        "delivered_per_sec": sum(result["received_frames"] for result in results) / elapsed if elapsed else 0.0,
+        "received_bytes": sum(result["received_bytes"] for result in results),
+        "latency": {},
+        "connect": summarize_latencies([ns for result in results for ns in result["connect_times"]]),
+        "ai_rejected": sum(result["ai_rejected"] for result in results),
+        "omitted_notices": sum(result["omitted_notices"] for result in results),
+        "errors": sum(result["errors"] for result in results),
+        "disconnected": sum(result["disconnected"] for result in results),
+    }
+    for name in OPERATIONS:
+        summary = summarize_latencies([ns for result in results for ns in result["latencies"][name]])
+        if summary:
+            report["latency"][name] = summary
+    rss = [value for value in rss_samples if value is not None]
+    if rss:
+        report["rss_start_mb"] = rss[0] / (1024 * 1024)
+        report["rss_peak_mb"] = max(rss) / (1024 * 1024)
+    return report
+
+
+def print_report(report):
+    print(f"接続数: {report['connected']}  計測時間: {report['elapsed']:.1f}秒")
+    print(f"送信: {report['sent_per_sec']:.0f} 件/秒  配信(受信フレーム): {report['delivered_per_sec']:.0f} 件/秒  "
+          f"受信 {report['received_bytes'] / (1024 * 1024):.1f} MiB")
+    print(f"{'操作':<10} {'送信':>8} {'配信':>10} {'p50[ms]':>9} {'p95[ms]':>9} {'p99[ms]':>9} {'max[ms]':>9}")
+    for name in OPERATIONS:
+        summary = report["latency"].get(name)
+        row = f"{name:<10} {report['sent'][name]:>8} {report['delivered'][name]:>10}"
+        if summary:
+            row += "".join(f" {summary[key]:>9.2f}" for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms"))
+        print(row)
+    if report["connect"]:
+        connect = report["connect"]
+        print(f"接続確立 (入室通知まで): p50 {connect['p50_ms']:.2f}ms  p95 {connect['p95_ms']:.2f}ms  "
+              f"p99 {connect['p99_ms']:.2f}ms")
+    if "rss_peak_mb" in report:
+        print(f"サーバーRSS: 開始時 {report['rss_start_mb']:.1f} MiB  最大 {report['rss_peak_mb']:.1f} MiB")
+    print(f"AI拒否/利用不可: {report['ai_rejected']}  省略通知: {report['omitted_notices']}  "
+          f"エラー: {report['errors']}  切断: {report['disconnected']}")
+
+
+def flatten_metrics(report):
+    """ベースラインと比較する指標を {名前: 値} で返す"""
+    metrics = {
+        "sent_per_sec": report["sent_per_sec"],
+        "delivered_per_sec": report["delivered_per_sec"],
+    }
+    for name, summary in report["latency"].items():
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            metrics[f"{name}.{key}"] = summary[key]
+    if report["connect"]:
+        metrics["connect.p95_ms"] = report["connect"]["p95_ms"]
+    if "rss_peak_mb" in report:
+        metrics["rss_peak_mb"] = report["rss_peak_mb"]
+    return metrics
+
+
+def compare_with_baseline(report, baseline, threshold):
+    """ベースラインから threshold (割合) 以上悪化した指標の数を返す"""
+    current = flatten_metrics(report)
+    previous = flatten_metrics(baseline)
+    regressions = 0
+    print(f"\nベースラインとの比較 (悪化の判定: {threshold * 100:.0f}%)")
+    if baseline.get("config") != report.get("config"):
+        print(f"  注意: 計測条件がベースラインと異なります ({baseline.get('config')})")
+    for name in sorted(current):
+        if name not in previous or not previous[name]:
+            continue
+        change = (current[name] - previous[name]) / previous[name]
+        worse = -change if name in HIGHER_IS_BETTER else change
+        mark = ""
+        if worse > threshold:
+            mark = "  << 悪化"
+            regressions += 1
+        print(f"  {name:<22} {previous[name]:>10.2f} -> {current[name]:>10.2f} ({change * 100:+.1f}%){mark}")
+    return regressions
+
+
+def spawn_server(args):
+    """計測用にヘッドレスサーバーを起動し、接続を受け付けるまで待つ"""
+    server_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "chat_server.py")
+    command = [sys.executable, server_path, "--host", args.host, "--port", str(args.port),
+               "--backlog", "4096", "--history-dir", "", "--llm", args.llm,
+               # ボットの送信レートはこちらで制御するため、接続ごとのレート制限は外す（--server-arg で上書き可）
+               "--chat-rate", "0", "--pm-rate", "0", "--ai-rate", "0"] + args.server_arg
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("サーバーの起動に失敗しました")
+        try:
+            socket.create_connection((args.host, args.port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("サーバーが接続を受け付けません")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="チャットサーバーの負荷試験・レイテンシ計測")
+    parser.add_argument("--host", default="127.0.0.1", help="サーバーのアドレス (既定: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=50000, help="サーバーのポート (既定: 50000)")
+    parser.add_argument("--clients", type=int, default=200, help="ボットの接続数 (既定: 200)")
+    parser.add_argument("--processes", type=int, default=max(1, min(4, os.cpu_count() or 1)),
+                        help="ボットを動かすプロセス数 (既定: CPU数、最大4)")
+    parser.add_argument("--rate", type=float, default=200, help="全ボット合計の送信レート [件/秒] (既定: 200)")
+    parser.add_argument("--duration", type=float, default=10, help="負荷をかける時間 [秒] (既定: 10)")
+    parser.add_argument("--drain", type=float, default=2, help="送信終了後に受信を待つ時間 [秒] (既定: 2)")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"操作の比率 (既定: {DEFAULT_MIX})")
+    parser.add_argument("--connect-rate", type=float, default=500,
+                        help="プロセスあたりの新規接続レート [件/秒]。0で無制限 (既定: 500)")
+    parser.add_argument("--connect-timeout", type=float, default=60, help="全接続の完了を待つ時間 [秒] (既定: 60)")
+    parser.add_argument("--seed", type=int, default=1, help="乱数シード (既定: 1)")
+    parser.add_argument("--spawn-server", action="store_true", help="計測用のサーバーを起動する")
+    parser.add_argument("--llm", default="fake", help="--spawn-server 時のLLMバックエンド (既定: fake)")
+    parser.add_argument("--server-arg", action="append", default=[],
+                        help="--spawn-server 時にサーバーへ渡す追加オプション (複数指定可)")
+    parser.add_argument("--server-pid", type=int, default=None, help="RSSを計測するサーバーのPID")
+    parser.add_argument("--json", default=None, help="結果をJSONで保存するパス")
+    parser.add_argument("--save-baseline", default=None, help="結果をベースラインとして保存するパス")
+    parser.add_argument("--compare", default=None, help="比較するベースラインのパス")
+    parser.add_argument("--threshold", type=float, default=10, help="悪化と判定する変化率 [%%] (既定: 10)")
+    args = parser.parse_args(argv)
+    try:
+        args.mix = parse_mix(args.mix)
+    except ValueError as e:
+        parser.error(str(e))
+    args.processes = max(1, min(args.processes, args.clients))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    server = spawn_server(args) if args.spawn_server else None
+    server_pid = server.pid if server else args.server_pid
+
+    run_id = f"{random.Random().randrange(36 ** 4):04x}"
+    all_usernames = [f"bot{run_id}_{i}" for i in range(args.clients)]
+    options = {
+        "host": args.host, "port": args.port, "mix": args.mix, "rate": args.rate / args.processes,
+        "seed": args.seed, "duration": args.duration, "drain": args.drain,
+        "connect_rate": args.connect_rate, "connect_timeout": args.connect_timeout,
+    }
+    barrier = multiprocessing.Barrier(args.processes + 1)
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=run_worker,
+                                args=(index, options, all_usernames[index::args.processes], all_usernames, barrier, results))
+        for index in range(args.processes)
+    ]
+    try:
+        for worker in workers:
+            worker.start()
+        barrier.wait(timeout=args.connect_timeout + 30)
+        rss_samples = [read_rss(server_pid)] if server_pid else []
+        barrier.wait()
+
+        collected = []
+        deadline = time.monotonic() + args.duration + args.drain + 60
+        while len(collected) < len(workers) and time.monotonic() < deadline:
+            if server_pid:
+                rss_samples.append(read_rss(server_pid))
+            try:
+                collected.append(results.get(timeout=0.5))
+            except queue.Empty:
+                pass
+        for worker in workers:
+            worker.join(timeout=5)
+    finally:
+        if server:
+            server.terminate()
+            server.wait(timeout=10)
+
+    if not collected:
+        print("結果を取得できませんでした。")
+        return 1
+    report = merge_results(collected, rss_samples)
+    report["config"] = {
+        "clients": args.clients, "processes": args.processes, "rate": args.rate,
+        "duration": args.duration, "mix": args.mix,
+    }
+    print_report(report)
+    for path in (args.json, args.save_baseline):
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare_with_baseline(report, baseline, args.threshold / 100):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
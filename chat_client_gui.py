@@ -1,11 +1,38 @@
 import customtkinter as ctk
 from tkinter import messagebox, PhotoImage  # messagebox と PhotoImage は tkinter から継続利用
+import collections
+import json
+import random
 import socket
 import threading
 import datetime
 import re # 正規表現モジュールをインポート
 import os
 import sys
+from chat_protocol import (
+    FrameDecoder, ProtocolError, encode_frame, decode_text, decode_stream_payload, decode_history_payload,
+    encode_sequenced_frame, decode_sequenced_payload,
+    FRAME_HELLO, FRAME_RESUME, FRAME_CHAT, FRAME_PRIVATE, FRAME_SYSTEM, FRAME_HISTORY, FRAME_SEQUENCED,
+    FRAME_SESSION, FRAME_AI_POSITIVE, FRAME_AI_STREAM, FRAME_SHUTDOWN, FRAME_PING, FRAME_PONG,
+    STREAM_START, STREAM_CHUNK, STREAM_END, STREAM_ERROR,
+)
+from chat_message_view import ChatMessageView, KIND_OWN, KIND_OTHER, KIND_AI, KIND_SYSTEM
+
+UI_POLL_INTERVAL = 30       # 受信キューを確認する間隔 (ミリ秒)
+MAX_FRAMES_PER_TICK = 200   # 1回に表示するフレーム数の上限（残りは次の回に回し、入力操作を待たせない）
+
+# 自動再接続: 接続が切れたら RECONNECT_BASE_DELAY 秒から倍々に（最大 RECONNECT_MAX_DELAY 秒）間隔を空けて再接続し、
+# サーバーに最後に受け取った通し番号を示して、切れている間の配信だけを受け取り直す
+RECONNECT_BASE_DELAY = 0.5
+RECONNECT_MAX_DELAY = 30.0
+CONNECT_TIMEOUT = 5.0
+OUTBOX_SIZE = 100           # 再開時の再送に備えて残す直近の発言の数
+# サーバーはハートビートの間隔ごとに PING を送ってくるため、その HEARTBEAT_TIMEOUT_FACTOR 倍の間
+# 何も受信しなければ接続が切れたとみなす（スリープ復帰後やNATのタイムアウトで半開きになった接続）
+HEARTBEAT_TIMEOUT_FACTOR = 3
+# 受信キューに積む、フレーム以外の通知の種別
+EVENT_RECONNECTED = "reconnected"          # 再接続できた (ペイロードは新しいソケット)
+EVENT_RECONNECT_FAILED = "reconnect_failed"  # 再接続に失敗した (ペイロードはエラー内容)
 
 # リソースパスを取得する関数
 def get_resource_path(relative_path):
@@ -97,11 +124,16 @@ class ChatClientGUI:
         self.disconnect_button = ctk.CTkButton(self.connection_frame, text="切断", command=self.disconnect_from_server, state='disabled', width=70)
         self.disconnect_button.pack(side="left", padx=(0,10))
 
+        self.auto_reconnect = ctk.BooleanVar(value=True)
+        self.reconnect_checkbox = ctk.CTkCheckBox(self.connection_frame, text="自動再接続", variable=self.auto_reconnect,
+                                                  width=90, checkbox_width=18, checkbox_height=18)
+        self.reconnect_checkbox.pack(side="left", padx=(0,5))
+
         self.help_button = ctk.CTkButton(self.connection_frame, text="ヘルプ", command=self.show_help, width=70, fg_color=("#4CAF50", "#45a049"))
         self.help_button.pack(side="left", padx=(0,5))
 
-        # チャット表示エリア（LINEライクなレイアウト）
-        self.chat_display = ctk.CTkScrollableFrame(master, fg_color="#f0f0f0")
+        # チャット表示エリア（LINEライクなレイアウト。表示範囲のバブルだけを作る仮想化リスト）
+        self.chat_display = ChatMessageView(master, fg_color="#f0f0f0")
         self.chat_display.pack(pady=5, padx=25, fill="both", expand=True)
 
         # メッセージ入力フレーム
@@ -130,88 +162,65 @@ class ChatClientGUI:
         self.receive_thread = None
         self.username = "" # 接続時に設定される実際のユーザー名
         self.initial_username = "" # ユーザーが最初に入力したユーザー名
+        self.ai_streams = {} # 逐次受信中のGemini応答 (ストリームID -> [メッセージ, これまでの本文])
+        # 受信スレッドはウィジェットに触れず、受信したフレームをこのキューに積むだけにする。
+        # Tkのスレッドが poll_incoming() でまとめて取り出して表示する
+        # (要素は (フレーム種別, ペイロード)。切断の通知は (None, 理由)、再接続の結果は (EVENT_*, 内容))
+        self.incoming = collections.deque()
+
+        # 再接続と再開。サーバーから受け取ったセッション情報 (トークン・epoch)、最後に受け取った配信の通し番号、
+        # 発言に付けるメッセージIDと、再開時に再送するための直近の発言
+        self.server_address = None
+        self.session_info = None
+        self.session_ready = False  # FRAME_SESSION を受け取るまでは発言を送らずに溜めておく
+        self.last_seq = 0
+        self.next_message_id = 1
+        self.sent_message_id = 0    # 送信済みの発言のメッセージIDの最大値
+        self.outbox = collections.deque(maxlen=OUTBOX_SIZE)  # (メッセージID, 本文)
+        self.reconnecting = False
+        self.reconnect_attempt = 0
+        self.reconnect_after_id = None
 
         master.protocol("WM_DELETE_WINDOW", self.on_closing)
+        self.poll_incoming()
 
-    def create_message_bubble(self, username, message_text, is_own=False, message_type="normal"):
-        """LINEライクなメッセージバブルを作成"""
-        # メッセージコンテナフレーム
-        container = ctk.CTkFrame(self.chat_display, fg_color="transparent")
-        container.pack(fill="x", padx=10, pady=2)
-        
+    def bubble_entry(self, username, message_text, is_own=False, message_type="normal"):
+        """バブル1件分の (種類, 表示名, 本文) を返す"""
         if message_type == "system":
             # システムメッセージは中央配置
-            system_frame = ctk.CTkFrame(container, fg_color="#ffebee", corner_radius=15)
-            system_frame.pack(pady=5)
-            system_label = ctk.CTkLabel(
-                system_frame, 
-                text=message_text, 
-                text_color="#d32f2f",
-                font=("Arial", 15, "bold"),  # 太字を追加
-                wraplength=400
-            )
-            system_label.pack(padx=10, pady=5)
-        else:
-            if is_own:
-                # 自分のメッセージ（右側）
-                message_frame = ctk.CTkFrame(container, fg_color="transparent")
-                message_frame.pack(side="right", anchor="e")
-                
-                bubble = ctk.CTkFrame(message_frame, fg_color="#e3f2fd", corner_radius=15)
-                bubble.pack(side="right", padx=(50, 0))
-                
-                # メッセージテキスト
-                message_label = ctk.CTkLabel(
-                    bubble, 
-                    text=message_text, 
-                    text_color="#000000",
-                    font=("Arial", 16, "bold"),  # 太字を追加
-                    wraplength=300,
-                    justify="left"
-                )
-                message_label.pack(anchor="e", padx=10, pady=(5, 5))
-            else:
-                # 相手のメッセージ（左側）
-                message_frame = ctk.CTkFrame(container, fg_color="transparent")
-                message_frame.pack(side="left", anchor="w")
-                
-                # ユーザー名表示（バブルの外側上部）
-                if username and ":" in f"{username}:":
-                    display_name = username.split(":")[0] if ":" in username else username
-                    name_label = ctk.CTkLabel(
-                        message_frame, 
-                        text=display_name, 
-                        font=("Arial", 13, "bold"),  # 太字を追加
-                        text_color="#666"
-                    )
-                    name_label.pack(anchor="w", padx=10, pady=(0, 2))
-                
-                bubble = ctk.CTkFrame(message_frame, fg_color="#ffffff", corner_radius=15)
-                bubble.pack(side="left", padx=(0, 50))
-                
-                # メッセージテキスト
-                clean_message = message_text
-                if ":" in message_text and username:
-                    parts = message_text.split(":", 1)
-                    if len(parts) > 1:
-                        clean_message = parts[1].strip()
-                
-                message_label = ctk.CTkLabel(
-                    bubble, 
-                    text=clean_message, 
-                    text_color="#000000",
-                    font=("Arial", 16, "bold"),  # 太字を追加
-                    wraplength=300,
-                    justify="left"
-                )
-                message_label.pack(anchor="w", padx=10, pady=5)
-        
-        # スクロールを最下部に移動
-        self.chat_display._parent_canvas.after(100, self._scroll_to_bottom)
+            return KIND_SYSTEM, "", message_text
+        if is_own:
+            # 自分のメッセージ（右側）
+            return KIND_OWN, "", message_text
+
+        # 相手のメッセージ（左側）。ユーザー名はバブルの外側上部に表示
+        display_name = username.split(":")[0] if username else ""
+        if message_type == "ai":
+            # AI応答は本文中の ":" で分割しない
+            return KIND_AI, display_name, message_text
+        clean_message = message_text
+        if ":" in message_text and username:
+            parts = message_text.split(":", 1)
+            if len(parts) > 1:
+                clean_message = parts[1].strip()
+        return KIND_OTHER, display_name, clean_message
 
-    def _scroll_to_bottom(self):
-        """チャット表示を最下部にスクロール"""
-        self.chat_display._parent_canvas.yview_moveto(1.0)
+    def create_message_bubble(self, username, message_text, is_own=False, message_type="normal"):
+        """LINEライクなメッセージバブルを追加し、表示中のメッセージ (ChatMessage) を返す"""
+        return self.chat_display.append(*self.bubble_entry(username, message_text, is_own, message_type))
+
+    def chat_line_entry(self, message):
+        """「送信者: 本文」形式のメッセージ（通常の発言・履歴の行）のバブル"""
+        username = ""
+        clean_message = message
+        if ":" in message:
+            parts = message.split(":", 1)
+            if len(parts) > 1:
+                username = parts[0].strip()
+                clean_message = parts[1].strip()
+
+        is_own = (username == self.username)
+        return self.bubble_entry(username, clean_message, is_own)
 
     def display_message(self, message, tag=None):
         """メッセージを表示（新しいバブル形式）"""
@@ -226,16 +235,7 @@ class ChatClientGUI:
             self.create_message_bubble("", message, tag == 'pm_sent', "system")
         else:
             # 他のユーザーのメッセージ
-            username = ""
-            clean_message = message
-            if ":" in message and not message.startswith("SYSTEM:"):
-                parts = message.split(":", 1)
-                if len(parts) > 1:
-                    username = parts[0].strip()
-                    clean_message = parts[1].strip()
-            
-            is_own = (username == self.username)
-            self.create_message_bubble(username, clean_message, is_own)
+            self.chat_display.append(*self.chat_line_entry(message))
 
     def connect_to_server(self):
         if self.is_connected:
@@ -259,9 +259,19 @@ class ChatClientGUI:
             port = int(port_str)
             self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.client_socket.connect((host, port))
+            # 短いチャットのフレームを Nagle で待たせない
+            self.client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
             
-            self.client_socket.sendall(self.username.encode('utf-8'))
-
+            self.client_socket.sendall(encode_frame(FRAME_HELLO, self.username))
+
+            self.server_address = (host, port)
+            self.session_info = None
+            self.session_ready = False
+            self.last_seq = 0
+            self.next_message_id = 1
+            self.sent_message_id = 0
+            self.outbox.clear()
+            self.reconnect_attempt = 0
             self.is_connected = True
             self.display_message(f"システム: {host}:{port} に接続試行中 (ユーザー名: {self.username})...", tag='info')
             self.master.title(f"チャットクライアント - {self.username}")
@@ -280,8 +290,8 @@ class ChatClientGUI:
             self.ai_positive_active = False # 状態更新
             self.message_input.focus()
 
-            self.receive_thread = threading.Thread(target=self.receive_messages, daemon=True)
-            self.receive_thread.start()
+            self.incoming.clear()  # 前回の接続で表示しきれなかった分は捨てる
+            self.start_receiving()
 
         except ConnectionRefusedError:
             self.display_message("接続失敗: サーバーに接続できませんでした。IPとポートを確認してください。", tag='system_error')
@@ -298,15 +308,13 @@ class ChatClientGUI:
                 self.client_socket.close()
             self.client_socket = None
             
-    def disconnect_from_server(self, show_info=True, reason=None):
-        if not self.is_connected and not self.client_socket:
-             if show_info and self.connect_button.cget('state') == 'normal':
-                  pass
-             elif show_info:
-                  messagebox.showinfo("切断", "既にサーバーから切断されています。", parent=self.master)
-             return
+    def start_receiving(self):
+        self.receive_thread = threading.Thread(target=self.receive_messages, args=(self.client_socket,), daemon=True)
+        self.receive_thread.start()
 
+    def close_socket(self):
         self.is_connected = False
+        self.session_ready = False
         if self.client_socket:
             try:
                 self.client_socket.shutdown(socket.SHUT_RDWR)
@@ -317,6 +325,23 @@ class ChatClientGUI:
             finally:
                 self.client_socket = None
 
+    def disconnect_from_server(self, show_info=True, reason=None):
+        if self.reconnecting:
+            # 再接続の待ち中に「切断」した場合は再接続をやめる
+            self.reconnecting = False
+            if self.reconnect_after_id is not None:
+                self.master.after_cancel(self.reconnect_after_id)
+                self.reconnect_after_id = None
+        elif not self.is_connected and not self.client_socket:
+             if show_info and self.connect_button.cget('state') == 'normal':
+                  pass
+             elif show_info:
+                  messagebox.showinfo("切断", "既にサーバーから切断されています。", parent=self.master)
+             return
+
+        self.close_socket()
+        self.session_info = None
+
         if show_info:
             msg = reason if reason else "サーバーから切断しました。"
             self.display_message(f"システム: {msg}", tag='info')
@@ -341,7 +366,8 @@ class ChatClientGUI:
         self.send_message()
 
     def send_message(self):
-        if not self.is_connected or not self.client_socket:
+        # 再接続中の発言は溜めておき、再接続できたら送る
+        if not self.reconnecting and (not self.is_connected or not self.client_socket):
             messagebox.showerror("送信エラー", "サーバーに接続されていません。", parent=self.master)
             return
 
@@ -349,17 +375,17 @@ class ChatClientGUI:
         if message:
             try:
                 if self.ai_positive_active: # AIポジティブモードが有効な場合
-                    self.client_socket.sendall(f"/positive_transform {message}".encode('utf-8'))
+                    self.send_chat(f"/positive_transform {message}")
                 elif message.startswith("/"):
-                    self.client_socket.sendall(message.encode('utf-8'))
+                    self.send_chat(message)
                     if message.lower().startswith("/w ") or message.lower().startswith("/msg "):
                         pass
-                    elif message.lower() == "/users":
+                    elif message.lower() in ("/users", "/rooms", "/more"):
                         pass
                     else:
                         self.display_message(f"コマンド送信: {message}", tag='info')
                 else:
-                    self.client_socket.sendall(message.encode('utf-8'))
+                    self.send_chat(message)
                     self.display_message(message, tag='own_message')  # ユーザー名を除去してメッセージのみ表示
                 
                 self.message_input.delete(0, "end")
@@ -370,6 +396,29 @@ class ChatClientGUI:
             except Exception as e:
                 self.handle_disconnection(f"送信エラー: {e}")
 
+    def send_chat(self, text):
+        """発言・コマンドにメッセージIDを付けて送る
+
+        再開時に再送できるよう直近 OUTBOX_SIZE 件を残す（サーバーは処理済みのIDの発言を重複として捨てる）。
+        セッションの確定前（接続・再接続の直後）は溜めておき、handle_session() で送る。
+        """
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        self.outbox.append((message_id, text))
+        if self.session_ready and self.client_socket:
+            self.client_socket.sendall(encode_sequenced_frame(message_id, encode_frame(FRAME_CHAT, text)))
+            self.sent_message_id = message_id
+
+    def flush_outbox(self, after_id):
+        """溜めておいた発言のうち、メッセージIDが after_id より大きいものを順に送る"""
+        try:
+            for message_id, text in list(self.outbox):
+                if message_id > after_id:
+                    self.client_socket.sendall(encode_sequenced_frame(message_id, encode_frame(FRAME_CHAT, text)))
+                    self.sent_message_id = max(self.sent_message_id, message_id)
+        except OSError as e:
+            self.handle_disconnection(f"送信エラー: {e}")
+
     def handle_ai_positive_click(self):
         """AIポジティブボタンのクリック処理（トグル方式に変更）"""
         if self.ai_positive_button.cget('state') == 'disabled' or not self.is_connected:
@@ -383,88 +432,286 @@ class ChatClientGUI:
             self.ai_positive_active = False
             self.ai_positive_button.configure(text="ポジティブ", fg_color=("#808080", "#606060"))
 
-    def receive_messages(self):
-        while self.is_connected and self.client_socket:
+    def receive_messages(self, sock):
+        decoder = FrameDecoder()
+        # 再接続後は別のソケットに切り替わるため、自分のソケットが現役の間だけ受信する
+        while self.is_connected and self.client_socket is sock:
             try:
-                message_bytes = self.client_socket.recv(4096)
+                message_bytes = sock.recv(4096)
                 if not message_bytes:
-                    self.handle_disconnection("サーバーが接続を閉じました。")
+                    if self.client_socket is sock:
+                        self.handle_disconnection("サーバーが接続を閉じました。")
                     break
                 
-                message = message_bytes.decode('utf-8')
-
-                # ユーザー名変更通知の処理
-                # 例: "SYSTEM: ユーザー名 'User1' は既に使用中のため、'User1_1' に変更されました。"
-                # 例: "SYSTEM: ユーザー名が無効だったため、'User12345' に設定されました。"
-                match_rename = re.match(r"SYSTEM: ユーザー名 '(.*)' は既に使用中のため、'(.*)' に変更されました。", message)
-                match_setname = re.match(r"SYSTEM: ユーザー名が無効だったため、'(.*)' に設定されました。", message)
-
-                if match_rename and match_rename.group(1) == self.initial_username:
-                    old_name, new_name = match_rename.groups()
-                    self.username = new_name
-                    self.master.title(f"チャットクライアント - {self.username}")
-                    self.display_message(message, tag='system_warn')
-                elif match_setname and self.is_connected : # 接続直後の可能性が高い
-                    # この形式の場合、誰のユーザー名が変更されたか特定しにくいが、
-                    # 接続直後であれば自分の可能性が高い。
-                    # より確実なのはサーバーが「あなたのユーザー名は～」と送ること。
-                    # ここでは、もしinitial_usernameがサーバーによって不適切と判断された場合を想定。
-                    new_name = match_setname.group(1)
-                    # 最初のユーザー名が空だったり予約語だった場合、このメッセージが飛んでくる
-                    if self.initial_username == "" or self.initial_username.upper() == "SERVER" or self.initial_username.upper() == "SYSTEM" or self.initial_username == new_name : # 最後の条件は、元々その名前だった場合
-                        self.username = new_name
-                        self.master.title(f"チャットクライアント - {self.username}")
-                        self.display_message(message, tag='system_warn')
-                    else: # 他の誰かの名前が設定されたメッセージかもしれない
-                        self.display_message(message, tag='system')
-
-                elif message == "SERVER_SHUTDOWN":
-                    self.handle_disconnection("サーバーがシャットダウンしました。")
-                    break
-                elif message.startswith("SYSTEM:"):
-                    self.display_message(message, tag='system')
-                elif message.startswith("(個人 from"): # (個人 from Sender): Message
-                    self.display_message(message, tag='pm_received')
-                elif message.startswith("(個人 to"):   # (個人 to Recipient): Message
-                    self.display_message(message, tag='pm_sent')
-                # elif message.startswith("GEMINI_RESPONSE:"): # Geminiからの応答 # 変更
-                #     # プレフィックス "GEMINI_RESPONSE:" を除去して表示
-                #     # サーバー側で "Gemini: " が付与されていることを想定
-                #     actual_message = message.split(":", 1)[1].strip() if ":" in message else message.strip() 
-                #     self.display_message(actual_message, tag='gemini_response_tag')
-                elif message.startswith("AI_POSITIVE_RESPONSE:"): # AIポジティブ変換応答の処理
-                    # 例: AI_POSITIVE_RESPONSE:OriginalUser (ポジティブ): Transformed Message
-                    actual_message = message.split(":", 1)[1].strip() if ":" in message else message.strip()
-                    self.display_message(actual_message, tag='ai_positive_response_tag')
-                else:
-                    self.display_message(message, tag='other_message')
-
-            except UnicodeDecodeError:
-                self.display_message("受信エラー: メッセージのデコードに失敗しました。", tag='system_error')
+                # 1回の受信に複数のフレームが含まれる場合や、フレームが分割されて
+                # 届く場合があるため、デコーダーで完成したフレームだけを処理する
+                for frame_type, payload in decoder.feed(message_bytes):
+                    self.incoming.append((frame_type, payload))
+                    if frame_type == FRAME_SHUTDOWN:
+                        return
+
+            except ProtocolError as e:
+                # 不正なデータより前に届いていたフレームは表示する
+                self.incoming.extend(e.frames)
+                if self.client_socket is sock:
+                    self.handle_disconnection(f"受信エラー: {e}")
+                break
             except ConnectionResetError:
-                if self.is_connected:
+                if self.client_socket is sock:
                     self.handle_disconnection("サーバーとの接続がリセットされました。")
                 break
             except ConnectionAbortedError:
-                if self.is_connected:
+                if self.client_socket is sock:
                     self.handle_disconnection("サーバーとの接続が中断されました。")
                 break
+            except TimeoutError:
+                if self.client_socket is sock:
+                    self.handle_disconnection("サーバーからの応答が途絶えました。")
+                break
             except OSError: # ソケットが閉じられた後など
-                 if self.is_connected:
+                 if self.client_socket is sock:
                       self.handle_disconnection("受信エラー (OSError)")
                  break
             except Exception as e:
-                if self.is_connected:
+                if self.client_socket is sock:
                     self.handle_disconnection(f"受信エラー: {e}")
                 break
+
+    def poll_incoming(self):
+        """受信キューのフレームをまとめて表示する（Tkのスレッドで定期的に実行）
+
+        表示の更新（バブルの配置とスクロール）はチャット表示側でアイドル時に1回にまとめられるため、
+        大量のメッセージが一度に届いてもバッチごとに1回の描画で済む。
+        """
+        incoming = self.incoming
+        try:
+            for _ in range(MAX_FRAMES_PER_TICK):
+                try:
+                    frame_type, payload = incoming.popleft()
+                except IndexError:
+                    break
+                # 不正なフレーム1つで表示全体が止まらないよう、フレームごとにエラーを捕まえる
+                try:
+                    self.dispatch_incoming(frame_type, payload)
+                except Exception as e:
+                    print(f"受信フレームの処理中にエラーが発生 (種別 {frame_type}): {e!r}")
+                    self.display_message(f"受信エラー: メッセージを表示できません ({e})", tag='system_error')
+        finally:
+            # 残りがあればすぐ次のバッチを処理する（間に入力イベントが処理される）
+            self.master.after(1 if incoming else UI_POLL_INTERVAL, self.poll_incoming)
+
+    def dispatch_incoming(self, frame_type, payload):
+        if frame_type is None:
+            self.on_connection_lost(payload)
+        elif frame_type == EVENT_RECONNECTED:
+            self.finish_reconnect(payload)
+        elif frame_type == EVENT_RECONNECT_FAILED:
+            if self.reconnecting:
+                self.display_message(f"システム: 再接続に失敗しました ({payload})。", tag='info')
+                self.schedule_reconnect()
+        else:
+            self.handle_frame(frame_type, payload)
+
+    def handle_frame(self, frame_type, payload):
+        """受信した1フレームを表示する（Tkのスレッド）"""
+        if frame_type == FRAME_SEQUENCED:
+            # ルームへの配信。再開時の再送と重なった分（受け取り済みの通し番号）は表示しない
+            try:
+                seq, frame_type, payload = decode_sequenced_payload(payload)
+            except ProtocolError as e:
+                self.display_message(f"受信エラー: {e}", tag='system_error')
+                return
+            if seq <= self.last_seq:
+                return
+            self.last_seq = seq
+        if frame_type == FRAME_SHUTDOWN:
+            self.session_info = None  # サーバーの停止時は再接続しない
+            self.handle_disconnection("サーバーがシャットダウンしました。")
+            return
+        if frame_type == FRAME_PING:
+            if self.client_socket:
+                try:
+                    self.client_socket.sendall(encode_frame(FRAME_PONG, payload))
+                except OSError as e:
+                    self.handle_disconnection(f"送信エラー: {e}")
+            return
+        if frame_type == FRAME_AI_STREAM:
+            self.handle_ai_stream(payload)
+            return
+        if frame_type == FRAME_HISTORY:
+            self.handle_history(payload)
+            return
+
+        try:
+            message = decode_text(payload)
+        except UnicodeDecodeError:
+            self.display_message("受信エラー: メッセージのデコードに失敗しました。", tag='system_error')
+            return
+
+        if frame_type == FRAME_SESSION:
+            self.handle_session(message)
+        elif frame_type == FRAME_SYSTEM:
+            # ユーザー名変更通知の処理
+            # 例: "ユーザー名 'User1' は既に使用中のため、'User1_1' に変更されました。"
+            # 例: "ユーザー名が無効だったため、'User12345' に設定されました。"
+            match_rename = re.match(r"ユーザー名 '(.*)' は既に使用中のため、'(.*)' に変更されました。", message)
+            match_setname = re.match(r"ユーザー名が無効だったため、'(.*)' に設定されました。", message)
+
+            if match_rename and match_rename.group(1) == self.initial_username:
+                old_name, new_name = match_rename.groups()
+                self.username = new_name
+                self.master.title(f"チャットクライアント - {self.username}")
+                self.display_message(message, tag='system_warn')
+            elif match_setname and self.is_connected : # 接続直後の可能性が高い
+                # この形式の場合、誰のユーザー名が変更されたか特定しにくいが、
+                # 接続直後であれば自分の可能性が高い。
+                # より確実なのはサーバーが「あなたのユーザー名は～」と送ること。
+                # ここでは、もしinitial_usernameがサーバーによって不適切と判断された場合を想定。
+                new_name = match_setname.group(1)
+                # 最初のユーザー名が空だったり予約語だった場合、このメッセージが飛んでくる
+                if self.initial_username == "" or self.initial_username.upper() == "SERVER" or self.initial_username.upper() == "SYSTEM" or self.initial_username == new_name : # 最後の条件は、元々その名前だった場合
+                    self.username = new_name
+                    self.master.title(f"チャットクライアント - {self.username}")
+                    self.display_message(message, tag='system_warn')
+                else: # 他の誰かの名前が設定されたメッセージかもしれない
+                    self.display_message(message, tag='system')
+            else:
+                self.display_message(message, tag='system')
+        elif frame_type == FRAME_PRIVATE:
+            if message.startswith("(個人 from"): # (個人 from Sender): Message
+                self.display_message(message, tag='pm_received')
+            else:   # (個人 to Recipient): Message
+                self.display_message(message, tag='pm_sent')
+        elif frame_type == FRAME_AI_POSITIVE: # AIポジティブ変換応答の処理
+            # 例: OriginalUser : Transformed Message
+            self.display_message(message.strip(), tag='ai_positive_response_tag')
+        elif frame_type == FRAME_CHAT:
+            self.display_message(message, tag='other_message')
+
+    def handle_session(self, message):
+        """入室・再接続の完了時にサーバーから届くセッション情報"""
+        try:
+            info = json.loads(message)
+            resumed = bool(info["resumed"])
+            ack = int(info["ack"])
+            self.username = info["username"]
+        except (ValueError, KeyError, TypeError) as e:
+            self.display_message(f"受信エラー: セッション情報が不正です ({e})", tag='system_error')
+            return
+        self.session_info = info
+        self.master.title(f"チャットクライアント - {self.username}")
+        heartbeat = info.get("heartbeat") or 0
+        if heartbeat > 0 and self.client_socket:
+            # 次の受信から適用される
+            self.client_socket.settimeout(heartbeat * HEARTBEAT_TIMEOUT_FACTOR)
+        if resumed:
+            # 切れている間の配信はこの後にサーバーから再送される。発言はサーバーが処理済みの分より後を送り直す
+            self.flush_outbox(ack)
+            self.display_message("システム: サーバーに再接続しました。", tag='info')
+        else:
+            # 新しいセッション（再開できなかった場合を含む）: 通し番号は振り直しになり、まだ送っていない発言だけを送る
+            if self.reconnect_attempt:
+                self.display_message("システム: 以前のセッションを再開できなかったため、新しく入室しました。", tag='info')
+            self.last_seq = 0
+            self.flush_outbox(self.sent_message_id)
+        self.session_ready = True
+        self.reconnect_attempt = 0
+
+    def on_connection_lost(self, reason):
+        """接続が切れた（Tkのスレッド）。自動再接続が有効ならセッションの再開を試み、そうでなければ切断する"""
+        if not (self.auto_reconnect.get() and self.session_info is not None and self.server_address):
+            self.disconnect_from_server(show_info=True, reason=reason)
+            return
+        self.close_socket()
+        self.reconnecting = True
+        self.master.title(f"チャットクライアント - {self.username} (再接続中)")
+        self.display_message(f"システム: {reason} 再接続します...", tag='info')
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        """次の再接続を予約する。間隔は失敗のたびに倍にし (最大 RECONNECT_MAX_DELAY 秒)、ゆらぎを加える"""
+        delay = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** min(self.reconnect_attempt, 16))
+        delay *= random.uniform(0.5, 1.0)  # 多数のクライアントが同時に再接続しないようにずらす
+        self.reconnect_attempt += 1
+        self.reconnect_after_id = self.master.after(int(delay * 1000), self.attempt_reconnect)
+
+    def attempt_reconnect(self):
+        self.reconnect_after_id = None
+        if not self.reconnecting:
+            return
+        request = encode_frame(FRAME_RESUME, json.dumps({
+            "username": self.username, "token": self.session_info["token"],
+            "epoch": self.session_info["epoch"], "seq": self.last_seq, "room": self.session_info.get("room"),
+        }, ensure_ascii=False))
+        # 接続はブロックするため別スレッドで行い、結果は受信キュー経由で受け取る
+        threading.Thread(target=self.reconnect_worker, args=(self.server_address, request), daemon=True).start()
+
+    def reconnect_worker(self, address, request):
+        sock = None
+        try:
+            sock = socket.create_connection(address, timeout=CONNECT_TIMEOUT)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(request)
+        except OSError as e:
+            if sock is not None:
+                sock.close()
+            self.incoming.append((EVENT_RECONNECT_FAILED, str(e)))
+            return
+        self.incoming.append((EVENT_RECONNECTED, sock))
+
+    def finish_reconnect(self, sock):
+        if not self.reconnecting:
+            sock.close()  # 待っている間に切断された
+            return
+        self.reconnecting = False
+        self.client_socket = sock
+        self.is_connected = True
+        self.start_receiving()
+
+    def handle_history(self, payload):
+        """入室時に届く直近の履歴を、1回の追加でまとめて表示する"""
+        try:
+            room_name, lines = decode_history_payload(payload)
+        except ProtocolError as e:
+            self.display_message(f"受信エラー: 履歴を表示できません ({e})", tag='system_error')
+            return
+        if self.session_info is not None:
+            # 入室・ルーム移動時に届くため、再接続先が別のサーバープロセスだった場合に戻るルームとして覚えておく
+            self.session_info["room"] = room_name
+        entries = [self.chat_line_entry(line) for line in lines]
+        entries.append(self.bubble_entry("", f"ここまでがルーム「{room_name}」の直近の履歴です（{len(lines)}件）。",
+                                         False, "system"))
+        self.chat_display.extend(entries)
+
+    def handle_ai_stream(self, payload):
+        """逐次送信されるGeminiの応答を、1つのバブルに追記して表示する"""
+        stream_id, state, text = decode_stream_payload(payload)
+        if state == STREAM_START:
+            message = self.create_message_bubble(text, "…", False, "ai")
+            self.ai_streams[stream_id] = [message, ""]
+            return
+        stream = self.ai_streams.get(stream_id)
+        if stream is None:
+            return
+        message, body = stream
+        if state == STREAM_CHUNK:
+            stream[1] = body + text
+            self.chat_display.update_text(message, stream[1])
+        elif state == STREAM_ERROR:
+            self.chat_display.update_text(message, (body + "\n" if body else "") + text)
+            del self.ai_streams[stream_id]
+        elif state == STREAM_END:
+            del self.ai_streams[stream_id]
     
     def handle_disconnection(self, reason_message):
+        """受信スレッドからも呼べる。切断の表示と後処理はTkのスレッドで行う"""
         if self.is_connected :
             self.is_connected = False
-            self.master.after(0, lambda: self.disconnect_from_server(show_info=True, reason=reason_message))
+            self.incoming.append((None, reason_message))
 
     def on_closing(self):
-        if self.is_connected:
+        if self.is_connected or self.reconnecting:
             self.disconnect_from_server(show_info=False)
         self.master.destroy()
 
@@ -473,13 +720,18 @@ class ChatClientGUI:
         help_message = """🎉 チャット機能ガイド 🎉
 
 📱 基本的なチャット機能:
-• 普通にメッセージを入力すると、全員に送信されます
+• 普通にメッセージを入力すると、同じルームの全員に送信されます
 • Enterキーでも送信できます
 
 🚀 特別なコマンド機能:
 • /users - 現在接続中のユーザー一覧を表示
 • /w ユーザー名 メッセージ - 特定のユーザーに個人メッセージを送信
 • /msg ユーザー名 メッセージ - 個人メッセージの別コマンド
+• /join ルーム名 - ルームに移動（なければ作成）
+• /leave - 最初のルーム (lobby) に戻る
+• /rooms - ルーム一覧を表示
+• /search 語 [from:ユーザー名] - ルームの過去の発言を検索
+• /history [件数|30m|09:00] - ルームの過去の発言を表示（続きは /more）
 
 ✨ 魔法のポジティブ機能 ✨
 「ポジティブ」ボタンを押すと、あなたのメッセージが
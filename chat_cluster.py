@@ -0,0 +1,472 @@
+import collections
+import itertools
+import json
+import os
+import selectors
+import socket
+import tempfile
+import threading
+
+from chat_protocol import HEADER, MAX_FRAME_SIZE, FrameDecoder, ProtocolError
+
+# 複数プロセス構成（クラスタモード）
+#
+# 複数のサーバーワーカープロセスが同じポートで待ち受け (SO_REUSEPORT、振り分けはカーネル)、
+# ワーカー同士はUnixソケットの中継プロセス (ClusterBroker) を介して次の情報をやり取りする。
+#   - ルームへの配信（発言、AI応答、入退室の通知）と、その履歴行
+#   - 個人メッセージ（宛先のユーザーがいるワーカーにだけ届ける）
+#   - 在室情報（どのワーカーにどのユーザーがいて、どのルームにいるか）
+# これにより /users と /w はワーカーをまたいで動作し、処理は CPU コア数に応じて分散する。
+# ユーザー名はワーカーが入室させる前にブローカーで予約する (RELAY_CLAIM)。ブローカーが全ワーカーの
+# 名前を一か所で割り当てるため、別々のワーカーに同時に同じ名前で接続しても重複しない。
+#
+# 中継メッセージはチャットと同じ形式のフレーム（長さ + 種別 + ペイロード）で、
+# ペイロードは JSON のヘッダー1行と、必要な場合はその後ろにクライアントへ送るエンコード済みフレームが続く。
+# ブローカーは在室情報だけを保持し、配信は中身を見ずに他のワーカーへそのまま転送する。
+
+RELAY_HELLO = 0x01        # ワーカー -> ブローカー: {"worker": ID}
+RELAY_PRESENCE = 0x02     # 在室情報の変更 {"worker": ID, "user": 名前, "room": ルーム名 (退室時は null)}
+RELAY_SNAPSHOT = 0x03     # ブローカー -> 新しいワーカー: 他のワーカーの在室情報 {"users": {名前: [ID, ルーム名]}}
+RELAY_WORKER_DOWN = 0x04  # ブローカー -> ワーカー: ワーカーが切断した {"worker": ID}
+RELAY_BROADCAST = 0x05    # ルームへの配信 {"room": ルーム名, "history": 履歴行 or null} + フレーム
+RELAY_DELIVER = 0x06      # 個人宛の配信 {"user": 名前} + フレーム
+RELAY_CLAIM = 0x07        # ワーカー -> ブローカー: ユーザー名の予約 {"worker": ID, "request": 要求番号, "user": 希望の名前}
+RELAY_CLAIMED = 0x08      # ブローカー -> ワーカー: 予約した名前 {"request": 要求番号, "user": 名前}
+
+MAX_RELAY_FRAME_SIZE = MAX_FRAME_SIZE + 64 * 1024  # クライアントのフレーム + JSONヘッダー
+RECV_SIZE = 262144
+
+
+def default_socket_path(port):
+    return os.path.join(tempfile.gettempdir(), f"chat_cluster_{port}.sock")
+
+
+def cluster_supported():
+    """このプラットフォームでクラスタモードが使えるか (Unixソケットと SO_REUSEPORT が必要)"""
+    return hasattr(socket, "AF_UNIX") and hasattr(socket, "SO_REUSEPORT")
+
+
+def encode_relay(kind, header, body=b""):
+    payload = json.dumps(header, ensure_ascii=False).encode('utf-8') + b"\n" + body
+    return HEADER.pack(len(payload), kind) + payload
+
+
+def decode_relay(payload):
+    """中継フレームのペイロードを (ヘッダー, 本体) に分解する"""
+    try:
+        newline = payload.index(b"\n")
+        header = json.loads(payload[:newline])
+    except ValueError as e:
+        raise ProtocolError(f"中継フレームの形式が正しくありません: {e}") from e
+    if not isinstance(header, dict):
+        raise ProtocolError("中継フレームの形式が正しくありません")
+    return header, payload[newline + 1:]
+
+
+class ClusterBroker:
+    """ワーカー間の中継（スーパーバイザープロセスのスレッドで動かす）"""
+
+    def __init__(self, path, log=None):
+        self.path = path
+        self.log = log or (lambda message, level="INFO": None)
+        self.relayed_frames = 0
+        self._selector = None
+        self._server = None
+        self._thread = None
+        self._stop = threading.Event()
+        self._peers = {}      # socket -> _BrokerPeer
+        self._users = {}      # ユーザー名 -> (ワーカーID, ルーム名)
+        self._reserved = {}   # 予約済みでまだ在室情報の届いていないユーザー名 -> ワーカーID
+        self._name_suffixes = {}  # 重複時に次に試す連番 (元の名前 -> 番号)
+        self._wakeup_recv = None
+        self._wakeup_send = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # 前回の異常終了で残ったソケットファイル
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            server.bind(self.path)
+            server.listen(64)
+            server.setblocking(False)
+        except Exception:
+            server.close()
+            raise
+        self._server = server
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(server, selectors.EVENT_READ, None)
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ, self._wakeup_recv)
+        self._thread = threading.Thread(target=self._run, name="cluster-broker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        try:
+            self._wakeup_send.send(b"\0")
+        except OSError:
+            pass
+        if self._thread:
+            self._thread.join(timeout=2.0)
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                for key, mask in self._selector.select():
+                    if key.data is None:
+                        self._accept()
+                    elif key.data is self._wakeup_recv:
+                        self._wakeup_recv.recv(64)
+                    else:
+                        peer = key.data
+                        if mask & selectors.EVENT_READ:
+                            self._read(peer)
+                        if mask & selectors.EVENT_WRITE and not peer.closed:
+                            self._flush(peer)
+        finally:
+            for peer in list(self._peers.values()):
+                peer.socket.close()
+            self._selector.close()
+            self._server.close()
+            self._wakeup_recv.close()
+            self._wakeup_send.close()
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+    def _accept(self):
+        try:
+            sock, _ = self._server.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        peer = _BrokerPeer(sock)
+        self._peers[sock] = peer
+        self._selector.register(sock, selectors.EVENT_READ, peer)
+
+    def _read(self, peer):
+        try:
+            data = peer.socket.recv(RECV_SIZE)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self._close(peer)
+            return
+        error = None
+        try:
+            frames = peer.decoder.feed(data)
+        except ProtocolError as e:
+            # 不正なデータより前に届いていたフレームは中継してから切断する
+            frames, error = e.frames, e
+        for kind, payload in frames:
+            try:
+                self._handle(peer, kind, payload)
+            except ProtocolError as e:
+                error = e
+                break
+        if error is not None:
+            self.log(f"クラスタ: ワーカー {peer.worker} から不正なデータを受信しました: {error}", "ERROR")
+            self._close(peer)
+
+    def _handle(self, peer, kind, payload):
+        frame = HEADER.pack(len(payload), kind) + payload
+        if kind == RELAY_BROADCAST:
+            self._send_others(peer, frame)
+        elif kind == RELAY_DELIVER:
+            # 宛先のユーザーがいるワーカーにだけ転送する
+            header, _ = decode_relay(payload)
+            owner = self._users.get(header["user"])
+            if owner is None:
+                return  # 既に退室している
+            for other in list(self._peers.values()):
+                if other.worker == owner[0] and other is not peer:
+                    self._send(other, frame)
+        elif kind == RELAY_PRESENCE:
+            header, _ = decode_relay(payload)
+            user = header["user"]
+            # 入室した（または予約したまま接続が閉じた）名前は予約から外す
+            if self._reserved.get(user) == peer.worker:
+                del self._reserved[user]
+            if header["room"] is None:
+                if self._users.get(user, (None,))[0] == peer.worker:
+                    del self._users[user]
+            else:
+                self._users[user] = (peer.worker, header["room"])
+            self._send_others(peer, frame)
+        elif kind == RELAY_CLAIM:
+            header, _ = decode_relay(payload)
+            username = self._claim(peer.worker, header["user"])
+            self._send(peer, encode_relay(RELAY_CLAIMED, {"request": header["request"], "user": username}))
+        elif kind == RELAY_HELLO:
+            header, _ = decode_relay(payload)
+            peer.worker = header["worker"]
+            self._send(peer, encode_relay(RELAY_SNAPSHOT, {"users": {
+                user: [worker, room] for user, (worker, room) in self._users.items() if worker != peer.worker
+            }}))
+            self.log(f"クラスタ: ワーカー {peer.worker} が接続しました。")
+
+    def _claim(self, worker, desired):
+        """desired を基にクラスタ全体で重複しない名前を worker に予約する（"名前_1", "名前_2" ... の形にする）"""
+        def in_use(name):
+            return name in self._users or name in self._reserved
+
+        username = desired
+        if not in_use(username):
+            self._name_suffixes.pop(desired, None)
+        else:
+            count = self._name_suffixes.get(desired, 1)
+            username = f"{desired}_{count}"
+            while in_use(username):
+                count += 1
+                username = f"{desired}_{count}"
+            self._name_suffixes[desired] = count + 1
+        self._reserved[username] = worker
+        return username
+
+    def _send_others(self, sender, frame):
+        for other in list(self._peers.values()):
+            if other is not sender and other.worker is not None:
+                self._send(other, frame)
+
+    def _send(self, peer, frame):
+        if peer.closed:
+            return
+        self.relayed_frames += 1
+        was_empty = not peer.outbuffer
+        peer.outbuffer += frame
+        if was_empty:
+            self._flush(peer)
+
+    def _flush(self, peer):
+        try:
+            sent = peer.socket.send(peer.outbuffer)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self._close(peer)
+            return
+        del peer.outbuffer[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if peer.outbuffer else 0)
+        if events != peer.events:
+            peer.events = events
+            self._selector.modify(peer.socket, events, peer)
+
+    def _close(self, peer):
+        if peer.closed:
+            return
+        peer.closed = True
+        del self._peers[peer.socket]
+        try:
+            self._selector.unregister(peer.socket)
+        except (KeyError, ValueError):
+            pass
+        peer.socket.close()
+        if peer.worker is None:
+            return
+        # 切断したワーカーのユーザーを在室情報から消し、他のワーカーにも知らせる
+        for user in [user for user, (worker, _) in self._users.items() if worker == peer.worker]:
+            del self._users[user]
+        for user in [user for user, worker in self._reserved.items() if worker == peer.worker]:
+            del self._reserved[user]
+        self.log(f"クラスタ: ワーカー {peer.worker} が切断しました。", "WARN")
+        frame = encode_relay(RELAY_WORKER_DOWN, {"worker": peer.worker})
+        for other in list(self._peers.values()):
+            self._send(other, frame)
+
+
+class _BrokerPeer:
+    __slots__ = ("socket", "decoder", "outbuffer", "events", "worker", "closed")
+
+    def __init__(self, sock):
+        self.socket = sock
+        self.decoder = FrameDecoder(max_frame_size=MAX_RELAY_FRAME_SIZE)
+        self.outbuffer = bytearray()
+        self.events = selectors.EVENT_READ
+        self.worker = None
+        self.closed = False
+
+
+class ClusterLink:
+    """ワーカー側のブローカーへの接続
+
+    送信は publish_*() でキューに積み、送信スレッドがまとめて書き込む（イベントループを待たせない）。
+    受信は受信スレッドが行い、handler のメソッドを engine.call_soon でイベントループのスレッドに渡す。
+
+    handler が実装するメソッド（イベントループのスレッドで呼ばれる）:
+      on_cluster_broadcast(room_name, history_line, frame)
+      on_cluster_deliver(username, frame)
+    他のワーカーの在室情報は remote_users で参照する。ユーザー名は claim_username() でブローカーに予約する。
+
+    ブローカーとの接続が切れた（送受信に失敗した、または不正なデータを受信した）場合は dead になり、以後の publish_*() は捨てる。
+    """
+
+    def __init__(self, path, worker_id, handler, call_soon, log=None):
+        self.path = path
+        self.worker_id = worker_id
+        self.handler = handler
+        self.call_soon = call_soon
+        self.log = log or (lambda message, level="INFO": None)
+        self.remote_users = {}  # 他のワーカーのユーザー名 -> (ワーカーID, ルーム名)（イベントループのスレッドが更新）
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.dead = False       # ブローカーとの接続が切れ、中継を停止している
+        self._claims = {}       # 応答待ちのユーザー名の予約 (要求番号 -> callback)（イベントループのスレッド）
+        self._claim_ids = itertools.count(1)
+        self._socket = None
+        self._outgoing = collections.deque()
+        self._outgoing_ready = threading.Condition()
+        self._closed = False
+        self._threads = []
+
+    def start(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            raise
+        self._socket = sock
+        self._queue(encode_relay(RELAY_HELLO, {"worker": self.worker_id}))
+        for target, name in ((self._write_loop, "cluster-writer"), (self._read_loop, "cluster-reader")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def close(self):
+        with self._outgoing_ready:
+            self._closed = True
+            self._outgoing_ready.notify()
+        if self._socket:
+            try:
+                self._socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._socket.close()
+        for thread in self._threads:
+            thread.join(timeout=1.0)
+
+    # --- 送信 ---
+
+    def publish_broadcast(self, room_name, history_line, frame):
+        self._queue(encode_relay(RELAY_BROADCAST, {"room": room_name, "history": history_line}, frame))
+
+    def publish_deliver(self, username, frame):
+        self._queue(encode_relay(RELAY_DELIVER, {"user": username}, frame))
+
+    def publish_presence(self, username, room_name):
+        """ユーザーの入室・ルーム移動 (room_name=None は退室) を他のワーカーに知らせる"""
+        self._queue(encode_relay(RELAY_PRESENCE, {"worker": self.worker_id, "user": username, "room": room_name}))
+
+    def claim_username(self, desired, callback):
+        """desired を基にクラスタ全体で重複しないユーザー名をブローカーに予約する（イベントループのスレッド）
+
+        応答が届いたら callback(予約した名前) を呼ぶ。ブローカーとの接続が切れている（応答の前に切れた）
+        場合は callback(None) を呼ぶ。予約した名前は publish_presence() で入室・退室を知らせると解放される。
+        """
+        if self.dead:
+            callback(None)
+            return
+        request = next(self._claim_ids)
+        self._claims[request] = callback
+        self._queue(encode_relay(RELAY_CLAIM, {"worker": self.worker_id, "request": request, "user": desired}))
+
+    def _queue(self, frame):
+        with self._outgoing_ready:
+            if self.dead or self._closed:
+                return
+            self._outgoing.append(frame)
+            self._outgoing_ready.notify()
+
+    def _mark_dead(self, message):
+        """ブローカーとの接続が切れた: 送信待ちを捨て、以後の中継を止める（どのスレッドからでも呼べる）"""
+        with self._outgoing_ready:
+            if self.dead or self._closed:
+                return
+            self.dead = True
+            dropped = len(self._outgoing)
+            self._outgoing.clear()
+            self._outgoing_ready.notify()
+        self.log(f"クラスタ: {message}。他のワーカーとの中継を停止します (送信待ち {dropped}件を破棄)。", "ERROR")
+        self.call_soon(self._on_dead)
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)  # もう一方のスレッドも止める
+        except OSError:
+            pass
+
+    def _write_loop(self):
+        outgoing = self._outgoing
+        while True:
+            with self._outgoing_ready:
+                while not outgoing and not self._closed and not self.dead:
+                    self._outgoing_ready.wait()
+                if self._closed or self.dead:
+                    return
+                frames = list(outgoing)
+                outgoing.clear()
+            try:
+                self._socket.sendall(b"".join(frames))
+                self.frames_sent += len(frames)
+            except OSError as e:
+                self._mark_dead(f"ブローカーへの送信に失敗しました: {e}")
+                return
+
+    def _on_dead(self):
+        # 他のワーカーの在室情報はもう更新されないため消し、応答待ちの予約は失敗とする（イベントループのスレッド）
+        self.remote_users = {}
+        claims, self._claims = self._claims, {}
+        for callback in claims.values():
+            callback(None)
+
+    # --- 受信 ---
+
+    def _read_loop(self):
+        decoder = FrameDecoder(max_frame_size=MAX_RELAY_FRAME_SIZE)
+        while True:
+            try:
+                data = self._socket.recv(RECV_SIZE)
+            except OSError:
+                data = b""
+            if not data:
+                self._mark_dead("ブローカーとの接続が切れました")
+                return
+            try:
+                frames = decoder.feed(data)
+            except ProtocolError as e:
+                # 不正なデータより前に届いていたフレームは処理してから中継を止める
+                if e.frames:
+                    self.call_soon(self._dispatch, e.frames)
+                self._mark_dead(f"ブローカーから不正なデータを受信しました: {e}")
+                return
+            self.frames_received += len(frames)
+            # 受信した分をまとめて1回でイベントループに渡す
+            self.call_soon(self._dispatch, frames)
+
+    def _dispatch(self, frames):
+        for kind, payload in frames:
+            try:
+                header, body = decode_relay(payload)
+            except ProtocolError as e:
+                self._mark_dead(f"ブローカーから不正なデータを受信しました: {e}")
+                return
+            if kind == RELAY_BROADCAST:
+                self.handler.on_cluster_broadcast(header["room"], header["history"], body)
+            elif kind == RELAY_DELIVER:
+                self.handler.on_cluster_deliver(header["user"], body)
+            elif kind == RELAY_PRESENCE:
+                if header["room"] is None:
+                    if self.remote_users.get(header["user"], (None,))[0] == header["worker"]:
+                        del self.remote_users[header["user"]]
+                else:
+                    self.remote_users[header["user"]] = (header["worker"], header["room"])
+            elif kind == RELAY_CLAIMED:
+                callback = self._claims.pop(header["request"], None)
+                if callback is not None:
+                    callback(header["user"])
+            elif kind == RELAY_SNAPSHOT:
+                self.remote_users = {user: tuple(entry) for user, entry in header["users"].items()}
+            elif kind == RELAY_WORKER_DOWN:
+                self.remote_users = {user: entry for user, entry in self.remote_users.items()
+                                     if entry[0] != header["worker"]}
@@ -0,0 +1,213 @@
+import collections
+import itertools
+import mmap
+import os
+import struct
+import threading
+import time
+
+# チャット履歴
+#
+# メモリ上は上限付きのリングバッファ (deque) で直近の履歴を保持し、
+# 同じ内容をディスク上の追記専用ログ（メモリマップしたセグメントファイル）にも書く。
+# 再起動時はログの末尾から履歴を復元する。
+#
+# セグメントファイルの形式:
+#   レコード = 長さ (4バイト, ビッグエンディアン) + UTF-8文字列
+#   ファイルは作成時に segment_size まで0埋めで確保し、長さ0のレコードを終端とみなす。
+
+RECORD_HEADER = struct.Struct(">I")
+SEGMENT_SUFFIX = ".seg"
+
+DEFAULT_SEGMENT_SIZE = 4 * 1024 * 1024
+DEFAULT_MAX_SEGMENTS = 16
+DEFAULT_ROTATE_INTERVAL = 24 * 60 * 60  # 秒
+
+
+class SegmentLog:
+    """メモリマップしたセグメントファイルへの追記専用ログ"""
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE,
+                 max_segments=DEFAULT_MAX_SEGMENTS, rotate_interval=DEFAULT_ROTATE_INTERVAL):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_segments = max_segments
+        self.rotate_interval = rotate_interval
+
+        self._file = None
+        self._mmap = None
+        self._index = 0          # 書き込み中セグメントの番号
+        self._offset = 0         # 書き込み中セグメントの次の書き込み位置
+        self._opened_at = 0.0
+
+        os.makedirs(directory, exist_ok=True)
+        indexes = self._segment_indexes()
+        if indexes:
+            self._open_segment(indexes[-1])
+            self._offset = self._scan_end(self._mmap)
+        else:
+            self._open_segment(1)
+
+    def _segment_path(self, index):
+        return os.path.join(self.directory, f"{index:08d}{SEGMENT_SUFFIX}")
+
+    def _segment_indexes(self):
+        indexes = []
+        for name in os.listdir(self.directory):
+            stem, ext = os.path.splitext(name)
+            if ext == SEGMENT_SUFFIX and stem.isdigit():
+                indexes.append(int(stem))
+        return sorted(indexes)
+
+    def _open_segment(self, index):
+        path = self._segment_path(index)
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self._file = open(path, "r+b")
+        if os.path.getsize(path) < self.segment_size:
+            self._file.truncate(self.segment_size)
+        self._mmap = mmap.mmap(self._file.fileno(), 0)
+        self._index = index
+        self._offset = 0
+        self._opened_at = time.monotonic()
+
+    def _close_segment(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+            self._mmap.close()
+            self._mmap = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def rotate(self):
+        """新しいセグメントに切り替え、古いセグメントを削除する"""
+        self._close_segment()
+        self._open_segment(self._index + 1)
+        indexes = self._segment_indexes()
+        for index in indexes[:-self.max_segments]:
+            try:
+                os.remove(self._segment_path(index))
+            except OSError:
+                pass
+
+    def append(self, text):
+        data = text.encode('utf-8')
+        # 1レコードがセグメントに収まらない場合は末尾を切り詰める
+        max_data = self.segment_size - RECORD_HEADER.size * 2
+        if len(data) > max_data:
+            data = data[:max_data].decode('utf-8', 'ignore').encode('utf-8')
+        size = RECORD_HEADER.size + len(data)
+        # 終端マーカー (長さ0) の分を残しておく
+        if (self._offset + size + RECORD_HEADER.size > self.segment_size or
+                time.monotonic() - self._opened_at > self.rotate_interval):
+            self.rotate()
+        mm = self._mmap
+        RECORD_HEADER.pack_into(mm, self._offset, len(data))
+        mm[self._offset + RECORD_HEADER.size:self._offset + size] = data
+        self._offset += size
+
+    @staticmethod
+    def _scan_end(buffer):
+        """セグメントの終端（次の書き込み位置）を求める"""
+        offset = 0
+        limit = len(buffer) - RECORD_HEADER.size
+        while offset <= limit:
+            (length,) = RECORD_HEADER.unpack_from(buffer, offset)
+            if length == 0 or offset + RECORD_HEADER.size + length > len(buffer):
+                break
+            offset += RECORD_HEADER.size + length
+        return offset
+
+    @staticmethod
+    def _read_records(buffer, end):
+        records = []
+        offset = 0
+        while offset < end:
+            (length,) = RECORD_HEADER.unpack_from(buffer, offset)
+            start = offset + RECORD_HEADER.size
+            records.append(bytes(buffer[start:start + length]).decode('utf-8', 'replace'))
+            offset = start + length
+        return records
+
+    def tail(self, n):
+        """末尾 n 件のレコードを古い順に返す（必要なセグメントだけを新しい順に読む）"""
+        if n <= 0:
+            return []
+        result = self._read_records(self._mmap, self._offset)[-n:]
+        for index in reversed(self._segment_indexes()):
+            if len(result) >= n:
+                break
+            if index >= self._index:
+                continue
+            try:
+                with open(self._segment_path(index), "rb") as f:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                        records = self._read_records(mm, self._scan_end(mm))
+            except (OSError, ValueError):
+                continue
+            result = records[-(n - len(result)):] + result
+        return result
+
+    def flush(self):
+        if self._mmap is not None:
+            self._mmap.flush()
+
+    def close(self):
+        self._close_segment()
+
+
+class ChatHistory:
+    """直近 max_lines 件を保持するリングバッファ（任意でディスクログに永続化）"""
+
+    def __init__(self, max_lines, log=None, flush_every=64):
+        self.max_lines = max_lines
+        self.log = log
+        self.flush_every = flush_every
+        self._lines = collections.deque(maxlen=max_lines)  # 追加・上限超過時の削除ともに O(1)
+        self._lock = threading.Lock()
+        self._unflushed = 0
+        self.total = 0  # これまでに追加された件数（最新の履歴の通し番号 + 1）
+        if log is not None:
+            self._lines.extend(log.tail(max_lines))
+            self.total = len(self._lines)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def append(self, line):
+        with self._lock:
+            self._lines.append(line)
+            self.total += 1
+            if self.log is not None:
+                self.log.append(line)
+                self._unflushed += 1
+                if self._unflushed >= self.flush_every:
+                    self.log.flush()
+                    self._unflushed = 0
+
+    def tail(self, n):
+        """末尾 n 件を古い順に返す（履歴全体はコピーしない）"""
+        with self._lock:
+            lines = list(itertools.islice(reversed(self._lines), n))
+        lines.reverse()
+        return lines
+
+    def since(self, index, limit=None):
+        """通し番号 index 以降の履歴（最大 limit 件、新しい側を優先）と、次の通し番号を返す
+
+        リングから既に押し出された分は含まれない。
+        """
+        with self._lock:
+            first = self.total - len(self._lines)
+            start = max(index, first)
+            if limit is not None:
+                start = max(start, self.total - limit)
+            lines = list(itertools.islice(self._lines, start - first, None))
+            return lines, self.total
+
+    def close(self):
+        with self._lock:
+            if self.log is not None:
+                self.log.close()
+                self.log = None
@@ -0,0 +1,328 @@
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# LLMバックエンド
+#
+# サーバーは generate(prompt) / stream(prompt) だけを使い、どのLLMに繋がっているかは意識しない。
+#   GeminiBackend : Google Gemini API（本番用）
+#   FakeBackend   : ネットワーク不要の決定的なスタンドイン。遅延とエラー率を指定でき、
+#                   ワーカープールやキャッシュの負荷試験に使う
+#   HTTPBackend   : 別プロセスで起動した FakeBackend (python chat_llm.py) にHTTPで繋ぐ
+# MeteredBackend / RateLimitedBackend はこれらを包んで計測・呼び出し回数の制限を行う。
+#
+# create_backend("gemini" / "fake" / "http://127.0.0.1:8765") で生成する。
+
+DEFAULT_GEMINI_MODEL = "gemini-1.5-flash-latest"
+DEFAULT_FAKE_PORT = 8765
+LATENCY_DISTRIBUTIONS = ("fixed", "uniform", "exponential", "lognormal")
+
+
+class LLMError(Exception):
+    """LLMの呼び出しに失敗した場合の例外"""
+
+
+class GeminiBackend:
+    def __init__(self, api_key, model_name=DEFAULT_GEMINI_MODEL):
+        # Gemini機能を使う場合だけライブラリを読み込む（起動時間短縮のため）
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+        self._model = genai.GenerativeModel(model_name)
+        self.model_name = f"models/{model_name}"
+
+    def generate(self, prompt):
+        return self._model.generate_content(prompt).text
+
+    def stream(self, prompt):
+        for chunk in self._model.generate_content(prompt, stream=True):
+            if chunk.text:
+                yield chunk.text
+
+
+class FakeBackend:
+    """決定的な応答を返すスタンドイン
+
+    応答の内容はプロンプトだけで決まる（同じプロンプトには同じ応答）。
+    遅延は latency (秒) を中央値として latency_distribution に従ってばらつかせ、
+    error_rate の確率で LLMError を送出する。乱数は seed で再現できる。
+    """
+
+    def __init__(self, latency=0.2, latency_distribution="lognormal", jitter=0.5,
+                 error_rate=0.0, chunk_count=4, seed=None):
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"未対応の遅延分布です: {latency_distribution}")
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.jitter = jitter  # uniform では ±割合、lognormal では σ
+        self.error_rate = error_rate
+        self.chunk_count = max(1, chunk_count)
+        self.model_name = "fake"
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def sample_latency(self):
+        with self._lock:
+            rng = self._random
+            if self.latency_distribution == "fixed":
+                return self.latency
+            if self.latency_distribution == "uniform":
+                return max(0.0, self.latency * rng.uniform(1 - self.jitter, 1 + self.jitter))
+            if self.latency_distribution == "exponential":
+                return rng.expovariate(1 / self.latency) if self.latency > 0 else 0.0
+            return self.latency * rng.lognormvariate(0, self.jitter)
+
+    def _should_fail(self):
+        with self._lock:
+            self.calls += 1
+            if self.error_rate > 0 and self._random.random() < self.error_rate:
+                self.errors += 1
+                return True
+            return False
+
+    def generate(self, prompt):
+        time.sleep(self.sample_latency())
+        if self._should_fail():
+            raise LLMError("fake backend: 疑似エラー")
+        return fake_response(prompt)
+
+    def stream(self, prompt):
+        # 最初の断片までに遅延の半分、残りを断片ごとに均等に割り振る
+        delay = self.sample_latency()
+        time.sleep(delay / 2)
+        if self._should_fail():
+            raise LLMError("fake backend: 疑似エラー")
+        text = fake_response(prompt)
+        size = max(1, -(-len(text) // self.chunk_count))
+        for start in range(0, len(text), size):
+            if start:
+                time.sleep(delay / 2 / self.chunk_count)
+            yield text[start:start + size]
+
+
+def fake_response(prompt):
+    """プロンプトの種類に合わせた、それらしい形の決定的な応答"""
+    tag = hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:6]
+    # ポジティブ変換のバッチ: 番号付きの発言ごとに JSON 配列で返す
+    if "JSON配列" in prompt:
+        items = re.findall(r"^(\d+)\. 送信者: .*?「(.*)」$", prompt, re.M)
+        return json.dumps([{"id": int(index), "text": f"{message}、ありがとう！"} for index, message in items],
+                          ensure_ascii=False)
+    match = re.search(r"変換前のメッセージ:\s*「(.*?)」", prompt)
+    if match:
+        return f"{match.group(1)}、ありがとう！"
+    if "要約" in prompt:
+        return f"- テスト用の要約です ({tag})"
+    return f"テスト用の応答です ({tag})。"
+
+
+class HTTPBackend:
+    """serve() で起動した FakeBackend にHTTPで問い合わせる"""
+
+    def __init__(self, url, timeout=60.0):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self.model_name = f"http:{self.url}"
+
+    def _post(self, path, prompt):
+        body = json.dumps({"prompt": prompt}).encode('utf-8')
+        request = urllib.request.Request(self.url + path, data=body, headers={"Content-Type": "application/json"})
+        try:
+            return urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            raise LLMError(f"{e.code} {e.read().decode('utf-8', 'replace')}") from e
+        except OSError as e:
+            raise LLMError(str(e)) from e
+
+    def generate(self, prompt):
+        with self._post("/generate", prompt) as response:
+            return json.load(response)["text"]
+
+    def stream(self, prompt):
+        # 応答は1行1断片の JSON Lines
+        with self._post("/stream", prompt) as response:
+            for line in response:
+                entry = json.loads(line)
+                if "error" in entry:
+                    raise LLMError(entry["error"])
+                yield entry["text"]
+
+
+class MeteredBackend:
+    """バックエンドの呼び出し時間とエラー数を記録するラッパー
+
+    latency_histogram / first_chunk_histogram は chat_metrics.Histogram (ラベルは呼び出し種別)、
+    error_counter は chat_metrics.Counter。
+    """
+
+    def __init__(self, backend, latency_histogram, first_chunk_histogram, error_counter):
+        self.backend = backend
+        self.model_name = backend.model_name
+        self.latency_histogram = latency_histogram
+        self.first_chunk_histogram = first_chunk_histogram
+        self.error_counter = error_counter
+
+    def generate(self, prompt):
+        started = time.perf_counter()
+        try:
+            return self.backend.generate(prompt)
+        except Exception:
+            self.error_counter.inc(label_value="generate")
+            raise
+        finally:
+            self.latency_histogram.observe(time.perf_counter() - started, "generate")
+
+    def stream(self, prompt):
+        started = time.perf_counter()
+        first = True
+        try:
+            for text in self.backend.stream(prompt):
+                if first:
+                    self.first_chunk_histogram.observe(time.perf_counter() - started, "stream")
+                    first = False
+                yield text
+        except Exception:
+            self.error_counter.inc(label_value="stream")
+            raise
+        finally:
+            self.latency_histogram.observe(time.perf_counter() - started, "stream")
+
+
+class RateLimitedBackend:
+    """APIの呼び出し全体の毎秒件数を制限するラッパー（APIのクォータ対策）
+
+    limiter は chat_rate_limit.GlobalRateLimiter。timeout 秒待っても枠が空かなければ
+    LLMError を送出する（呼び出し元のワーカーはエラーとして依頼者に通知する）。
+    """
+
+    def __init__(self, backend, limiter, timeout=30.0):
+        self.backend = backend
+        self.model_name = backend.model_name
+        self.limiter = limiter
+        self.timeout = timeout
+
+    def _acquire(self):
+        if not self.limiter.acquire(self.timeout):
+            raise LLMError("APIの呼び出し回数の上限に達しています")
+
+    def generate(self, prompt):
+        self._acquire()
+        return self.backend.generate(prompt)
+
+    def stream(self, prompt):
+        self._acquire()
+        yield from self.backend.stream(prompt)
+
+
+def create_backend(spec, api_key=None, **fake_options):
+    """spec ("gemini" / "fake" / "http://...") からバックエンドを生成する"""
+    if spec == "gemini":
+        if not api_key:
+            raise LLMError("APIキーが設定されていません")
+        return GeminiBackend(api_key)
+    if spec == "fake":
+        return FakeBackend(**fake_options)
+    if spec.startswith(("http://", "https://")):
+        return HTTPBackend(spec)
+    raise ValueError(f"未対応のLLMバックエンドです: {spec}")
+
+
+class _FakeRequestHandler(BaseHTTPRequestHandler):
+    backend = None
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            prompt = json.loads(self.rfile.read(length))["prompt"]
+        except (ValueError, KeyError):
+            self._reply(400, {"error": "不正なリクエストです"})
+            return
+        if self.path == "/generate":
+            try:
+                self._reply(200, {"text": self.backend.generate(prompt)})
+            except LLMError as e:
+                self._reply(503, {"error": str(e)})
+        elif self.path == "/stream":
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.end_headers()
+            try:
+                for text in self.backend.stream(prompt):
+                    self._write_line({"text": text})
+            except LLMError as e:
+                self._write_line({"error": str(e)})
+        else:
+            self._reply(404, {"error": "not found"})
+
+    def _reply(self, status, entry):
+        body = json.dumps(entry, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _write_line(self, entry):
+        self.wfile.write(json.dumps(entry, ensure_ascii=False).encode('utf-8') + b"\n")
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(backend, host="127.0.0.1", port=DEFAULT_FAKE_PORT):
+    """FakeBackend をHTTPサービスとして公開する（serve_forever() で待ち受け）"""
+    handler = type("FakeRequestHandler", (_FakeRequestHandler,), {"backend": backend})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="オフライン用のLLMスタンドインサーバー")
+    parser.add_argument("--host", default="127.0.0.1", help="待ち受けアドレス (既定: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=DEFAULT_FAKE_PORT, help=f"待ち受けポート (既定: {DEFAULT_FAKE_PORT})")
+    add_fake_arguments(parser)
+    args = parser.parse_args(argv)
+    server = serve(FakeBackend(**fake_options_from_args(args)), args.host, args.port)
+    print(f"LLMスタンドインを http://{args.host}:{args.port} で起動しました。")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+def add_fake_arguments(parser):
+    """FakeBackend の設定用オプションを追加する（サーバーのCLIと共用）"""
+    parser.add_argument("--fake-latency-ms", type=float, default=200,
+                        help="スタンドインの応答遅延の中央値 [ミリ秒] (既定: 200)")
+    parser.add_argument("--fake-latency-dist", choices=LATENCY_DISTRIBUTIONS, default="lognormal",
+                        help="スタンドインの応答遅延の分布 (既定: lognormal)")
+    parser.add_argument("--fake-jitter", type=float, default=0.5,
+                        help="遅延のばらつき (uniform: ±割合, lognormal: σ) (既定: 0.5)")
+    parser.add_argument("--fake-error-rate", type=float, default=0.0,
+                        help="スタンドインが疑似エラーを返す確率 (既定: 0)")
+    parser.add_argument("--fake-seed", type=int, default=None, help="遅延・エラーの乱数シード")
+
+
+def fake_options_from_args(args):
+    return {
+        "latency": args.fake_latency_ms / 1000,
+        "latency_distribution": args.fake_latency_dist,
+        "jitter": args.fake_jitter,
+        "error_rate": args.fake_error_rate,
+        "seed": args.fake_seed,
+    }
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
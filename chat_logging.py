@@ -0,0 +1,97 @@
+import collections
+import datetime
+import sys
+import threading
+
+# サーバーログのパイプライン
+#
+# log() はレコードをキュー (collections.deque。append はロック不要) に積むだけで戻り、
+# 整形と出力 (標準出力・ファイル) はバックグラウンドのスレッドがまとめて行う。
+# GUIは subscribe() で受け取った上限付きのキューを master.after で定期的に取り出して表示する。
+# 出力レベル未満のログはキューにも積まずに捨てる。
+
+LEVELS = {"DEBUG": 10, "INFO": 20, "WARN": 30, "ERROR": 40}
+DEFAULT_LOG_LEVEL = "INFO"
+FLUSH_INTERVAL = 0.1          # 出力スレッドがキューを取り出す間隔 (秒)
+MAX_PENDING_RECORDS = 100000  # 出力が追いつかない場合はこれを超えた古いレコードから捨てる
+
+
+class LogPipeline:
+    def __init__(self, level=DEFAULT_LOG_LEVEL, stdout=True, path=None):
+        self.threshold = LEVELS[level]
+        self.stdout = stdout
+        self._file = open(path, "a", encoding="utf-8") if path else None
+        self._records = collections.deque(maxlen=MAX_PENDING_RECORDS)
+        self._subscribers = []
+        self._write_lock = threading.Lock()  # 出力スレッドと flush() の同時書き込みを防ぐ
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def set_level(self, level):
+        self.threshold = LEVELS[level]
+
+    def enabled(self, level):
+        """level のログが出力されるか（重い整形を伴うログの前に確認する）"""
+        return LEVELS.get(level, 0) >= self.threshold
+
+    def log(self, message, level="INFO"):
+        """どのスレッドからでも呼べる。出力はバックグラウンドで行う"""
+        if LEVELS.get(level, 0) < self.threshold:
+            return
+        self._records.append((datetime.datetime.now(), level, message))
+
+    def subscribe(self, maxlen=1000):
+        """整形済みの行を受け取るキューを返す（GUIが定期的に popleft() で取り出す）
+
+        取り出しが追いつかない場合は古い行から捨てられる。
+        """
+        lines = collections.deque(maxlen=maxlen)
+        self._subscribers.append(lines)
+        return lines
+
+    def unsubscribe(self, lines):
+        if lines in self._subscribers:
+            self._subscribers.remove(lines)
+
+    def flush(self):
+        """溜まっているログをすべて出力する"""
+        with self._write_lock:
+            self._drain()
+
+    def close(self):
+        self._stop.set()
+        self._thread.join(timeout=1.0)
+        self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._stop.wait(FLUSH_INTERVAL):
+            with self._write_lock:
+                self._drain()
+
+    def _drain(self):
+        records = self._records
+        if not records:
+            return
+        lines = []
+        try:
+            while True:
+                when, level, message = records.popleft()
+                lines.append(f"[{when.strftime('%Y-%m-%d %H:%M:%S')}] [{level}] {message}")
+        except IndexError:
+            pass
+        text = "\n".join(lines) + "\n"
+        try:
+            if self.stdout:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            if self._file:
+                self._file.write(text)
+                self._file.flush()
+        except (OSError, ValueError):
+            pass  # 出力先が閉じられていてもサーバーは止めない
+        for subscriber in list(self._subscribers):
+            subscriber.extend(lines)
@@ -0,0 +1,304 @@
+import bisect
+import sys
+import tkinter
+
+import customtkinter as ctk
+
+# 仮想化したチャット表示
+#
+# メッセージは ChatMessage (種類・名前・本文・高さだけを持つ小さなオブジェクト) のリストで保持し、
+# バブルのウィジェットは表示範囲 (+ 上下の余白) に入っているメッセージの分だけ作る。
+# 画面外に出たバブルは種類ごとのプールに戻し、次に表示するメッセージで使い回すため、
+# 長時間のセッションでもウィジェット数は画面に収まる件数程度で一定になる。
+#
+# スクロールは Canvas を使わず、表示位置 (self._top) から各バブルの y 座標を計算して place() で配置する。
+# まだ表示したことのないメッセージの高さは本文の長さから見積もり、表示時に実測値で置き換える。
+
+KIND_OWN = "own"        # 自分のメッセージ（右側）
+KIND_OTHER = "other"    # 他のユーザーのメッセージ（左側、名前付き）
+KIND_AI = "ai"          # Geminiの応答（左側、本文を ":" で分割しない）
+KIND_SYSTEM = "system"  # システムメッセージ（中央）
+
+MAX_MESSAGES = 5000     # 保持するメッセージ数の上限（古いものから捨てる）
+RENDER_MARGIN = 400     # 表示範囲の上下に余分に用意する高さ (px)
+MESSAGE_SPACING = 4     # バブル同士の間隔 (px)
+SCROLL_UNIT = 40        # ホイール1目盛りのスクロール量 (px)
+
+
+class ChatMessage:
+    __slots__ = ("kind", "username", "text", "height", "dirty")
+
+    def __init__(self, kind, username, text):
+        self.kind = kind
+        self.username = username
+        self.text = text
+        self.height = None  # 実測した高さ (None の間は見積もりを使う)
+        self.dirty = False  # 表示中に本文が変わった
+
+
+def estimate_height(message):
+    """実測前のメッセージの高さの見積もり（1行あたりの文字数はおおよその値）"""
+    chars_per_line = 26 if message.kind == KIND_SYSTEM else 19
+    lines = sum(len(line) // chars_per_line + 1 for line in message.text.split("\n"))
+    header = 22 if message.kind in (KIND_OTHER, KIND_AI) and message.username else 0
+    return 24 + header + 22 * lines
+
+
+class BubbleWidget:
+    """1件分のバブル。種類ごとにレイアウトを作り、本文と名前だけを差し替えて使い回す"""
+
+    def __init__(self, parent, kind):
+        self.kind = kind
+        self.message = None
+        self.container = ctk.CTkFrame(parent, fg_color="transparent")
+        self.name_label = None
+        if kind == KIND_SYSTEM:
+            # システムメッセージは中央配置
+            frame = ctk.CTkFrame(self.container, fg_color="#ffebee", corner_radius=15)
+            frame.pack(pady=5)
+            self.text_label = ctk.CTkLabel(frame, text="", text_color="#d32f2f",
+                                           font=("Arial", 15, "bold"), wraplength=400)
+            self.text_label.pack(padx=10, pady=5)
+        elif kind == KIND_OWN:
+            # 自分のメッセージ（右側）
+            message_frame = ctk.CTkFrame(self.container, fg_color="transparent")
+            message_frame.pack(side="right", anchor="e", padx=10)
+            bubble = ctk.CTkFrame(message_frame, fg_color="#e3f2fd", corner_radius=15)
+            bubble.pack(side="right", padx=(50, 0))
+            self.text_label = ctk.CTkLabel(bubble, text="", text_color="#000000", font=("Arial", 16, "bold"),
+                                           wraplength=300, justify="left")
+            self.text_label.pack(anchor="e", padx=10, pady=(5, 5))
+        else:
+            # 相手のメッセージ・AI応答（左側、名前はバブルの外側上部）
+            message_frame = ctk.CTkFrame(self.container, fg_color="transparent")
+            message_frame.pack(side="left", anchor="w", padx=10)
+            self.name_label = ctk.CTkLabel(message_frame, text="", font=("Arial", 13, "bold"), text_color="#666")
+            self.bubble = ctk.CTkFrame(message_frame, fg_color="#ffffff", corner_radius=15)
+            self.bubble.pack(side="left", padx=(0, 50))
+            self.text_label = ctk.CTkLabel(self.bubble, text="", text_color="#000000", font=("Arial", 16, "bold"),
+                                           wraplength=300, justify="left")
+            self.text_label.pack(anchor="w", padx=10, pady=5)
+
+    def show(self, message):
+        self.message = message
+        self.text_label.configure(text=message.text)
+        if self.name_label is not None:
+            if message.username:
+                self.name_label.configure(text=message.username)
+                if not self.name_label.winfo_manager():
+                    self.name_label.pack(anchor="w", padx=10, pady=(0, 2), before=self.bubble)
+            elif self.name_label.winfo_manager():
+                self.name_label.pack_forget()
+
+    def hide(self):
+        self.message = None
+        self.container.place_forget()
+
+
+class ChatMessageView(ctk.CTkFrame):
+    def __init__(self, master, **kwargs):
+        super().__init__(master, **kwargs)
+        self.messages = []
+        self._offsets = None   # 各メッセージの上端の y 座標（末尾は全体の高さ）。None は再計算が必要
+        self._top = 0          # 表示範囲の上端の y 座標
+        self._follow_tail = True  # 最下部を表示中なら、新しいメッセージに追従する
+        self._active = {}      # 表示中のメッセージ -> BubbleWidget
+        self._pool = {}        # 種類 -> 未使用の BubbleWidget のリスト
+        self._render_pending = False
+        self._rendering = False
+
+        self.viewport = ctk.CTkFrame(self, fg_color="transparent", corner_radius=0)
+        self.viewport.pack(side="left", fill="both", expand=True)
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        self.viewport.bind("<Configure>", lambda event: self.schedule_render())
+        self._bind_wheel(self.viewport)
+
+    # --- メッセージの追加・更新 ---
+
+    def append(self, kind, username, text):
+        """メッセージを追加して返す（表示はアイドル時にまとめて更新する）"""
+        message = ChatMessage(kind, username, text)
+        self.messages.append(message)
+        self._trim()
+        self._offsets = None
+        self.schedule_render()
+        return message
+
+    def extend(self, entries):
+        """(種類, 名前, 本文) のリストをまとめて追加する（入室時の履歴など）
+
+        件数によらず、上限超過分の削除と再配置・描画はそれぞれ1回だけ行う。
+        """
+        self.messages.extend(ChatMessage(kind, username, text) for kind, username, text in entries)
+        self._trim()
+        self._offsets = None
+        self.schedule_render()
+
+    def _trim(self):
+        """上限 (MAX_MESSAGES) を超えた古いメッセージを捨てる"""
+        if len(self.messages) > MAX_MESSAGES:
+            removed = self.messages[:len(self.messages) - MAX_MESSAGES]
+            del self.messages[:len(removed)]
+            removed_height = sum(self._height(old) for old in removed)
+            self._top = max(0, self._top - removed_height)
+
+    def update_text(self, message, text):
+        """表示済みのメッセージの本文を差し替える（逐次応答の追記など）"""
+        message.text = text
+        message.dirty = True
+        self.schedule_render()
+
+    def clear(self):
+        for widget in self._active.values():
+            self._release(widget)
+        self._active.clear()
+        self.messages = []
+        self._offsets = None
+        self._top = 0
+        self._follow_tail = True
+        self.schedule_render()
+
+    def scroll_to_bottom(self):
+        self._follow_tail = True
+        self.schedule_render()
+
+    # --- スクロール ---
+
+    def yview(self, *args):
+        """スクロールバーからの操作 ("moveto", 割合) / ("scroll", 量, 単位)"""
+        height = self.viewport.winfo_height()
+        total = self._layout()[-1]
+        if args[0] == "moveto":
+            self._top = float(args[1]) * total
+        elif args[0] == "scroll":
+            step = height if args[2] == "pages" else SCROLL_UNIT
+            self._top += int(args[1]) * step
+        self._top = max(0, min(self._top, max(0, total - height)))
+        self._follow_tail = self._top >= total - height - 1
+        self.schedule_render()
+
+    def _on_wheel(self, event):
+        if getattr(event, "num", None) == 4:
+            units = -1
+        elif getattr(event, "num", None) == 5:
+            units = 1
+        elif sys.platform == "darwin":
+            units = -event.delta
+        else:
+            units = -int(event.delta / 120) or (-1 if event.delta > 0 else 1)
+        self.yview("scroll", units, "units")
+
+    def _bind_wheel(self, root):
+        """root 以下の全ウィジェットにホイール操作を割り当てる
+
+        CTkウィジェットの bind() は内部の Canvas / Label にも割り当てるため、
+        子を辿って割り当てる場合は tkinter の bind を直接使い、二重に反応しないようにする。
+        """
+        stack = [root]
+        while stack:
+            widget = stack.pop()
+            for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+                tkinter.Misc.bind(widget, sequence, self._on_wheel, "+")
+            stack.extend(widget.winfo_children())
+
+    # --- 描画 ---
+
+    def schedule_render(self):
+        if not self._render_pending:
+            self._render_pending = True
+            self.after_idle(self._render)
+
+    def _height(self, message):
+        return (message.height if message.height is not None else estimate_height(message)) + MESSAGE_SPACING
+
+    def _layout(self):
+        if self._offsets is None:
+            offsets = [0] * (len(self.messages) + 1)
+            y = 0
+            for index, message in enumerate(self.messages):
+                offsets[index] = y
+                y += self._height(message)
+            offsets[-1] = y
+            self._offsets = offsets
+        return self._offsets
+
+    def _visible_range(self, offsets, height):
+        first = max(0, bisect.bisect_right(offsets, self._top - RENDER_MARGIN) - 1)
+        last = min(len(self.messages), bisect.bisect_left(offsets, self._top + height + RENDER_MARGIN))
+        return first, last
+
+    def _acquire(self, kind):
+        pool = self._pool.get(kind)
+        if pool:
+            return pool.pop()
+        widget = BubbleWidget(self.viewport, kind)
+        self._bind_wheel(widget.container)
+        return widget
+
+    def _release(self, widget):
+        widget.hide()
+        self._pool.setdefault(widget.kind, []).append(widget)
+
+    def _clamp_top(self, total, height):
+        if self._follow_tail:
+            self._top = max(0, total - height)
+        else:
+            self._top = max(0, min(self._top, max(0, total - height)))
+
+    def _render(self):
+        self._render_pending = False
+        if self._rendering:
+            return
+        self._rendering = True
+        try:
+            height = self.viewport.winfo_height()
+            offsets = self._layout()
+            self._clamp_top(offsets[-1], height)
+            first, last = self._visible_range(offsets, height)
+            visible = self.messages[first:last]
+            visible_set = set(visible)
+
+            # 表示範囲から外れたバブルをプールに戻す
+            for message in [message for message in self._active if message not in visible_set]:
+                self._release(self._active.pop(message))
+
+            shown = []
+            for message in visible:
+                widget = self._active.get(message)
+                if widget is None:
+                    widget = self._active[message] = self._acquire(message.kind)
+                    widget.show(message)
+                    shown.append(message)
+                elif message.dirty:
+                    widget.show(message)
+                    shown.append(message)
+                message.dirty = False
+
+            # 新しく表示したバブルの高さを実測し、見積もりと違えば配置を計算し直す
+            if shown:
+                self.viewport.update_idletasks()
+                changed = False
+                for message in shown:
+                    measured = self._active[message].container.winfo_reqheight()
+                    if measured != message.height:
+                        message.height = measured
+                        changed = True
+                if changed:
+                    self._offsets = None
+                    offsets = self._layout()
+                    self._clamp_top(offsets[-1], height)
+                    # 実測で高さが変わると表示範囲も変わるため、もう一度描画する（実測済みなので収束する）
+                    self.schedule_render()
+
+            for index in range(first, last):
+                message = self.messages[index]
+                self._active[message].container.place(x=0, y=offsets[index] - self._top, relwidth=1)
+
+            total = offsets[-1]
+            if total <= height or total == 0:
+                self.scrollbar.set(0.0, 1.0)
+            else:
+                self.scrollbar.set(self._top / total, (self._top + height) / total)
+        finally:
+            self._rendering = False
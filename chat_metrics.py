@@ -0,0 +1,278 @@
+import bisect
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# サーバーのメトリクス
+#
+# カウンター・ゲージ・ヒストグラムを名前で登録し、/stats コマンドの要約と
+# Prometheus のテキスト形式 (/metrics) の両方で公開する。
+# 既存のクラスが持っている件数 (AIJobScheduler.completed_jobs など) は、
+# 値を読み出す関数を登録して公開する（各クラスはレジストリに依存しない）。
+
+# 秒単位のレイテンシ用のバケット境界
+DEFAULT_LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(label, label_value):
+    if label is None or label_value is None:
+        return ""
+    escaped = str(label_value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return f'{{{label}="{escaped}"}}'
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """単調増加するカウンター（ラベルは1種類まで）"""
+
+    kind = "counter"
+
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, label_value=None):
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def values(self):
+        """{ラベル値: 値} (ラベルなしはキー None)"""
+        with self._lock:
+            return dict(self._values)
+
+    def total(self):
+        return sum(self.values().values())
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.label, key)} {_format_value(value)}"
+                for key, value in sorted(self.values().items(), key=lambda item: str(item[0]))]
+
+
+class FunctionMetric:
+    """読み出すたびに func() を呼ぶカウンター/ゲージ
+
+    func() は数値、またはラベル付きの場合 {ラベル値: 数値} を返す。
+    """
+
+    def __init__(self, kind, name, help_text, func, label=None):
+        self.kind = kind
+        self.name = name
+        self.help_text = help_text
+        self.func = func
+        self.label = label
+
+    def values(self):
+        value = self.func()
+        if value is None:
+            return {}
+        if isinstance(value, dict):
+            return value
+        return {None: value}
+
+    def total(self):
+        return sum(self.values().values())
+
+    def render(self):
+        return [f"{self.name}{_format_labels(self.label, key)} {_format_value(value)}"
+                for key, value in sorted(self.values().items(), key=lambda item: str(item[0]))]
+
+
+class Histogram:
+    """固定バケットのヒストグラム（ラベルは1種類まで）"""
+
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        self.label = label
+        self._series = {}  # ラベル値 -> [バケットごとの件数 (+Inf含む), 合計, 件数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, label_value=None):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, label_value=None):
+        """with 文で囲んだ処理の所要時間を記録する"""
+        return _Timer(self, label_value)
+
+    def count(self, label_value=None):
+        with self._lock:
+            series = self._series.get(label_value)
+            return series[2] if series else 0
+
+    def quantile(self, fraction, label_value=None):
+        """分位点の概算（該当バケットの上限）。記録がなければ None"""
+        with self._lock:
+            series = self._series.get(label_value)
+            if not series or not series[2]:
+                return None
+            counts = list(series[0])
+            total = series[2]
+        rank = fraction * total
+        cumulative = 0
+        for index, count in enumerate(counts):
+            cumulative += count
+            if cumulative >= rank and count:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def label_values(self):
+        with self._lock:
+            return list(self._series)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            series_items = sorted(((key, [list(s[0]), s[1], s[2]]) for key, s in self._series.items()),
+                                  key=lambda item: str(item[0]))
+        for key, (counts, total_sum, count) in series_items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                labels = f'le="{_format_value(bound)}"'
+                if self.label is not None and key is not None:
+                    labels = _format_labels(self.label, key)[1:-1] + "," + labels
+                lines.append(f"{self.name}_bucket{{{labels}}} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.label, key)} {_format_value(total_sum)}")
+            lines.append(f"{self.name}_count{_format_labels(self.label, key)} {count}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "label_value", "started")
+
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, self.label_value)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        # 毎秒の件数を出すため、sample() ごとにカウンターの合計を記録しておく
+        self._previous_sample = None
+        self._last_sample = None
+
+    def _register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f"メトリクス {metric.name} は既に登録されています")
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_text, label=None):
+        return self._register(Counter(name, help_text, label))
+
+    def histogram(self, name, help_text, buckets=DEFAULT_LATENCY_BUCKETS, label=None):
+        return self._register(Histogram(name, help_text, buckets, label))
+
+    def counter_func(self, name, help_text, func, label=None):
+        return self._register(FunctionMetric("counter", name, help_text, func, label))
+
+    def gauge(self, name, help_text, func, label=None):
+        return self._register(FunctionMetric("gauge", name, help_text, func, label))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def value(self, name, label_value=None):
+        """カウンター/ゲージの現在値（ラベル値を省略すると合計）"""
+        metric = self._metrics.get(name)
+        if metric is None:
+            return None
+        if label_value is None:
+            return metric.total()
+        return metric.values().get(label_value, 0)
+
+    def sample(self):
+        """カウンターの合計を記録する（定期的に呼び、rate() の計算に使う）"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        totals = {metric.name: metric.total() for metric in metrics if metric.kind == "counter"}
+        self._previous_sample, self._last_sample = self._last_sample, (time.monotonic(), totals)
+
+    def rate(self, name):
+        """直近2回の sample() の間の1秒あたりの増加量。計算できなければ None"""
+        previous, last = self._previous_sample, self._last_sample
+        if not previous or not last or last[0] <= previous[0]:
+            return None
+        if name not in last[1] or name not in previous[1]:
+            return None
+        return (last[1][name] - previous[1][name]) / (last[0] - previous[0])
+
+    def render_prometheus(self):
+        """Prometheus のテキスト形式 (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help_text}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                continue  # 読み出し関数の失敗で全体を出せなくしない
+        return "\n".join(lines) + "\n"
+
+
+def thread_count():
+    return threading.active_count()
+
+
+def open_fd_count():
+    """開いているファイル記述子の数（/proc のない環境では None）"""
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+def serve_metrics(registry, host="127.0.0.1", port=9100):
+    """GET /metrics で registry を返すHTTPサーバーを別スレッドで起動する"""
+
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?", 1)[0] != "/metrics":
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
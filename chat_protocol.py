@@ -0,0 +1,212 @@
+import json
+import struct
+import zlib
+
+# チャットの通信プロトコル（サーバー・クライアント共通）
+#
+# 1フレーム = ヘッダー(5バイト) + ペイロード
+#   ヘッダー: ペイロード長 (4バイト, ビッグエンディアン) + フレーム種別 (1バイト)
+#   ペイロード: UTF-8文字列（種別によってはバイナリ）
+#
+# TCPはメッセージの区切りを保持しないため、recv() 1回 = 1メッセージとはならない。
+# 受信側は FrameDecoder にバイト列を順次渡し、揃ったフレームだけを取り出す。
+
+HEADER = struct.Struct(">IB")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 1024 * 1024  # 1フレームの最大ペイロード長 (1MiB)
+
+# --- チャット系フレーム ---
+FRAME_HELLO = 0x01        # クライアント -> サーバー: 接続直後のユーザー名
+FRAME_CHAT = 0x02         # 通常のチャットメッセージ（クライアントからはコマンドも含む）
+FRAME_PRIVATE = 0x03      # 個人メッセージ "(個人 from ...)" / "(個人 to ...)"
+FRAME_RESUME = 0x04       # クライアント -> サーバー: 再接続時に HELLO の代わりに送る（JSON、chat_resume.py 参照）
+
+# --- システム系フレーム ---
+FRAME_SYSTEM = 0x10       # システム通知（旧 "SYSTEM:" プレフィックス）
+FRAME_HISTORY = 0x11      # 入室時に送る直近の履歴（ペイロード先頭に圧縮方式、encode_history_frame 参照）
+FRAME_SEQUENCED = 0x12    # 通し番号付きのフレーム（サーバー -> クライアント: ルームへの配信、
+                          # クライアント -> サーバー: メッセージID付きの発言。encode_sequenced_frame 参照）
+FRAME_SESSION = 0x13      # サーバー -> クライアント: 入室・再接続の完了時のセッション情報（JSON）
+
+# --- AI系フレーム ---
+FRAME_AI_POSITIVE = 0x20  # AIポジティブ変換の結果（旧 "AI_POSITIVE_RESPONSE:"）
+FRAME_AI_STREAM = 0x21    # 逐次送信されるGeminiの応答（ペイロード先頭に STREAM_HEADER）
+
+# --- 制御系フレーム ---
+FRAME_SHUTDOWN = 0x30     # サーバーシャットダウン通知（旧 "SERVER_SHUTDOWN"）
+FRAME_PING = 0x31         # ハートビート（受け取った側はペイロードをそのまま FRAME_PONG で返す）
+FRAME_PONG = 0x32         # ハートビートの応答
+
+FRAME_NAMES = {
+    FRAME_HELLO: "HELLO",
+    FRAME_CHAT: "CHAT",
+    FRAME_PRIVATE: "PRIVATE",
+    FRAME_RESUME: "RESUME",
+    FRAME_SYSTEM: "SYSTEM",
+    FRAME_HISTORY: "HISTORY",
+    FRAME_SEQUENCED: "SEQUENCED",
+    FRAME_SESSION: "SESSION",
+    FRAME_AI_POSITIVE: "AI_POSITIVE",
+    FRAME_AI_STREAM: "AI_STREAM",
+    FRAME_SHUTDOWN: "SHUTDOWN",
+    FRAME_PING: "PING",
+    FRAME_PONG: "PONG",
+}
+
+
+# FRAME_AI_STREAM のペイロード: ストリームID (4バイト) + 状態 (1バイト) + UTF-8文字列
+STREAM_HEADER = struct.Struct(">IB")
+STREAM_START = 0   # 応答の開始（文字列は見出し）
+STREAM_CHUNK = 1   # 応答の続き（文字列は追加分）
+STREAM_END = 2     # 応答の終了
+STREAM_ERROR = 3   # エラーで中断（文字列はエラー内容）
+
+
+# FRAME_SEQUENCED のペイロード: 通し番号 (8バイト) + エンコード済みのフレーム（ヘッダーを含む）
+SEQUENCE_HEADER = struct.Struct(">Q")
+SEQUENCED_OVERHEAD = HEADER_SIZE + SEQUENCE_HEADER.size  # 通し番号を付けると元のフレームより長くなる分
+
+# FRAME_HISTORY のペイロード: 圧縮方式 (1バイト) + JSON {"room": ルーム名, "lines": [履歴の行, ...]}
+HISTORY_PLAIN = 0
+HISTORY_ZLIB = 1
+HISTORY_COMPRESS_MIN = 512               # これより短い本文は圧縮しない (バイト)
+MAX_HISTORY_SIZE = 8 * MAX_FRAME_SIZE    # 展開後の本文の上限 (バイト)
+
+
+class ProtocolError(Exception):
+    """不正なフレームを受信した場合の例外
+
+    FrameDecoder.feed() が送出した場合、frames にはその呼び出しで不正なデータより前に完成していた
+    フレームが入る（接続は切断すべきだが、これらは正しく届いている）。
+    """
+
+    def __init__(self, message, frames=()):
+        super().__init__(message)
+        self.frames = frames
+
+
+def encode_frame(frame_type, payload=""):
+    """フレーム種別とペイロード（str または bytes）から送信用バイト列を作成"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ProtocolError(f"フレームが大きすぎます: {len(payload)} バイト")
+    return HEADER.pack(len(payload), frame_type) + payload
+
+
+def encode_stream_frame(stream_id, state, text=""):
+    """FRAME_AI_STREAM のフレームを作成"""
+    return encode_frame(FRAME_AI_STREAM, STREAM_HEADER.pack(stream_id, state) + text.encode('utf-8'))
+
+
+def decode_stream_payload(payload):
+    """FRAME_AI_STREAM のペイロードを (ストリームID, 状態, 文字列) に分解"""
+    if len(payload) < STREAM_HEADER.size:
+        raise ProtocolError("ストリームフレームが短すぎます")
+    stream_id, state = STREAM_HEADER.unpack_from(payload)
+    return stream_id, state, bytes(payload[STREAM_HEADER.size:]).decode('utf-8')
+
+
+def encode_sequenced_frame(seq, frame):
+    """エンコード済みの frame に通し番号 seq を付けた FRAME_SEQUENCED を作成"""
+    return HEADER.pack(SEQUENCE_HEADER.size + len(frame), FRAME_SEQUENCED) + SEQUENCE_HEADER.pack(seq) + frame
+
+
+def decode_sequenced_payload(payload):
+    """FRAME_SEQUENCED のペイロードを (通し番号, 元のフレーム種別, 元のペイロード) に分解"""
+    start = SEQUENCE_HEADER.size + HEADER_SIZE
+    if len(payload) < start:
+        raise ProtocolError("通し番号付きのフレームが短すぎます")
+    (seq,) = SEQUENCE_HEADER.unpack_from(payload)
+    length, frame_type = HEADER.unpack_from(payload, SEQUENCE_HEADER.size)
+    if start + length != len(payload):
+        raise ProtocolError("通し番号付きのフレームの長さが正しくありません")
+    return seq, frame_type, payload[start:]
+
+
+def encode_history_frame(room_name, lines, compress=True):
+    """直近の履歴 lines (古い順) を1つの FRAME_HISTORY にまとめる
+
+    compress が真で本文が HISTORY_COMPRESS_MIN バイト以上なら zlib で圧縮する。
+    1フレームに収まらない場合は古い側の行を省く。
+    """
+    lines = list(lines)
+    while True:
+        body = json.dumps({"room": room_name, "lines": lines}, ensure_ascii=False).encode('utf-8')
+        encoding = HISTORY_PLAIN
+        if compress and len(body) >= HISTORY_COMPRESS_MIN:
+            body = zlib.compress(body)
+            encoding = HISTORY_ZLIB
+        if len(body) < MAX_FRAME_SIZE or not lines:
+            return encode_frame(FRAME_HISTORY, bytes((encoding,)) + body)
+        del lines[:max(1, len(lines) // 4)]
+
+
+def decode_history_payload(payload):
+    """FRAME_HISTORY のペイロードを (ルーム名, 履歴の行のリスト) に分解"""
+    if not payload:
+        raise ProtocolError("履歴フレームが空です")
+    encoding, body = payload[0], bytes(payload[1:])
+    if encoding == HISTORY_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            body = decompressor.decompress(body, MAX_HISTORY_SIZE)
+        except zlib.error as e:
+            raise ProtocolError(f"履歴フレームを展開できません: {e}") from e
+        if decompressor.unconsumed_tail:
+            raise ProtocolError("履歴フレームが大きすぎます")
+    elif encoding != HISTORY_PLAIN:
+        raise ProtocolError(f"不明な履歴の圧縮方式です: {encoding}")
+    try:
+        entry = json.loads(body.decode('utf-8'))
+        room_name, lines = entry["room"], entry["lines"]
+    except (UnicodeDecodeError, ValueError, TypeError, KeyError) as e:
+        raise ProtocolError(f"履歴フレームの形式が正しくありません: {e}") from e
+    if not isinstance(lines, list) or not all(isinstance(line, str) for line in lines):
+        raise ProtocolError("履歴フレームの形式が正しくありません")
+    return room_name, lines
+
+
+def decode_text(payload):
+    """ペイロードをUTF-8文字列として取り出す"""
+    return bytes(payload).decode('utf-8')
+
+
+class FrameDecoder:
+    """受信バイト列を蓄積し、完成したフレームを (種別, ペイロード) として取り出す"""
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE + SEQUENCED_OVERHEAD):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """受信データを追加し、完成したフレームのリストを返す
+
+        受信バッファ全体を1回の走査でデコードし、消費した分はまとめて切り詰める。
+        不正なフレームがあれば ProtocolError を送出する（それより前に完成していたフレームは例外の frames に入れる）。
+        """
+        self._buffer += data
+        frames = []
+        buffer = self._buffer
+        view = memoryview(buffer)
+        offset = 0
+        available = len(buffer)
+        try:
+            while available - offset >= HEADER_SIZE:
+                length, frame_type = HEADER.unpack_from(buffer, offset)
+                if length > self.max_frame_size:
+                    raise ProtocolError(f"フレームが大きすぎます: {length} バイト", frames)
+                end = offset + HEADER_SIZE + length
+                if end > available:
+                    break
+                frames.append((frame_type, bytes(view[offset + HEADER_SIZE:end])))
+                offset = end
+        finally:
+            view.release()
+            if offset:
+                del buffer[:offset]
+        return frames
+
+    def pending_bytes(self):
+        """まだフレームとして完成していないバイト数"""
+        return len(self._buffer)
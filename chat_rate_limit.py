@@ -0,0 +1,122 @@
+import threading
+import time
+
+# 送信レートの制限（フラッド対策）
+#
+# 接続ごと・メッセージの種類ごと (チャット / 個人メッセージ / AIコマンド) にトークンバケットを持ち、
+# 上限を超えたメッセージは設定に応じて遅らせる・破棄する・切断する。
+# これとは別に、LLM APIの呼び出し全体の毎秒件数を GlobalRateLimiter で制限する（APIのクォータ対策）。
+
+CATEGORY_CHAT = "chat"  # 通常の発言と /users などの軽いコマンド
+CATEGORY_PM = "pm"      # /w, /msg
+CATEGORY_AI = "ai"      # /ask_gemini, /positive_transform, /summarize_gemini
+CATEGORIES = (CATEGORY_CHAT, CATEGORY_PM, CATEGORY_AI)
+
+ACTION_DELAY = "delay"            # トークンが貯まるまで処理を遅らせる
+ACTION_DROP = "drop"              # 破棄して本人に通知する
+ACTION_DISCONNECT = "disconnect"  # 切断する
+FLOOD_ACTIONS = (ACTION_DELAY, ACTION_DROP, ACTION_DISCONNECT)
+
+# 種類ごとの既定値 (毎秒の件数, バースト)
+DEFAULT_LIMITS = {
+    CATEGORY_CHAT: (5.0, 10),
+    CATEGORY_PM: (3.0, 6),
+    CATEGORY_AI: (0.5, 3),
+}
+MAX_DEFERRED_MESSAGES = 50  # delay で1接続が溜められるメッセージ数（超えた分は破棄）
+NOTICE_INTERVAL = 2.0       # 本人への制限通知は最短でもこの間隔 (秒)
+
+_AI_COMMANDS = ("/ask_gemini ", "/positive_transform ")
+
+
+def message_category(message_str):
+    """クライアントから受信したメッセージの種類"""
+    if message_str.startswith(("/w ", "/msg ")):
+        return CATEGORY_PM
+    if message_str.startswith(_AI_COMMANDS) or message_str.strip().lower() == "/summarize_gemini":
+        return CATEGORY_AI
+    return CATEGORY_CHAT
+
+
+class TokenBucket:
+    """毎秒 rate 個ずつ、最大 burst 個までトークンが貯まるバケット"""
+
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now=None):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def acquire(self, now=None):
+        """トークンを1つ使う。使えれば 0、足りなければ使えるようになるまでの秒数を返す"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class ClientRateLimiter:
+    """接続ごと・種類ごとのレート制限（イベントループのスレッドから使う）"""
+
+    def __init__(self, limits=None, action=ACTION_DROP):
+        if action not in FLOOD_ACTIONS:
+            raise ValueError(f"不明なフラッド対策の動作: {action}")
+        # rate が0以下の種類は制限しない。burst が1未満だとトークンが1つも貯まらないため1とする
+        self.limits = {category: (rate, max(1, burst)) for category, (rate, burst) in (limits or DEFAULT_LIMITS).items()
+                       if rate > 0}
+        self.action = action
+        self.delayed = dict.fromkeys(CATEGORIES, 0)
+        self.dropped = dict.fromkeys(CATEGORIES, 0)
+        self.disconnected = dict.fromkeys(CATEGORIES, 0)
+
+    def acquire(self, conn, category, now=None):
+        """conn が category のメッセージを1件送ってよければ 0、だめなら待ち時間 (秒) を返す"""
+        limit = self.limits.get(category)
+        if limit is None:
+            return 0.0
+        bucket = conn.rate_buckets.get(category)
+        if bucket is None:
+            bucket = conn.rate_buckets[category] = TokenBucket(*limit, now=now)
+        return bucket.acquire(now)
+
+    def describe(self, category):
+        rate, burst = self.limits[category]
+        return f"毎秒{rate:g}件、連続{burst}件まで"
+
+
+class GlobalRateLimiter:
+    """全体の毎秒件数の上限（複数のワーカースレッドから使う）"""
+
+    def __init__(self, rate, burst=1):
+        self._bucket = TokenBucket(rate, max(1, burst))
+        self._lock = threading.Lock()
+        self.waits = 0      # トークン待ちが発生した回数
+        self.rejected = 0   # 待ちきれずに断った回数
+
+    def acquire(self, timeout):
+        """トークンを1つ使う。timeout 秒以内に使えなければ False"""
+        deadline = time.monotonic() + timeout
+        waited = False
+        while True:
+            with self._lock:
+                wait = self._bucket.acquire()
+            if not wait:
+                return True
+            if not waited:
+                waited = True
+                with self._lock:
+                    self.waits += 1
+            if time.monotonic() + wait > deadline:
+                with self._lock:
+                    self.rejected += 1
+                return False
+            time.sleep(wait)
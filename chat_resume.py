@@ -0,0 +1,134 @@
+import collections
+import itertools
+import secrets
+import time
+
+from chat_protocol import encode_sequenced_frame
+
+# 再接続と再開（レジューム）
+#
+# ルームへの配信には、サーバー（プロセス）内で単調増加する通し番号を付けて送る (FRAME_SEQUENCED)。
+# 直近の配信は ReplayBuffer に残しておき、再接続したクライアントが最後に受け取った通し番号を示すと、
+# その後に自分のいたルームへ配信された分だけを再送する。通し番号は起動ごとに変わる epoch と組で扱い、
+# epoch が違う場合やバッファから押し出されている場合は再送せず、入室時の履歴 (FRAME_HISTORY) で代える。
+#
+# 入室時に接続ごとの再開用トークンを発行し、切断後も ttl 秒はユーザー名・ルーム・処理済みの
+# メッセージIDを ResumeRegistry に残す。クライアントは発言に単調増加のメッセージIDを付けて送り
+# (FRAME_SEQUENCED)、サーバーは処理済みのID以下の発言を重複として捨てる。そのため再接続後に
+# 届いたか分からない発言を再送しても、二重に処理されない。
+#
+# 再接続時の要求 (FRAME_RESUME): {"username": 名前, "token": トークン, "epoch": epoch, "seq": 最後に受け取った通し番号,
+#                                  "room": ルーム名}
+# 入室・再接続の完了 (FRAME_SESSION): {"username": 確定した名前, "room": ルーム名, "epoch": epoch, "token": トークン,
+#                                      "ack": 処理済みのメッセージID, "resumed": 再開できたか}
+#
+# どちらのクラスもイベントループのスレッドから使う。
+#
+# 状態はプロセスごとに持つ。クラスタモードでは再接続が別のワーカーに振り分けられることがあり、
+# その場合は再開できない（新しいセッションとして入室し、履歴で代える）。トークンには発行した
+# ワーカーの接頭辞を付け、他のワーカーのトークンであることをクライアントに伝えられるようにする。
+#
+# 再接続時の要求には、他のワーカーで入室し直す場合に備えてクライアントが知っているルーム名 ("room") も含める。
+
+DEFAULT_REPLAY_FRAMES = 5000  # 再送に備えて残す直近の配信の件数（全ルームの合計）
+DEFAULT_RESUME_TTL = 120.0    # 切断後に再開を受け付ける時間 (秒)
+
+
+class ReplayBuffer:
+    """通し番号を付けた直近の配信"""
+
+    def __init__(self, max_frames=DEFAULT_REPLAY_FRAMES):
+        self.epoch = secrets.token_hex(4)
+        self.seq = 0  # 最後に付けた通し番号
+        self._frames = collections.deque(maxlen=max_frames)  # (通し番号, ルーム名, 送信者, フレーム)
+
+    def stamp(self, room_name, frame, sender=None):
+        """frame に次の通し番号を付けたフレームを返し、再送用に残す
+
+        sender (ユーザー名) は配信から除いた送信者。再送時もその本人には送らない。
+        """
+        self.seq += 1
+        stamped = encode_sequenced_frame(self.seq, frame)
+        self._frames.append((self.seq, room_name, sender, stamped))
+        return stamped
+
+    def since(self, seq, room_name, username):
+        """通し番号 seq より後に room_name へ配信したフレーム（username が送信者のものは除く）
+
+        バッファから押し出された分がある（再送では埋められない）場合は None を返す。
+        """
+        if seq > self.seq:
+            return None
+        frames = self._frames
+        first = frames[0][0] if frames else self.seq + 1
+        if seq + 1 < first:
+            return None
+        return [stamped for _, name, sender, stamped in itertools.islice(frames, seq + 1 - first, None)
+                if name == room_name and sender != username]
+
+
+class ResumeState:
+    """切断したセッションの、再開に必要な状態"""
+
+    __slots__ = ("username", "room_name", "client_seq", "expires")
+
+    def __init__(self, username, room_name, client_seq, expires):
+        self.username = username
+        self.room_name = room_name
+        self.client_seq = client_seq
+        self.expires = expires
+
+
+class ResumeRegistry:
+    """再開用トークンの一覧（接続中のセッションと、切断後 ttl 秒以内のセッション）"""
+
+    def __init__(self, ttl=DEFAULT_RESUME_TTL, prefix=""):
+        self.ttl = ttl
+        self.prefix = prefix  # 発行するトークンの接頭辞（クラスタモードではワーカーごとに変える）
+        self._live = {}      # トークン -> Session
+        self._detached = {}  # トークン -> ResumeState（切断した順）
+
+    def __len__(self):
+        return len(self._detached)
+
+    def attach(self, conn, token=None):
+        """conn にトークンを割り当てて返す（token が None なら新しく発行する）"""
+        if token is None:
+            token = self.prefix + secrets.token_urlsafe(16)
+        conn.token = token
+        self._live[token] = conn
+        return token
+
+    def foreign(self, token):
+        """token が他のワーカー（別の接頭辞）の発行したものか"""
+        return bool(self.prefix) and not token.startswith(self.prefix)
+
+    def live(self, token):
+        """token を持つ接続中のセッション（半開きのまま残っている以前の接続など）"""
+        return self._live.get(token)
+
+    def detach(self, conn, now=None):
+        """切断した conn の状態を ttl 秒だけ残す（ルームを抜ける前に呼ぶ）"""
+        token = conn.token
+        if token is None or self._live.get(token) is not conn:
+            return
+        del self._live[token]
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        if self.ttl > 0:
+            room_name = conn.room.name if conn.room is not None else None
+            self._detached[token] = ResumeState(conn.username, room_name, conn.client_seq, now + self.ttl)
+
+    def claim(self, token, now=None):
+        """token の状態を取り出す。なければ（期限切れを含む） None"""
+        self._expire(time.monotonic() if now is None else now)
+        return self._detached.pop(token, None)
+
+    def _expire(self, now):
+        # 切断した順に並んでいるため、期限の切れていない状態が見つかった時点で止める
+        detached = self._detached
+        while detached:
+            token, state = next(iter(detached.items()))
+            if state.expires > now:
+                break
+            del detached[token]
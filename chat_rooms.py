@@ -0,0 +1,97 @@
+import re
+
+from chat_summary import RollingSummarizer
+
+# ルーム（チャンネル）
+#
+# 各ユーザーは常にどれか1つのルームに所属し、発言・AI応答・入退室の通知は同じルームの
+# メンバーにだけ配信する。そのため1件の配信コストは全接続数ではなくルームの人数に比例する。
+# 履歴と /summarize_gemini の要約、ポジティブ変換の文脈もルームごとに持つ。
+#
+# 接続直後は既定のルーム (DEFAULT_ROOM) に入る。既定のルーム以外は、最後のメンバーが
+# 抜けた時点で削除する（ディスク上の履歴ログは残るため、同じ名前で作り直すと復元される）。
+# メンバーの追加・削除はイベントループのスレッドから行う。
+
+DEFAULT_ROOM = "lobby"
+MAX_ROOMS = 1000
+ROOM_NAME_PATTERN = re.compile(r"[\w-]{1,32}")  # 履歴ログのディレクトリ名にも使うため記号は - と _ のみ
+
+
+class RoomError(Exception):
+    """ルームの作成・参加に失敗した場合の例外（メッセージはそのまま利用者に返す）"""
+
+
+class Room:
+    __slots__ = ("name", "members", "history", "summarizer", "replay_frame")
+
+    def __init__(self, name, history, summary_lines):
+        self.name = name
+        self.members = set()  # 所属している Session
+        self.history = history
+        self.summarizer = RollingSummarizer(summary_lines)
+        self.replay_frame = None  # 入室時に送る履歴のフレーム (履歴の通し番号, フレーム)
+
+    def __len__(self):
+        return len(self.members)
+
+    def __repr__(self):
+        return f"<Room {self.name} ({len(self.members)})>"
+
+
+class RoomRegistry:
+    def __init__(self, open_history, summary_lines, default_room=DEFAULT_ROOM, max_rooms=MAX_ROOMS):
+        self.open_history = open_history  # open_history(name) でルームの ChatHistory を開く
+        self.summary_lines = summary_lines
+        self.max_rooms = max_rooms
+        self._rooms = {}
+        self.default = self._create(default_room)
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def __iter__(self):
+        return iter(list(self._rooms.values()))
+
+    def get(self, name):
+        return self._rooms.get(name)
+
+    def _create(self, name):
+        room = Room(name, self.open_history(name), self.summary_lines)
+        self._rooms[name] = room
+        return room
+
+    def join(self, conn, name):
+        """conn を name のルームに移す（なければ作る）。(新しいルーム, 元のルーム) を返す"""
+        room = self._rooms.get(name)
+        if room is None:
+            if not ROOM_NAME_PATTERN.fullmatch(name):
+                raise RoomError("ルーム名には英数字・日本語・-・_ を32文字以内で指定してください。")
+            if len(self._rooms) >= self.max_rooms:
+                raise RoomError("ルーム数が上限に達しているため、新しいルームを作成できません。")
+            room = self._create(name)
+        previous = conn.room
+        if previous is room:
+            return room, previous
+        if previous is not None:
+            self._discard(conn, previous)
+        room.members.add(conn)
+        conn.room = room
+        return room, previous
+
+    def leave(self, conn):
+        """conn をルームから外す（切断時）。所属していたルームを返す"""
+        room = conn.room
+        if room is not None:
+            self._discard(conn, room)
+            conn.room = None
+        return room
+
+    def _discard(self, conn, room):
+        room.members.discard(conn)
+        if not room.members and room is not self.default:
+            del self._rooms[room.name]
+            room.history.close()
+
+    def close(self):
+        for room in self._rooms.values():
+            room.history.close()
@@ -0,0 +1,1427 @@
+import argparse
+import collections
+import itertools
+import json
+import time
+import os
+import signal
+import subprocess
+import sys
+import threading
+from chat_ai_jobs import (
+    AIJobScheduler, PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND,
+    DEFAULT_AI_WORKERS, DEFAULT_AI_QUEUE_SIZE, DEFAULT_JOB_TIMEOUT,
+)
+from chat_protocol import (
+    ProtocolError, encode_frame, decode_text, encode_stream_frame, encode_history_frame, decode_sequenced_payload,
+    STREAM_START, STREAM_CHUNK, STREAM_END, STREAM_ERROR,
+    FRAME_HELLO, FRAME_RESUME, FRAME_CHAT, FRAME_PRIVATE, FRAME_SYSTEM, FRAME_SEQUENCED, FRAME_SESSION,
+    FRAME_AI_POSITIVE, FRAME_SHUTDOWN,
+)
+from chat_ai_batch import (
+    TransformBatcher, PendingTransform, build_batch_prompt, parse_batch_response,
+    DEFAULT_BATCH_WINDOW, DEFAULT_BATCH_MAX_ITEMS,
+)
+from chat_llm import MeteredBackend, RateLimitedBackend, create_backend, add_fake_arguments, fake_options_from_args
+from chat_rate_limit import (
+    ClientRateLimiter, GlobalRateLimiter, message_category,
+    CATEGORIES, FLOOD_ACTIONS, ACTION_DELAY, ACTION_DROP, ACTION_DISCONNECT,
+    DEFAULT_LIMITS, MAX_DEFERRED_MESSAGES, NOTICE_INTERVAL,
+)
+from chat_metrics import MetricsRegistry, serve_metrics, thread_count, open_fd_count
+from chat_logging import LogPipeline, LEVELS, DEFAULT_LOG_LEVEL
+from chat_ai_cache import TransformCache, context_fingerprint, DEFAULT_CACHE_SIZE, DEFAULT_CACHE_TTL
+from chat_history import ChatHistory, SegmentLog
+from chat_store import (
+    MessageStore, PageCursor, parse_search, parse_since,
+    KIND_SEARCH, KIND_RECENT, KIND_SINCE, DEFAULT_MESSAGE_STORE, PAGE_SIZE, MAX_HISTORY_ROWS,
+)
+from chat_rooms import RoomRegistry, RoomError, DEFAULT_ROOM
+from chat_resume import ReplayBuffer, ResumeRegistry, DEFAULT_REPLAY_FRAMES, DEFAULT_RESUME_TTL
+from chat_cluster import ClusterBroker, ClusterLink, cluster_supported, default_socket_path
+from chat_server_engine import (
+    ChatServerEngine, SLOW_CONSUMER_POLICIES, POLICY_DROP_OLDEST,
+    DEFAULT_MAX_QUEUE_FRAMES, DEFAULT_MAX_QUEUE_BYTES, DEFAULT_MAX_FLUSH_DELAY,
+    DEFAULT_HEARTBEAT_INTERVAL, DEFAULT_IDLE_TIMEOUT, DEFAULT_WRITE_TIMEOUT, REAP_IDLE, REAP_WRITE,
+)
+
+# チャットサーバー本体（tkinterに依存しない）
+#
+# ソケット処理は ChatServerEngine に任せ、このクラスはユーザー名の確定、
+# コマンド処理、履歴、Gemini連携などチャットのロジックを担当する。
+# GUI (chat_server_gui.py) からも、ヘッドレス起動 (python chat_server.py) からも
+# 同じクラスを利用する。
+
+DEFAULT_HISTORY_DIR = "chat_history"
+ROOMS_HISTORY_DIR = "rooms"  # 既定以外のルームの履歴ログは history_dir/rooms/ルーム名 に保存する
+POSITIVE_PROMPT_VERSION = 1  # プロンプトを変更したら上げる（キャッシュ済みの変換結果を無効にするため）
+STATS_SAMPLE_INTERVAL = 10.0  # /stats の「毎秒の件数」を計算する間隔 (秒)
+DEFAULT_JOIN_BACKLOG = 50  # 入室時に送る直近の履歴の件数
+WORKER_MIN_UPTIME = 5.0  # クラスタモードでワーカーがこれより早く終了した場合は起動失敗とみなし、再起動しない
+
+
+class ChatServer:
+    def __init__(self, host="", port=50000, backlog=128, log_level=DEFAULT_LOG_LEVEL, log_file=None,
+                 max_queue_frames=DEFAULT_MAX_QUEUE_FRAMES, max_queue_bytes=DEFAULT_MAX_QUEUE_BYTES,
+                 slow_consumer_policy=POLICY_DROP_OLDEST, history_dir=DEFAULT_HISTORY_DIR,
+                 ai_workers=DEFAULT_AI_WORKERS, ai_queue_size=DEFAULT_AI_QUEUE_SIZE,
+                 cache_size=DEFAULT_CACHE_SIZE, cache_ttl=DEFAULT_CACHE_TTL, cache_file=None,
+                 cache_context_lines=0, batch_window=DEFAULT_BATCH_WINDOW,
+                 batch_max_items=DEFAULT_BATCH_MAX_ITEMS, llm_backend="gemini", llm_options=None,
+                 metrics_port=None, public_stats=False, rate_limits=None, flood_action=ACTION_DROP,
+                 ai_qps=0, ai_qps_burst=1, reuse_port=False, cluster_socket=None, worker_id=0,
+                 tcp_nodelay=True, max_flush_delay=DEFAULT_MAX_FLUSH_DELAY,
+                 join_backlog=DEFAULT_JOIN_BACKLOG, history_compress=True,
+                 replay_frames=DEFAULT_REPLAY_FRAMES, resume_ttl=DEFAULT_RESUME_TTL,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 write_timeout=DEFAULT_WRITE_TIMEOUT, message_store=DEFAULT_MESSAGE_STORE):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        # クラスタモードでは同じポートを複数のワーカープロセスで待ち受け、
+        # 配信・在室情報・個人メッセージを cluster_socket のブローカー経由で他のワーカーと共有する
+        self.reuse_port = reuse_port
+        self.cluster_socket = cluster_socket
+        self.worker_id = worker_id
+        self.cluster = None
+        # クライアントごとの送信キューの上限と、上限に達したときの動作
+        self.max_queue_frames = max_queue_frames
+        self.max_queue_bytes = max_queue_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        # 送信の集約: バースト時に送信を遅らせる最大時間と、TCP_NODELAY の設定
+        self.tcp_nodelay = tcp_nodelay
+        self.max_flush_delay = max_flush_delay
+        # 死んだ接続の検出: ハートビートの間隔と、無受信・送信停滞で切断するまでの時間
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.write_timeout = write_timeout
+        # ログは LogPipeline がバックグラウンドで標準出力・ファイルに書き出す
+        # (GUIは logger.subscribe() で受け取って表示する)
+        self.logger = LogPipeline(level=log_level, path=log_file)
+        # 接続ごとの送信レート制限（種類ごとのトークンバケット）と、超過時の動作
+        self.rate_limiter = ClientRateLimiter(rate_limits, flood_action)
+
+        self.engine = None  # 起動中のイベントループエンジン
+        self.is_running = False
+        self.MAX_HISTORY_LINES = 50
+        # 履歴はルームごとのメモリ上のリングバッファ。history_dir を指定すると起動時にディスクログから
+        # 復元し、以後の発言もログに追記する (None の場合はメモリのみ)
+        self.history_dir = history_dir
+        # 入室時（接続直後・/join）に、ルームの直近 join_backlog 件の履歴を1フレームにまとめて送る
+        # (history_compress が真なら zlib で圧縮する)。リングバッファはこの件数以上を保持する
+        self.join_backlog = max(0, join_backlog)
+        self.history_compress = history_compress
+        self.history_capacity = max(self.MAX_HISTORY_LINES, self.join_backlog)
+        # ルームへの配信に通し番号を付け、直近 replay_frames 件を残す。切断したクライアントが
+        # resume_ttl 秒以内に再接続すれば、同じ名前・ルームに戻し、受け取れなかった分だけを再送する
+        self.replay_frames = replay_frames
+        self.resume_ttl = resume_ttl
+        self.replay = ReplayBuffer(replay_frames)
+        self.resume = ResumeRegistry(resume_ttl, self.resume_token_prefix())
+        # クラスタモードでユーザー名の予約を待っている接続と、その間に届いたフレーム (接続 -> リスト)
+        self.entering = {}
+        # ルームの発言は SQLite のメッセージストアにも書き、/search・/history で検索する。
+        # message_store は history_dir からの相対パス（絶対パスも可）。history_dir が None なら使わない
+        self.message_store_path = os.path.join(history_dir, message_store) if history_dir and message_store else None
+        self.store = None
+        self.SUMMARY_LINES_FOR_GEMINI = 30
+        # 発言・AI応答の配信先、履歴、/summarize_gemini の要約はルーム単位
+        # (要約は前回の要約に新しい発言だけを取り込んで更新する)
+        self.rooms = RoomRegistry(lambda name: ChatHistory(self.history_capacity), self.SUMMARY_LINES_FOR_GEMINI)
+
+        # Gemini呼び出しは固定数のワーカーで実行する（同時実行数とキュー長に上限を設ける）
+        self.ai_jobs = AIJobScheduler(workers=ai_workers, max_queue=ai_queue_size, log=self.log_message)
+
+        # ポジティブ変換結果のキャッシュ。cache_context_lines > 0 の場合は直近の履歴も
+        # キーに含め、会話の流れが変わったら別の変換結果を使う
+        self.transform_cache = TransformCache(maxsize=cache_size, ttl=cache_ttl, path=cache_file)
+        self.cache_context_lines = cache_context_lines
+
+        # 変換リクエストを batch_window 秒 / batch_max_items 件まで溜めて1回のAPI呼び出しにまとめる
+        # (batch_window が0以下または batch_max_items が1以下ならバッチ化しない)
+        self.batch_window = batch_window
+        self.batch_max_items = batch_max_items
+        self.transform_batcher = None
+        # /ask_gemini の逐次応答を識別するID（クラスタモードでもワーカー間で重複しないよう上位ビットにワーカーIDを入れる）
+        self._stream_ids = itertools.count((worker_id << 24) + 1)
+
+        # LLMバックエンド（既定はGemini。"fake" や "http://..." でオフラインのスタンドインに差し替えられる）
+        self.gemini_api_key = os.getenv("API_Gemini")
+        self.llm = None
+        self.gemini_model_name = None
+        self.gemini_enabled = False
+
+        if llm_backend == "gemini" and not self.gemini_api_key:
+            self.log_message("環境変数 API_Gemini が設定されていません。Gemini機能は無効です。", "WARN")
+        else:
+            try:
+                self.llm = create_backend(llm_backend, api_key=self.gemini_api_key, **(llm_options or {}))
+                self.gemini_model_name = self.llm.model_name
+                # ai_qps > 0 の場合、APIの呼び出し全体を毎秒 ai_qps 件までに抑える
+                if ai_qps > 0:
+                    self.llm = RateLimitedBackend(self.llm, GlobalRateLimiter(ai_qps, ai_qps_burst),
+                                                  timeout=DEFAULT_JOB_TIMEOUT)
+                self.gemini_enabled = True
+                self.log_message(f"LLMバックエンドの準備ができました (model: {self.gemini_model_name})。", "INFO")
+            except Exception as e:
+                self.log_message(f"LLMバックエンドの初期化に失敗しました: {e}", "ERROR")
+                self.llm = None
+                self.gemini_enabled = False
+
+        # メトリクス。metrics_port を指定すると 127.0.0.1 で Prometheus 形式 (/metrics) を公開する
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.public_stats = public_stats  # False の場合、/stats はローカルホストからの接続だけに許可する
+        self.metrics = MetricsRegistry()
+        self.setup_metrics()
+
+    def setup_metrics(self):
+        metrics = self.metrics
+
+        def engine_value(attribute):
+            return lambda: getattr(self.engine, attribute) if self.engine else None
+
+        metrics.gauge("chat_connections", "接続数（ユーザー名確定前を含む）",
+                      lambda: len(self.engine.sessions) if self.engine else 0)
+        metrics.gauge("chat_users", "接続中のユーザー数",
+                      lambda: self.engine.sessions.user_count() if self.engine else 0)
+        metrics.counter_func("chat_connections_accepted_total", "受け付けた接続数", engine_value("accepted_connections"))
+        metrics.counter_func("chat_frames_received_total", "受信したフレーム数", engine_value("frames_received"))
+        metrics.counter_func("chat_bytes_received_total", "受信したバイト数", engine_value("bytes_received"))
+        metrics.counter_func("chat_frames_sent_total", "送信キューに積んだフレーム数", engine_value("frames_queued"))
+        metrics.counter_func("chat_bytes_sent_total", "送信したバイト数", engine_value("bytes_sent"))
+        metrics.counter_func("chat_send_syscalls_total", "送信のシステムコール数 (sendmsg / send)", engine_value("send_calls"))
+        metrics.gauge("chat_flush_delay_seconds", "現在の送信の遅らせ時間（バースト時のみ0より大きい）",
+                      engine_value("flush_delay"))
+        metrics.counter_func("chat_heartbeats_sent_total", "送信したハートビート (PING) の数", engine_value("heartbeats_sent"))
+        metrics.counter_func("chat_reaped_connections_total", "応答がないため切断した接続数",
+                             engine_value("reaped"), label="reason")
+        metrics.counter_func("chat_frames_dropped_total", "送信キューの上限超過で捨てたフレーム数", engine_value("dropped_frames"))
+        metrics.counter_func("chat_slow_consumer_disconnects_total", "受信が遅いため切断した接続数",
+                             engine_value("slow_consumer_disconnects"))
+        self.fanout_histogram = metrics.histogram("chat_broadcast_fanout_seconds", "ブロードキャスト1回の送信キュー投入時間")
+        self.command_counter = metrics.counter("chat_commands_total", "受信したメッセージ・コマンドの件数", label="command")
+        metrics.counter_func("chat_rate_limit_delayed_total", "送信レートの上限を超えて処理を遅らせたメッセージ数",
+                             lambda: self.rate_limiter.delayed, label="category")
+        metrics.counter_func("chat_rate_limit_dropped_total", "送信レートの上限を超えて破棄したメッセージ数",
+                             lambda: self.rate_limiter.dropped, label="category")
+        metrics.counter_func("chat_rate_limit_disconnects_total", "送信レートの上限を超えて切断した接続数",
+                             lambda: self.rate_limiter.disconnected, label="category")
+
+        metrics.gauge("chat_ai_queue_depth", "AIジョブの待ち件数", self.ai_jobs.queue_depth)
+        metrics.gauge("chat_ai_active_jobs", "実行中のAIジョブ数", lambda: self.ai_jobs.active_jobs)
+        metrics.counter_func("chat_ai_jobs_total", "終了したAIジョブ数", lambda: {
+            "completed": self.ai_jobs.completed_jobs,
+            "expired": self.ai_jobs.expired_jobs,
+            "rejected": self.ai_jobs.rejected_jobs,
+        }, label="result")
+        self.llm_latency = metrics.histogram("chat_llm_request_seconds", "LLM呼び出しの所要時間", label="kind")
+        self.llm_first_chunk = metrics.histogram("chat_llm_first_chunk_seconds", "逐次応答の最初の断片までの時間", label="kind")
+        self.llm_errors = metrics.counter("chat_llm_errors_total", "LLM呼び出しのエラー数", label="kind")
+        if self.llm:
+            limiter = self.llm.limiter if isinstance(self.llm, RateLimitedBackend) else None
+            self.llm = MeteredBackend(self.llm, self.llm_latency, self.llm_first_chunk, self.llm_errors)
+            if limiter:
+                metrics.counter_func("chat_llm_quota_waits_total", "呼び出し回数の上限で待たされたLLM呼び出し数",
+                                     lambda: limiter.waits)
+                metrics.counter_func("chat_llm_quota_rejected_total", "呼び出し回数の上限で断ったLLM呼び出し数",
+                                     lambda: limiter.rejected)
+
+        metrics.counter_func("chat_transform_cache_requests_total", "ポジティブ変換キャッシュの参照数", lambda: {
+            "hit": self.transform_cache.hits,
+            "miss": self.transform_cache.misses,
+        }, label="result")
+        metrics.gauge("chat_transform_cache_entries", "ポジティブ変換キャッシュの件数", lambda: len(self.transform_cache))
+        metrics.counter_func("chat_transform_batches_total", "まとめて送信した変換バッチ数",
+                             lambda: self.transform_batcher.batches if self.transform_batcher else None)
+        self.resume_counter = metrics.counter("chat_resumes_total", "再接続時の再開要求の件数", label="result")
+        self.resent_frames = metrics.counter("chat_resent_frames_total", "再接続時に再送したフレーム数")
+        self.duplicate_messages = metrics.counter("chat_duplicate_messages_total", "再送による重複として捨てた発言の件数")
+        metrics.gauge("chat_resumable_sessions", "切断後に再開を受け付けているセッション数", lambda: len(self.resume))
+        self.history_replays = metrics.counter("chat_history_replays_total", "入室時に履歴を送った回数")
+        self.summary_updates = metrics.counter("chat_summary_updates_total", "要約の更新回数")
+        metrics.gauge("chat_rooms", "ルーム数", lambda: len(self.rooms))
+        metrics.gauge("chat_history_lines", "メモリ上の履歴の行数（全ルームの合計）",
+                      lambda: sum(len(room.history) for room in self.rooms))
+        metrics.counter_func("chat_store_rows_written_total", "メッセージストアに書き込んだ行数",
+                             lambda: self.store.written if self.store else None)
+        metrics.gauge("chat_store_pending_rows", "メッセージストアへの書き込み待ちの行数",
+                      lambda: self.store.pending() if self.store else None)
+        self.store_queries = metrics.counter("chat_store_queries_total", "/search・/history の問い合わせ件数", label="kind")
+        metrics.gauge("chat_cluster_remote_users", "他のワーカーに接続しているユーザー数",
+                      lambda: len(self.cluster.remote_users) if self.cluster else None)
+        metrics.counter_func("chat_cluster_relay_frames_total", "ブローカーと中継したフレーム数", lambda: {
+            "sent": self.cluster.frames_sent,
+            "received": self.cluster.frames_received,
+        } if self.cluster else None, label="direction")
+        metrics.gauge("chat_threads", "スレッド数", thread_count)
+        metrics.gauge("chat_open_fds", "開いているファイル記述子の数", open_fd_count)
+
+    def sample_metrics(self):
+        """毎秒の件数の計算用にカウンターを記録する（イベントループのタイマーで定期実行）"""
+        if not self.engine:
+            return
+        self.metrics.sample()
+        self.engine.call_later(STATS_SAMPLE_INTERVAL, self.sample_metrics)
+
+    def log_message(self, message, level="INFO"):
+        self.logger.log(message, level)
+
+    def resume_token_prefix(self):
+        # 再開の状態はワーカーごとのため、クラスタモードではどのワーカーのトークンか分かるようにする
+        return f"w{self.worker_id}." if self.cluster_socket else ""
+
+    def open_room_history(self, name):
+        """ルームの履歴を開く。history_dir 指定時はディスクログから復元し、以後の発言も追記する"""
+        if not self.history_dir:
+            return ChatHistory(self.history_capacity)
+        # 既定のルームは history_dir 直下（ルーム導入前のログをそのまま引き継ぐ）
+        if name == DEFAULT_ROOM:
+            directory = self.history_dir
+        else:
+            directory = os.path.join(self.history_dir, ROOMS_HISTORY_DIR, name)
+        try:
+            history = ChatHistory(self.history_capacity, log=SegmentLog(directory))
+        except OSError as e:
+            self.log_message(f"履歴ログを開けませんでした。ルーム {name} の履歴はメモリ上のみに保持します: {e}", "WARN")
+            return ChatHistory(self.history_capacity)
+        if len(history):
+            self.log_message(f"履歴ログを読み込みました ({directory}, {len(history)}件)。")
+        return history
+
+    def start(self):
+        """サーバーを起動する。失敗した場合は例外を送出する"""
+        if self.is_running:
+            self.log_message("サーバーは既に起動しています。", "WARN")
+            return
+
+        # accept / 受信 / 送信はすべてエンジンのイベントループが担当し、
+        # このクラスはフレーム受信・切断の通知を受けてチャットの処理を行う
+        self.rooms = RoomRegistry(self.open_room_history, self.SUMMARY_LINES_FOR_GEMINI)
+        # 通し番号は起動ごとに振り直す (epoch が変わるため、前回の起動時の番号での再開は履歴で代える)
+        self.replay = ReplayBuffer(self.replay_frames)
+        self.resume = ResumeRegistry(self.resume_ttl, self.resume_token_prefix())
+        self.entering = {}
+        if self.message_store_path:
+            store = MessageStore(self.message_store_path, log=self.log_message)
+            try:
+                store.start()
+                self.store = store
+                self.log_message(f"メッセージストアを開きました ({self.message_store_path}, "
+                                 f"全文検索: {store.fts or '利用不可'})。")
+            except Exception as e:
+                self.log_message(f"メッセージストアを開けません ({self.message_store_path}): {e}。"
+                                 f"/search・/history は無効です。", "WARN")
+
+        self.engine = ChatServerEngine(
+            self, host=self.host, port=self.port, backlog=self.backlog, log=self.log_message,
+            max_queue_frames=self.max_queue_frames, max_queue_bytes=self.max_queue_bytes,
+            slow_consumer_policy=self.slow_consumer_policy, fanout_histogram=self.fanout_histogram,
+            reuse_port=self.reuse_port, tcp_nodelay=self.tcp_nodelay, max_flush_delay=self.max_flush_delay,
+            heartbeat_interval=self.heartbeat_interval, idle_timeout=self.idle_timeout, write_timeout=self.write_timeout,
+        )
+        try:
+            self.engine.start()
+        except Exception as e:
+            self.engine = None
+            self.log_message(f"サーバー起動エラー: {e}", "ERROR")
+            raise
+        if self.cluster_socket:
+            self.cluster = ClusterLink(self.cluster_socket, self.worker_id, self, self.engine.call_soon,
+                                       log=self.log_message)
+            try:
+                self.cluster.start()
+            except OSError as e:
+                self.cluster = None
+                self.engine.stop()
+                self.engine = None
+                self.log_message(f"クラスタのブローカーに接続できません ({self.cluster_socket}): {e}", "ERROR")
+                raise
+        if self.batch_window > 0 and self.batch_max_items > 1:
+            self.transform_batcher = TransformBatcher(
+                self.submit_transform_batch, self.engine.call_later,
+                window=self.batch_window, max_items=self.batch_max_items,
+            )
+        self.ai_jobs.start()
+        self.engine.call_soon(self.sample_metrics)
+        if self.metrics_port:
+            try:
+                self.metrics_server = serve_metrics(self.metrics, "127.0.0.1", self.metrics_port)
+                self.log_message(f"メトリクスを http://127.0.0.1:{self.metrics_port}/metrics で公開しています。")
+            except OSError as e:
+                self.log_message(f"メトリクスの公開に失敗しました: {e}", "WARN")
+        self.is_running = True
+        if self.cluster:
+            self.log_message(f"サーバー (ワーカー {self.worker_id}) がポート {self.port} で起動しました。")
+        else:
+            self.log_message(f"サーバーがポート {self.port} で起動しました。")
+
+    def stop(self, show_log=True):
+        if not self.is_running:
+            if show_log: self.log_message("サーバーは起動していません。", "WARN")
+            return
+
+        self.is_running = False
+        
+        # シャットダウン通知を積んでからループを停止する（停止時に送信される）
+        self.engine.broadcast(encode_frame(FRAME_SHUTDOWN))
+        self.ai_jobs.stop()
+        self.transform_batcher = None
+        if self.cluster:
+            self.cluster.close()
+            self.cluster = None
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+            self.metrics_server.server_close()
+            self.metrics_server = None
+        try:
+            self.transform_cache.save()
+        except OSError as e:
+            self.log_message(f"変換キャッシュの保存に失敗しました: {e}", "WARN")
+        self.engine.stop()
+        self.engine = None
+        self.rooms.close()
+        if self.store:
+            self.store.close()
+            self.store = None
+
+        if show_log: self.log_message("サーバーが停止しました。")
+        self.logger.flush()
+
+    def on_frame(self, conn, frame_type, payload):
+        """エンジンからの通知: フレームを1つ受信した（イベントループのスレッド）"""
+        if conn.username is None:
+            pending = self.entering.get(conn)
+            if pending is not None:
+                # ユーザー名の予約を待っている間のフレームは、入室後に順に処理する
+                if len(pending) < MAX_DEFERRED_MESSAGES:
+                    pending.append((frame_type, payload))
+                return
+            # 最初のフレームはユーザー名 (HELLO)、または再接続時の再開要求 (RESUME)
+            if frame_type == FRAME_HELLO:
+                self.handle_hello(conn, payload)
+            elif frame_type == FRAME_RESUME:
+                self.handle_resume(conn, payload)
+            return
+        if frame_type == FRAME_SEQUENCED:
+            # メッセージID付きの発言。処理済みのID以下は再送による重複なので捨てる
+            try:
+                message_id, frame_type, payload = decode_sequenced_payload(payload)
+            except ProtocolError as e:
+                self.log_message(f"エラー ({conn.username}): {e}", "WARN")
+                return
+            if message_id <= conn.client_seq:
+                self.duplicate_messages.inc()
+                return
+            conn.client_seq = message_id
+        if frame_type != FRAME_CHAT:
+            return
+        try:
+            message_str = decode_text(payload)
+        except UnicodeDecodeError:
+            self.log_message(f"エラー ({conn.username}): メッセージのデコードに失敗しました。UTF-8形式のメッセージのみ対応しています。", "WARN")
+            return
+        if self.admit_message(conn, message_str):
+            self.handle_client_message(conn, message_str)
+
+    def admit_message(self, conn, message_str):
+        """送信レートの制限を確認する。すぐに処理してよければ True（イベントループのスレッド）
+
+        上限を超えた場合は flood_action に従い、遅らせる (後で process_deferred が処理する)・
+        破棄して本人に通知する・切断する のいずれかを行う。
+        """
+        limiter = self.rate_limiter
+        category = message_category(message_str)
+        # 遅らせているメッセージがあれば、順序を保つためその後ろに並べる
+        if conn.deferred:
+            return self.defer_message(conn, category, message_str)
+        wait = limiter.acquire(conn, category)
+        if not wait:
+            return True
+
+        if limiter.action == ACTION_DELAY:
+            conn.deferred = collections.deque()
+            self.defer_message(conn, category, message_str)
+            self.engine.call_later(wait, self.process_deferred, conn)
+        elif limiter.action == ACTION_DISCONNECT:
+            limiter.disconnected[category] += 1
+            self.send_to_client(conn, FRAME_SYSTEM, f"送信回数が多すぎるため切断します（{limiter.describe(category)}）。")
+            self.log_message(f"送信レート超過のため切断 ({conn.username}, {category})", "WARN")
+            self.engine.close_connection(conn)
+        else:
+            self.drop_message(conn, category)
+        return False
+
+    def defer_message(self, conn, category, message_str):
+        if len(conn.deferred) >= MAX_DEFERRED_MESSAGES:
+            self.drop_message(conn, category)
+        else:
+            conn.deferred.append((category, message_str))
+            self.rate_limiter.delayed[category] += 1
+        return False
+
+    def drop_message(self, conn, category):
+        self.rate_limiter.dropped[category] += 1
+        # 通知自体がフラッドにならないよう、本人への通知は NOTICE_INTERVAL 秒に1回まで
+        now = time.monotonic()
+        if now - conn.last_limit_notice >= NOTICE_INTERVAL:
+            conn.last_limit_notice = now
+            self.send_to_client(conn, FRAME_SYSTEM, f"送信回数が多すぎるため、メッセージを破棄しました"
+                                                    f"（{self.rate_limiter.describe(category)}）。")
+            self.log_message(f"送信レート超過のためメッセージを破棄 ({conn.username}, {category})", "WARN")
+
+    def process_deferred(self, conn):
+        """遅らせていたメッセージを、トークンが貯まった分だけ順に処理する（イベントループのタイマー）"""
+        while conn.deferred and not conn.closed:
+            category, message_str = conn.deferred[0]
+            wait = self.rate_limiter.acquire(conn, category)
+            if wait:
+                self.engine.call_later(wait, self.process_deferred, conn)
+                return
+            conn.deferred.popleft()
+            self.handle_client_message(conn, message_str)
+        conn.deferred = None
+
+    def on_close(self, conn):
+        """エンジンからの通知: 接続が閉じられた（イベントループのスレッド）"""
+        if conn.username is None:
+            return
+        self.resume.detach(conn)
+        room = self.rooms.leave(conn)
+        if self.cluster:
+            self.cluster.publish_presence(conn.username, None)
+        client_address = conn.address
+        if self.is_running :
+            self.log_message(f"{conn.username} ({client_address[0]}:{client_address[1]}) が切断しました。")
+            self.broadcast_message(FRAME_SYSTEM, f"{conn.username} さんが退室しました。", None, room)
+
+    def handle_hello(self, conn, payload):
+        try:
+            username = decode_text(payload).strip()
+        except UnicodeDecodeError:
+            username = ""
+        self.enter(conn, username)
+
+    def handle_resume(self, conn, payload):
+        """再接続したクライアントの再開要求。トークンが有効なら以前の名前・ルームに戻し、受け取れなかった配信を再送する"""
+        try:
+            request = json.loads(decode_text(payload))
+            username = str(request.get("username") or "").strip()
+            token, epoch, seq = request.get("token"), request.get("epoch"), int(request.get("seq") or 0)
+        except (UnicodeDecodeError, ValueError, TypeError, AttributeError):
+            request, username, token, epoch, seq = {}, "", None, None, 0
+        state = None
+        if isinstance(token, str):
+            previous = self.resume.live(token)
+            if previous is not None:
+                # 以前の接続が半開きのまま残っている場合は閉じて引き継ぐ
+                self.engine.close_connection(previous)
+            state = self.resume.claim(token)
+        if state is None:
+            if isinstance(token, str) and self.resume.foreign(token):
+                # クラスタモードで別のワーカーに振り分けられた: 再開の状態はそのワーカーにしかない
+                self.resume_counter.inc(label_value="foreign")
+                self.send_to_client(conn, FRAME_SYSTEM, "再接続先のサーバープロセスが切断前と異なるため、"
+                                                        "切断中の発言は再送できません。直近の履歴を表示します。")
+                room_name = request.get("room")
+                self.enter(conn, username, room_name if isinstance(room_name, str) else None)
+                return
+            self.resume_counter.inc(label_value="expired")
+            self.enter(conn, username)
+            return
+        conn.client_seq = state.client_seq
+        self.enter(conn, state.username, state.room_name, token, seq if epoch == self.replay.epoch else None)
+
+    def enter(self, conn, username, room_name=None, token=None, resume_seq=None):
+        """ユーザー名を確定してルームに入れる（HELLO と再開要求の共通処理）
+
+        token は再開するセッションのトークン (None なら新しく発行する)。resume_seq はクライアントが
+        最後に受け取った通し番号で、その後の配信を再送する。None の場合や再送で埋められない場合は、
+        代わりにルームの直近の履歴を送る。
+        """
+        client_address = conn.address
+        if not username or username.upper() == "SERVER" or username.upper() == "SYSTEM":
+            username = f"User{client_address[1]}"
+            self.send_to_client(conn, FRAME_SYSTEM, f"ユーザー名が無効だったため、'{username}' に設定されました。")
+
+        if self.cluster:
+            # クラスタモードでは他のワーカーと重複しないよう、名前をブローカーで予約してから入室する
+            self.entering[conn] = []
+            self.cluster.claim_username(username, lambda granted: self.finish_enter(
+                conn, username, room_name, token, resume_seq, granted))
+            return
+        self.finish_enter(conn, username, room_name, token, resume_seq)
+
+    def finish_enter(self, conn, original_username, room_name, token, resume_seq, granted=None):
+        """ユーザー名を登録してルームに入れる（イベントループのスレッド）
+
+        granted はクラスタモードでブローカーが予約した名前。None の場合はこのワーカー内で重複を確認する
+        （ブローカーとの接続が切れている場合は他のワーカーのユーザーが分からないため、ワーカーをまたいだ重複は防げない）。
+        """
+        pending = self.entering.pop(conn, None)
+        if conn.closed or not self.engine:
+            if granted is not None and self.cluster:
+                self.cluster.publish_presence(granted, None)  # 予約を解放する
+            return
+        client_address = conn.address
+
+        # ユーザー名重複チェック（重複時は連番を付けて登録される）
+        if granted is not None:
+            username = self.engine.sessions.claim_username(conn, granted)
+            if username != granted:
+                # このワーカー内で使用中だったため別の名前になった: ブローカーの予約を解放する
+                self.cluster.publish_presence(granted, None)
+        else:
+            username = self.engine.sessions.claim_username(conn, original_username)
+        if original_username != username:
+            self.send_to_client(conn, FRAME_SYSTEM, f"ユーザー名 '{original_username}' は既に使用中のため、'{username}' に変更されました。")
+
+        # 接続直後は既定のルームに入る（再開時は切断前のルームに戻す）
+        room = None
+        if room_name is not None:
+            try:
+                room, _ = self.rooms.join(conn, room_name)
+            except RoomError:
+                pass
+        if room is None:
+            room, _ = self.rooms.join(conn, self.rooms.default.name)
+        resumed = token is not None
+        # 再送するフレームはルームに入ったのと同時に切り出す（ブローカーの応答を待つ間の配信も含める）
+        replay = None
+        if resume_seq is not None and room.name == room_name:
+            replay = self.replay.since(resume_seq, room_name, original_username)
+        if resumed:
+            self.resume_counter.inc(label_value="resumed" if replay is not None else "history")
+        token = self.resume.attach(conn, token)
+        if self.cluster:
+            self.cluster.publish_presence(username, room.name)
+        self.send_to_client(conn, FRAME_SESSION, json.dumps({
+            "username": username, "room": room.name, "epoch": self.replay.epoch, "token": token,
+            "ack": conn.client_seq, "resumed": resumed, "heartbeat": self.heartbeat_interval,
+        }, ensure_ascii=False))
+        if replay is not None:
+            for frame in replay:
+                self.engine.send(conn, frame)
+            self.resent_frames.inc(len(replay))
+        else:
+            self.send_history_replay(conn, room)
+        if resumed:
+            self.log_message(f"{username} ({client_address[0]}:{client_address[1]}) が再接続しました "
+                             f"(ルーム {room.name}, 再送 {len(replay) if replay is not None else '-'}件)。")
+            self.broadcast_message(FRAME_SYSTEM, f"{username} さんが再接続しました。", None, room)
+        else:
+            self.log_message(f"{username} ({client_address[0]}:{client_address[1]}) が接続しました。")
+            self.broadcast_message(FRAME_SYSTEM, f"{username} さんが入室しました。", None, room)
+        for frame_type, payload in pending or ():
+            self.on_frame(conn, frame_type, payload)
+
+    def handle_client_message(self, client_socket, message_str):
+        """クライアントから受信した1メッセージ（チャットまたはコマンド）を処理"""
+        username = client_socket.username
+
+        if message_str.startswith("/w ") or message_str.startswith("/msg "):
+            parts = message_str.split(" ", 2)
+            if len(parts) < 3:
+                self.send_to_client(client_socket, FRAME_SYSTEM, "個人メッセージの形式が正しくありません。例: /w ユーザー名 メッセージ")
+                return
+            self.command_counter.inc(label_value="pm")
+            recipient_username = parts[1]
+            pm_content = parts[2]
+            self.handle_private_message(client_socket, recipient_username, pm_content)
+        elif message_str.strip().lower() == "/users":
+            self.command_counter.inc(label_value="users")
+            self.send_user_list(client_socket)
+        elif message_str.strip().lower() == "/stats":
+            self.command_counter.inc(label_value="stats")
+            self.send_stats(client_socket)
+        elif message_str.startswith("/join "):
+            self.command_counter.inc(label_value="join")
+            self.handle_join(client_socket, message_str.split(" ", 1)[1].strip())
+        elif message_str.strip().lower() == "/leave":
+            self.command_counter.inc(label_value="leave")
+            self.handle_join(client_socket, self.rooms.default.name)
+        elif message_str.strip().lower() == "/rooms":
+            self.command_counter.inc(label_value="rooms")
+            self.send_room_list(client_socket)
+        elif message_str.startswith("/search "):
+            self.command_counter.inc(label_value="search")
+            self.handle_search(client_socket, message_str.split(" ", 1)[1])
+        elif message_str.strip().lower() == "/history" or message_str.startswith("/history "):
+            self.command_counter.inc(label_value="history")
+            self.handle_history(client_socket, message_str[len("/history"):].strip())
+        elif message_str.strip().lower() == "/more":
+            self.command_counter.inc(label_value="more")
+            self.handle_more(client_socket)
+        elif message_str.startswith("/ask_gemini "): 
+            self.command_counter.inc(label_value="ask_gemini")
+            if not self.gemini_enabled or not self.llm:
+                self.send_to_client(client_socket, FRAME_SYSTEM, "Geminiが現在利用できません。")
+                self.log_message(f"User {username} tried to ask Gemini, but it's not enabled/initialized.", "WARN")
+                return
+            question = message_str.split(" ", 1)[1]
+            self.trigger_ask_gemini(client_socket, username, question)
+        elif message_str.startswith("/positive_transform "): # 新しいコマンドの処理
+            self.command_counter.inc(label_value="positive_transform")
+            if not self.gemini_enabled or not self.llm:
+                self.send_to_client(client_socket, FRAME_SYSTEM, "AI変換機能が現在利用できません。")
+                self.log_message(f"User {username} tried to use AI positive transform, but Gemini is not enabled/initialized.", "WARN")
+                return
+            original_message = message_str.split(" ", 1)[1]
+            self.trigger_positive_transform(client_socket, username, original_message)
+        elif message_str.strip().lower() == "/summarize_gemini":
+            self.command_counter.inc(label_value="summarize_gemini")
+            self.trigger_gemini_summary(client_socket, username)
+        else:
+            self.command_counter.inc(label_value="chat")
+            full_message = f"{username}: {message_str}"
+            self.log_message(f"受信 ({username}): {message_str}")
+            self.broadcast_message(FRAME_CHAT, full_message, client_socket, client_socket.room)
+
+    def send_to_client(self, client_socket, frame_type, message_string):
+        try:
+            self.engine.send(client_socket, encode_frame(frame_type, message_string))
+        except Exception as e:
+            self.log_message(f"特定クライアントへの送信エラー: {e}", "ERROR")
+
+    def trigger_gemini_summary(self, client_socket, username):
+        if not self.gemini_enabled or not self.llm:
+            self.send_to_client(client_socket, FRAME_SYSTEM, "Gemini APIが利用できないため、要約を生成できません。")
+            self.log_message(f"ユーザー {username} のGemini要約リクエスト失敗: API未設定", "WARN")
+            return
+
+        # 要約の対象は依頼者がいるルームの会話
+        room = client_socket.room
+        if not len(room.history):
+            self.send_to_client(client_socket, FRAME_SYSTEM, "要約対象のチャット履歴がありません。")
+            self.log_message(f"ユーザー {username} のGemini要約リクエスト失敗: 履歴なし", "INFO")
+            return
+
+        # 前回の要約以降に新しい発言がなければ、保持している要約をそのまま返す
+        if room.summarizer.is_current(room.history):
+            self.send_summary(client_socket, room.summarizer.summary)
+            self.log_message(f"ユーザー {username} のGemini要約リクエスト: 保持している要約を返しました", "INFO")
+            return
+
+        # API呼び出しはワーカーで実行する（要約は対話的な変換より後回し）
+        if not self.submit_ai_job([client_socket], self.execute_gemini_summary, client_socket, username, room,
+                                  priority=PRIORITY_BACKGROUND, timeout=DEFAULT_JOB_TIMEOUT * 4, name="summary"):
+            return
+        self.send_to_client(client_socket, FRAME_SYSTEM, "Gemini APIによる要約を生成中です。少々お待ちください...")
+        self.log_message(f"ユーザー {username} からGemini要約リクエストを受信。処理を開始します。", "INFO")
+
+    def execute_gemini_summary(self, client_socket, username, room):
+        """ルームの要約を更新して依頼者に送る（ワーカースレッド）"""
+        try:
+            summary, from_cache = room.summarizer.summarize(room.history, self.llm.generate)
+        except Exception as e:
+            self.send_to_client(client_socket, FRAME_SYSTEM, "要約の生成中にエラーが発生しました。")
+            self.log_message(f"Gemini要約 APIエラー (依頼者 {username}): {e}", "ERROR")
+            return
+        if not from_cache:
+            self.summary_updates.inc()
+        self.send_summary(client_socket, summary)
+        self.log_message(f"ユーザー {username} にGemini要約を送信しました ({'保持している要約' if from_cache else '更新'})", "INFO")
+
+    def send_summary(self, client_socket, summary):
+        self.send_to_client(client_socket, FRAME_SYSTEM, f"チャットの要約:\n{summary}")
+
+    def submit_ai_job(self, requesters, func, *args, priority=PRIORITY_INTERACTIVE,
+                      timeout=DEFAULT_JOB_TIMEOUT, name=""):
+        """AIジョブをワーカーに投入する。混雑で受け付けられない場合は依頼者全員に通知して False を返す"""
+        names = ", ".join(str(conn.username) for conn in requesters)
+
+        def on_expired():
+            for conn in requesters:
+                self.send_to_client(conn, FRAME_SYSTEM, "AIリクエストが混み合っているため、時間内に処理できませんでした。")
+            self.log_message(f"AIジョブ期限切れ ({names}, {name})", "WARN")
+
+        if self.ai_jobs.submit(func, *args, priority=priority, timeout=timeout, on_expired=on_expired, name=name):
+            return True
+        depth = self.ai_jobs.queue_depth()
+        for conn in requesters:
+            self.send_to_client(conn, FRAME_SYSTEM, f"AIリクエストが混み合っています（待ち {depth} 件）。しばらくしてから再度お試しください。")
+        self.log_message(f"AIジョブ受付拒否 ({names}, {name}): キュー待ち {depth} 件", "WARN")
+        return False
+
+
+    def handle_private_message(self, sender_socket, recipient_username, message_content):
+        sender_username = sender_socket.username
+        
+        r_socket = self.engine.sessions.get(recipient_username)
+        if r_socket is None and self.cluster and recipient_username in self.cluster.remote_users:
+            # 他のワーカーに接続しているユーザー宛て
+            self.cluster.publish_deliver(recipient_username,
+                                         encode_frame(FRAME_PRIVATE, f"(個人 from {sender_username}): {message_content}"))
+            self.send_to_client(sender_socket, FRAME_PRIVATE, f"(個人 to {recipient_username}): {message_content}")
+            self.log_message(f"PM ({sender_username} -> {recipient_username}, 他のワーカー): {message_content}", "INFO")
+        elif r_socket is None:
+            self.send_to_client(sender_socket, FRAME_SYSTEM, f"ユーザー '{recipient_username}' は見つかりません。")
+            self.log_message(f"PM失敗 ({sender_username} -> {recipient_username}): 宛先不明", "WARN")
+        elif r_socket is sender_socket: # 自分自身へのPM
+            self.send_to_client(sender_socket, FRAME_SYSTEM, "自分自身に個人メッセージは送信できません。")
+            self.log_message(f"PM試行 ({sender_username} -> {recipient_username}): 自分自身", "INFO")
+        else:
+            self.send_to_client(r_socket, FRAME_PRIVATE, f"(個人 from {sender_username}): {message_content}")
+            self.send_to_client(sender_socket, FRAME_PRIVATE, f"(個人 to {recipient_username}): {message_content}")
+            self.log_message(f"PM ({sender_username} -> {recipient_username}): {message_content}", "INFO")
+
+    def send_user_list(self, client_socket):
+        usernames = self.engine.sessions.usernames()
+        if self.cluster:
+            usernames += sorted(self.cluster.remote_users)
+        if not usernames:
+            user_list_str = "現在接続中のユーザーはいません。"
+        else:
+            user_list_str = "接続中のユーザー: " + ", ".join(usernames)
+        
+        self.send_to_client(client_socket, FRAME_SYSTEM, user_list_str)
+        self.log_message(f"ユーザーリスト要求を処理 ({client_socket.username})", "INFO")
+
+    def handle_join(self, conn, name):
+        """/join ルーム名: 指定のルームに移動する（なければ作成）。/leave は既定のルームへの移動"""
+        if conn.room is not None and conn.room.name == name:
+            self.send_to_client(conn, FRAME_SYSTEM, f"既にルーム「{name}」にいます。")
+            return
+        try:
+            room, previous = self.rooms.join(conn, name)
+        except RoomError as e:
+            self.send_to_client(conn, FRAME_SYSTEM, str(e))
+            return
+        if self.cluster:
+            self.cluster.publish_presence(conn.username, room.name)
+        if previous is not None:
+            self.broadcast_message(FRAME_SYSTEM, f"{conn.username} さんがルーム「{room.name}」に移動しました。", None, previous)
+        self.broadcast_message(FRAME_SYSTEM, f"{conn.username} さんがルームに参加しました。", conn, room)
+        self.send_history_replay(conn, room)
+        self.send_to_client(conn, FRAME_SYSTEM, f"ルーム「{room.name}」に参加しました（{len(room)}人）。")
+        self.log_message(f"{conn.username} がルームを移動しました ({previous.name if previous is not None else '-'} -> {room.name})", "INFO")
+
+    def send_history_replay(self, conn, room):
+        """入室した conn に room の直近の履歴を1フレームで送る
+
+        エンコード（と圧縮）した結果は履歴が増えるまでルームに保持し、続けて入室した接続にはそのまま送る。
+        """
+        if not self.join_backlog:
+            return
+        total = room.history.total
+        cached = room.replay_frame
+        if cached is None or cached[0] != total:
+            lines = room.history.tail(self.join_backlog)
+            if not lines:
+                return
+            cached = room.replay_frame = (total, encode_history_frame(room.name, lines, self.history_compress))
+        self.history_replays.inc()
+        self.engine.send(conn, cached[1])
+
+    def send_room_list(self, client_socket):
+        counts = {room.name: len(room) for room in self.rooms}
+        if self.cluster:
+            for _, room_name in self.cluster.remote_users.values():
+                counts[room_name] = counts.get(room_name, 0) + 1
+        rooms = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+        room_list_str = "ルーム一覧: " + ", ".join(f"{name} ({count}人)" for name, count in rooms[:50])
+        if len(rooms) > 50:
+            room_list_str += f" ほか{len(rooms) - 50}ルーム"
+        room_list_str += f"\n現在のルーム: {client_socket.room.name}"
+        self.send_to_client(client_socket, FRAME_SYSTEM, room_list_str)
+        self.log_message(f"ルーム一覧の要求を処理 ({client_socket.username})", "INFO")
+
+
+    def handle_search(self, conn, text):
+        """/search 語 [from:名前]: 今いるルームの発言を新しい順に検索する（続きは /more）"""
+        terms, sender = parse_search(text)
+        if not terms and sender is None:
+            self.send_to_client(conn, FRAME_SYSTEM, "検索語を指定してください。例: /search 会議 from:ユーザー名")
+            return
+        self.query_store(conn, PageCursor(KIND_SEARCH, conn.room.name, terms, sender))
+
+    def handle_history(self, conn, arg):
+        """/history [件数|時刻]: 今いるルームの直近の発言、または指定の時刻以降の発言を表示する（続きは /more）"""
+        if not arg:
+            cursor = PageCursor(KIND_RECENT, conn.room.name, remaining=PAGE_SIZE)
+        elif arg.isascii() and arg.isdecimal():
+            cursor = PageCursor(KIND_RECENT, conn.room.name, remaining=max(1, min(int(arg), MAX_HISTORY_ROWS)))
+        else:
+            since = parse_since(arg)
+            if since is None:
+                self.send_to_client(conn, FRAME_SYSTEM, "時刻の形式が正しくありません。"
+                                                        "例: /history 50、/history 30m、/history 09:00、/history 2024-05-01")
+                return
+            cursor = PageCursor(KIND_SINCE, conn.room.name, position=(since, 0))
+        self.query_store(conn, cursor)
+
+    def handle_more(self, conn):
+        cursor = conn.page_cursor
+        if cursor is None:
+            self.send_to_client(conn, FRAME_SYSTEM, "続きはありません。")
+            return
+        self.query_store(conn, cursor, continued=True)
+
+    def query_store(self, conn, cursor, continued=False):
+        """メッセージストアに問い合わせ、1ページ分の結果を conn に送る（検索はストアのスレッドで行う）"""
+        store = self.store
+        if store is None:
+            self.send_to_client(conn, FRAME_SYSTEM, "メッセージストアが無効のため、/search・/history は利用できません。")
+            return
+        conn.page_cursor = None
+        self.store_queries.inc(label_value=cursor.kind)
+
+        def on_result(rows, next_cursor, error):
+            # ストアのスレッドから呼ばれるため、接続の状態はイベントループのスレッドで更新する
+            engine = self.engine
+            if engine:
+                engine.call_soon(self.send_store_result, conn, cursor, rows, next_cursor, error, continued)
+
+        store.query(cursor, on_result)
+
+    def send_store_result(self, conn, cursor, rows, next_cursor, error, continued):
+        """問い合わせの結果を conn に送る（イベントループのスレッド）
+
+        問い合わせはストアのスレッドで受け付けた順に実行され、結果もその順にここへ届くため、
+        続けて問い合わせた場合も最後の問い合わせの続きが page_cursor に残る。
+        """
+        if conn.closed:
+            return
+        if error is not None:
+            self.send_to_client(conn, FRAME_SYSTEM, "検索中にエラーが発生しました。")
+            return
+        conn.page_cursor = next_cursor
+        self.send_to_client(conn, FRAME_SYSTEM, self.format_store_result(cursor, rows, next_cursor, continued))
+
+    @staticmethod
+    def format_store_result(cursor, rows, next_cursor, continued):
+        if cursor.kind == KIND_SEARCH:
+            condition = " ".join(cursor.terms + ((f"from:{cursor.sender}",) if cursor.sender else ()))
+            title = f"「{condition}」の検索結果"
+        else:
+            title = "履歴"
+        if not rows:
+            return f"{title} (ルーム {cursor.room}): " + ("これ以上ありません。" if continued else "見つかりませんでした。")
+        lines = [f"{title} (ルーム {cursor.room}, {len(rows)}件):"]
+        lines.extend(row.format() for row in rows)
+        if next_cursor is not None:
+            lines.append("続きは /more で表示します。")
+        return "\n".join(lines)
+
+    def send_stats(self, client_socket):
+        """/stats: サーバーの統計を依頼者に送る"""
+        if not self.public_stats and client_socket.address[0] not in ("127.0.0.1", "::1"):
+            self.send_to_client(client_socket, FRAME_SYSTEM, "/stats はサーバーと同じマシンからのみ利用できます。")
+            return
+        metrics = self.metrics
+
+        def rate(name):
+            value = metrics.rate(name)
+            return "-" if value is None else f"{value:.1f}"
+
+        def latency(histogram, label_value=None):
+            count = histogram.count(label_value)
+            if not count:
+                return "記録なし"
+            parts = []
+            for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99)):
+                value = histogram.quantile(fraction, label_value)
+                if value == float("inf"):
+                    parts.append(f"{name} >{histogram.buckets[-1]:g}秒")
+                else:
+                    parts.append(f"{name} ≦{value * 1000:g}ms")
+            return " / ".join(parts) + f" ({count}回)"
+
+        send_calls = metrics.value('chat_send_syscalls_total')
+        frames_per_call = f"{metrics.value('chat_frames_sent_total') / send_calls:.1f}" if send_calls else "-"
+        commands = self.command_counter.values()
+        command_text = ", ".join(f"{name}={count}" for name, count in sorted(commands.items())) or "なし"
+        fds = open_fd_count()
+        lines = [
+            "サーバー統計:",
+            f"接続: {metrics.value('chat_connections')} (ユーザー {metrics.value('chat_users')}, ルーム {len(self.rooms)})",
+            f"受信: {rate('chat_frames_received_total')} 件/秒 (累計 {metrics.value('chat_frames_received_total')} 件, "
+            f"{metrics.value('chat_bytes_received_total')} バイト)",
+            f"送信: {rate('chat_frames_sent_total')} 件/秒 (累計 {metrics.value('chat_frames_sent_total')} 件, "
+            f"{metrics.value('chat_bytes_sent_total')} バイト, 破棄 {metrics.value('chat_frames_dropped_total')} 件)",
+            f"送信のシステムコール: {rate('chat_send_syscalls_total')} 回/秒 (1回あたり {frames_per_call} フレーム)",
+            f"応答のない接続の切断: 無受信 {self.engine.reaped[REAP_IDLE]} / 送信停滞 {self.engine.reaped[REAP_WRITE]} "
+            f"(ハートビート送信 {self.engine.heartbeats_sent} 回)",
+            f"ブロードキャスト所要時間: {latency(self.fanout_histogram)}",
+            f"コマンド: {command_text}",
+            f"AIジョブ: 待ち {self.ai_jobs.queue_depth()} / 実行中 {self.ai_jobs.active_jobs} / 完了 {self.ai_jobs.completed_jobs}"
+            f" / 期限切れ {self.ai_jobs.expired_jobs} / 拒否 {self.ai_jobs.rejected_jobs}",
+        ]
+        for label_value in sorted(self.llm_latency.label_values()):
+            lines.append(f"LLM ({label_value}): {latency(self.llm_latency, label_value)}"
+                         f", エラー {self.llm_errors.values().get(label_value, 0)}")
+        limiter = self.rate_limiter
+        lines.append("送信レート制限: " + ", ".join(
+            f"{category} 遅延 {limiter.delayed[category]} / 破棄 {limiter.dropped[category]} / 切断 {limiter.disconnected[category]}"
+            for category in CATEGORIES))
+        resumes = self.resume_counter.values()
+        lines.append(f"再接続: 再開 {resumes.get('resumed', 0)} / 履歴で代替 {resumes.get('history', 0)} / "
+                     f"期限切れ {resumes.get('expired', 0)} / 別のワーカー {resumes.get('foreign', 0)}, 再送 {self.resent_frames.total()}フレーム, "
+                     f"重複を破棄 {self.duplicate_messages.total()}件")
+        if self.store:
+            queries = self.store_queries.values()
+            lines.append(f"メッセージストア: 書き込み {self.store.written}件 ({self.store.batches}回), "
+                         f"待ち {self.store.pending()}件, 破棄 {self.store.dropped}件, "
+                         f"問い合わせ 検索 {queries.get(KIND_SEARCH, 0)} / 履歴 "
+                         f"{queries.get(KIND_RECENT, 0) + queries.get(KIND_SINCE, 0)}")
+        lines.append(f"変換キャッシュ: ヒット率 {self.transform_cache.hit_rate() * 100:.1f}% "
+                     f"({self.transform_cache.hits + self.transform_cache.misses}回中), {len(self.transform_cache)}件")
+        if self.cluster:
+            lines.append(f"クラスタ: ワーカー {self.worker_id}, 他のワーカーのユーザー {len(self.cluster.remote_users)}人, "
+                         f"中継 送信 {self.cluster.frames_sent} / 受信 {self.cluster.frames_received}")
+        lines.append(f"スレッド: {thread_count()} / FD: {fds if fds is not None else '-'}")
+        self.send_to_client(client_socket, FRAME_SYSTEM, "\n".join(lines))
+        self.log_message(f"統計情報の要求を処理 ({client_socket.username})", "INFO")
+
+    def broadcast_message(self, frame_type, message_string, sender_socket, room=None):
+        """room のメンバーに送信する（room が None の場合は全接続。履歴には残らない）"""
+        if not self.engine:
+            return
+        # AIポジティブ応答とユーザーの発言をルームの履歴に含める
+        history_line = None
+        if room is not None:
+            if frame_type == FRAME_AI_POSITIVE: # AIポジティブ応答の履歴追加
+                history_line = message_string.strip()
+                if self.logger.enabled("DEBUG"):
+                    self.log_message(f"履歴追加 (AI Positive, {room.name}): {history_line}", "DEBUG")
+            elif sender_socket is not None and frame_type == FRAME_CHAT:
+                history_line = message_string
+        self.publish(encode_frame(frame_type, message_string), room, history_line, exclude=sender_socket)
+
+    def publish(self, frame, room, history_line=None, exclude=None):
+        """room のメンバー（None は全接続）にフレームを配信し、history_line をルームの履歴に追加する
+
+        ルームへの配信には通し番号を付け、再接続時の再送用に残す。クラスタモードでは他のワーカーにも
+        中継する。どのスレッドからでも呼べる（通し番号の順序を保つため、イベントループのスレッドに移してから処理する）。
+        """
+        engine, cluster = self.engine, self.cluster
+        if not engine:
+            return
+        if not engine.in_loop_thread():
+            engine.call_soon(self.publish, frame, room, history_line, exclude)
+            return
+        if room is None:
+            engine.broadcast(frame, exclude=exclude)
+        else:
+            sender = exclude.username if exclude is not None else None
+            if history_line is not None:
+                room.history.append(history_line)
+                # 他のワーカーと同じストアを共有するため、書くのは発言を受けたワーカーだけ
+                if self.store:
+                    self.store.append(room.name, sender, history_line)
+            engine.broadcast(self.replay.stamp(room.name, frame, sender), exclude=exclude, members=room.members)
+        if cluster:
+            cluster.publish_broadcast(room.name if room is not None else None, history_line, frame)
+
+    def on_cluster_broadcast(self, room_name, history_line, frame):
+        """他のワーカーからの配信を、このワーカーにいるメンバーに届ける（イベントループのスレッド）"""
+        if not self.engine:
+            return
+        if room_name is None:
+            self.engine.broadcast(frame)
+            return
+        room = self.rooms.get(room_name)
+        if room is None:
+            return  # このワーカーにはそのルームのメンバーがいない（履歴も持たない）
+        if history_line is not None:
+            room.history.append(history_line)
+        self.engine.broadcast(self.replay.stamp(room.name, frame), members=room.members)
+
+    def on_cluster_deliver(self, username, frame):
+        """他のワーカーからの個人メッセージを宛先に届ける（イベントループのスレッド）"""
+        conn = self.engine.sessions.get(username) if self.engine else None
+        if conn is not None:
+            self.engine.send(conn, frame)
+
+    def trigger_ask_gemini(self, client_socket, username, question):
+        if not self.gemini_enabled or not self.llm:
+            self.send_to_client(client_socket, FRAME_SYSTEM, "Gemini APIが現在利用できません。")
+            self.log_message(f"ユーザー {username} のGemini質問リクエスト失敗: Gemini無効またはモデル未初期化", "WARN")
+            return
+
+        self.log_message(f"ユーザー {username} からGeminiへの質問「{question}」を受信。処理を開始します。", "INFO")
+
+        # API呼び出しはワーカーで実行する
+        self.submit_ai_job([client_socket], self.execute_ask_gemini_stream, client_socket, username, question,
+                           client_socket.room, name="ask")
+
+    def execute_ask_gemini_stream(self, client_socket, username, question, room):
+        """Geminiの応答を生成されたそばからルームの全員に逐次送信する（ワーカースレッド）
+
+        クライアントは同じストリームIDのフレームを1つのバブルに追記していくため、
+        利用者が待つのは生成全体ではなく最初の断片が届くまでになる。
+        """
+        engine = self.engine
+        if not engine:
+            return
+        stream_id = next(self._stream_ids)
+        self.publish(encode_stream_frame(stream_id, STREAM_START, f"Gemini ({username}さんの質問: {question})"), room)
+
+        prompt = f"""あなたはチャットに参加しているアシスタントです。次の質問に日本語で簡潔に答えてください。
+
+質問者: {username}
+質問: {question}
+"""
+        chunks = []
+        try:
+            self.log_message(f"Geminiに質問を送信中 ({username}): {question[:30]}...", "DEBUG")
+            for text in self.llm.stream(prompt):
+                if not text:
+                    continue
+                chunks.append(text)
+                self.publish(encode_stream_frame(stream_id, STREAM_CHUNK, text), room)
+        except Exception as e:
+            self.publish(encode_stream_frame(stream_id, STREAM_ERROR, "応答の生成中にエラーが発生しました。"), room)
+            self.log_message(f"Gemini質問 APIエラー (依頼者 {username}): {e}", "ERROR")
+            return
+
+        answer = "".join(chunks).strip()
+        engine.call_soon(self.finish_ai_stream, stream_id, answer, room)
+        self.log_message(f"Geminiの応答を送信しました ({username}の質問「{question[:30]}...」に対して, {len(chunks)}チャンク)", "INFO")
+
+    def finish_ai_stream(self, stream_id, answer, room):
+        """逐次応答の終了を通知し、応答全体をルームの履歴に追加する（イベントループのスレッド）"""
+        self.publish(encode_stream_frame(stream_id, STREAM_END), room, f"Gemini: {answer}" if answer else None)
+
+    def trigger_positive_transform(self, client_socket, username, original_message):
+        if not self.gemini_enabled or not self.llm: # Gemini APIを流用
+            self.send_to_client(client_socket, FRAME_SYSTEM, "AI変換機能が現在利用できません。")
+            self.log_message(f"ユーザー {username} のAIポジティブ変換リクエスト失敗: Gemini無効またはモデル未初期化", "WARN")
+            return
+
+        # 文脈と変換結果の配信先は依頼者がいるルーム
+        room = client_socket.room
+        # 同じ発言の変換結果がキャッシュにあれば、Geminiを呼ばずにそのまま返す
+        cache_key = self.transform_cache.make_key(original_message, self.transform_context_fingerprint(room))
+        cached_text = self.transform_cache.get(cache_key)
+        if cached_text is not None:
+            if self.logger.enabled("DEBUG"):
+                self.log_message(f"AIポジティブ変換キャッシュヒット ({username}): {original_message[:30]}", "DEBUG")
+            self.broadcast_ai_response_message(FRAME_AI_POSITIVE, f"{username} : {cached_text}", room)
+            return
+
+        self.log_message(f"ユーザー {username} からAIポジティブ変換リクエスト「{original_message}」を受信。処理を開始します。", "INFO")
+        # API呼び出しはワーカーで実行する（バッチ有効時は短時間溜めてからまとめて投入）
+        if self.transform_batcher:
+            self.transform_batcher.add(PendingTransform(client_socket, username, original_message, cache_key, room))
+        else:
+            self.submit_ai_job([client_socket], self.execute_positive_transform, client_socket, username,
+                               original_message, cache_key, room, name="positive")
+
+    def submit_transform_batch(self, items):
+        """バッチャーからの通知: 溜まった変換リクエストをルームごとに1つのAIジョブとして投入する"""
+        # 文脈（直近の履歴）と配信先がルームごとに違うため、ルームをまたいではまとめない
+        by_room = {}
+        for item in items:
+            by_room.setdefault(item.room, []).append(item)
+        for room_items in by_room.values():
+            requesters = [item.client_socket for item in room_items]
+            self.submit_ai_job(requesters, self.execute_positive_transform_batch, room_items,
+                               name=f"positive_batch({len(room_items)})")
+
+    def transform_context_fingerprint(self, room):
+        """変換結果のキャッシュキーに含める文脈（モデル、プロンプトの版、ルームの直近の履歴）"""
+        context_lines = room.history.tail(self.cache_context_lines) if self.cache_context_lines > 0 else []
+        return context_fingerprint(self.gemini_model_name, POSITIVE_PROMPT_VERSION, *context_lines)
+
+    def execute_positive_transform(self, client_socket, username, original_message, cache_key, room):
+        try:
+            # 依頼者がいるルームのチャット履歴を取得して文脈情報として使用
+            context_history = self.positive_transform_context(room)
+            
+            prompt = f"""あなたは、送信者{username}の発言を変換し、どんな悪口やネガティブな表現でも非常にポジティブな言い回しに変換するAIです。自然で簡潔な応答をしてください。
+。絵文字は使用しないでください。
+
+過去のチャット履歴（文脈参考用）:
+{context_history}
+
+変換対象のメッセージ送信者: {username}←ここを変更する
+変換前のメッセージ:
+「{original_message}」←ここを変更する【重要】
+
+上記の履歴と文脈を踏まえて、変換後のメッセージだけを、チャットでそのまま送信できる形で出力してください。「」で囲む必要はありません。
+ポジティブな表現にする上で表現方法は変わる可能性がありますが、元々のメッセージの内容は変えず表現方法を
+変えるだけにしてください。例えば、悪口やネガティブな表現をポジティブな表現に変換することが求められます。
+会話の流れに合わせて、より適切で自然なポジティブ表現にしてください。
+
+例：
+変換前：「うるさい」
+変換後：「盛り上げてくれてありがとう」
+"""
+            
+            self.log_message(f"GeminiにAIポジティブ変換を送信中 ({username}): {original_message[:30]}...", "DEBUG")
+            transformed_message_text = self.llm.generate(prompt).strip()
+            self.publish_positive_transform(username, original_message, transformed_message_text, cache_key, room)
+
+        except Exception as e:
+            error_message = f"AIポジティブ変換 APIエラー (依頼者 {username}): {e}"
+            self.log_message(error_message, "ERROR")
+            self.notify_transform_failure(client_socket)
+
+    def execute_positive_transform_batch(self, items):
+        """複数の変換リクエストを1回のAPI呼び出しで変換する（ワーカースレッド）"""
+        room = items[0].room  # submit_transform_batch でルームごとに分けてある
+        if len(items) == 1:
+            item = items[0]
+            self.execute_positive_transform(item.client_socket, item.username, item.original_message, item.cache_key,
+                                            room)
+            return
+
+        try:
+            prompt = build_batch_prompt(items, self.positive_transform_context(room))
+            self.log_message(f"GeminiにAIポジティブ変換をまとめて送信中 ({len(items)}件)", "DEBUG")
+            results = parse_batch_response(self.llm.generate(prompt), len(items))
+        except Exception as e:
+            self.log_message(f"AIポジティブ変換 APIエラー (バッチ {len(items)}件): {e}", "ERROR")
+            # API呼び出し自体の失敗は個別に送り直しても同じ結果になりやすいため、依頼者それぞれに通知する
+            for item in items:
+                self.notify_transform_failure(item.client_socket)
+            return
+
+        for index, item in enumerate(items, 1):
+            transformed_message_text = results.get(index)
+            if transformed_message_text is None:
+                # 応答から取り出せなかった分だけ個別に変換し直す
+                self.log_message(f"バッチ応答に {item.username} の変換結果がないため個別に変換します。", "WARN")
+                self.execute_positive_transform(item.client_socket, item.username, item.original_message,
+                                                item.cache_key, room)
+            else:
+                self.publish_positive_transform(item.username, item.original_message, transformed_message_text,
+                                                item.cache_key, room)
+
+    def notify_transform_failure(self, client_socket):
+        """変換に失敗したことを依頼者に知らせる（ワーカースレッド）"""
+        if not client_socket.closed:
+            self.send_to_client(client_socket, FRAME_SYSTEM, "AIポジティブ変換に失敗しました。しばらくしてからもう一度お試しください。")
+
+    def positive_transform_context(self, room):
+        """変換プロンプトに含めるルームの直近の履歴"""
+        history_snapshot = room.history.tail(10)
+        return "\n".join(history_snapshot) if history_snapshot else "（履歴なし）"
+
+    def publish_positive_transform(self, username, original_message, transformed_message_text, cache_key, room):
+        """変換結果をキャッシュに入れ、ルームの全員にブロードキャストする（ワーカースレッドから呼ぶ）"""
+        self.transform_cache.put(cache_key, transformed_message_text)
+
+        response_for_broadcast = f"{username} : {transformed_message_text}"
+        # 履歴とブロードキャストはイベントループのスレッドで処理する
+        engine = self.engine
+        if engine:
+            engine.call_soon(self.broadcast_ai_response_message, FRAME_AI_POSITIVE, response_for_broadcast, room)
+        self.log_message(f"AIポジティブ変換の応答をブロードキャスト準備 ({username}のメッセージ「{original_message[:30]}...」に対して)", "INFO")
+
+    def broadcast_ai_response_message(self, frame_type, message_text, room):
+        """AIからのメッセージ(Gemini応答、ポジティブ変換応答など)をルームにブロードキャストし、ログに記録する"""
+        self.broadcast_message(frame_type, message_text, None, room)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="チャットサーバー（ヘッドレス起動）")
+    parser.add_argument("--host", default="", help="待ち受けアドレス (既定: 全インターフェース)")
+    parser.add_argument("--port", type=int, default=50000, help="待ち受けポート (既定: 50000)")
+    parser.add_argument("--backlog", type=int, default=128, help="listen() のバックログ (既定: 128)")
+    parser.add_argument("--history-dir", default=DEFAULT_HISTORY_DIR,
+                        help=f"履歴ログの保存先ディレクトリ。空文字でメモリのみ (既定: {DEFAULT_HISTORY_DIR})")
+    parser.add_argument("--join-backlog", type=int, default=DEFAULT_JOIN_BACKLOG,
+                        help=f"入室時に送る直近の履歴の件数。0で送らない (既定: {DEFAULT_JOIN_BACKLOG})")
+    parser.add_argument("--history-compress", action=argparse.BooleanOptionalAction, default=True,
+                        help="入室時に送る履歴を zlib で圧縮する (既定: 有効)")
+    parser.add_argument("--message-store", default=DEFAULT_MESSAGE_STORE,
+                        help="/search・/history に使う SQLite のメッセージストア。--history-dir からの相対パス。"
+                             f"空文字で使わない (既定: {DEFAULT_MESSAGE_STORE})")
+    parser.add_argument("--resume-ttl", type=float, default=DEFAULT_RESUME_TTL,
+                        help=f"切断後に再接続での再開を受け付ける時間 [秒]。0で再開しない (既定: {DEFAULT_RESUME_TTL:g})")
+    parser.add_argument("--replay-frames", type=int, default=DEFAULT_REPLAY_FRAMES,
+                        help=f"再接続時の再送に備えて残す直近の配信の件数 (既定: {DEFAULT_REPLAY_FRAMES})")
+    parser.add_argument("--ai-workers", type=int, default=DEFAULT_AI_WORKERS,
+                        help=f"Gemini呼び出しを行うワーカースレッド数 (既定: {DEFAULT_AI_WORKERS})")
+    parser.add_argument("--ai-queue-size", type=int, default=DEFAULT_AI_QUEUE_SIZE,
+                        help=f"Gemini呼び出しの待ち行列の上限 (既定: {DEFAULT_AI_QUEUE_SIZE})")
+    parser.add_argument("--cache-size", type=int, default=DEFAULT_CACHE_SIZE,
+                        help=f"ポジティブ変換キャッシュの最大件数 (既定: {DEFAULT_CACHE_SIZE})")
+    parser.add_argument("--cache-ttl", type=float, default=DEFAULT_CACHE_TTL,
+                        help=f"ポジティブ変換キャッシュの有効期限 [秒] (既定: {DEFAULT_CACHE_TTL})")
+    parser.add_argument("--cache-file", default=None,
+                        help="ポジティブ変換キャッシュの保存先 (指定時は再起動後も引き継ぐ)")
+    parser.add_argument("--cache-context-lines", type=int, default=0,
+                        help="キャッシュキーに含める直近の履歴の行数 (既定: 0 = 文脈によらず共有)")
+    parser.add_argument("--batch-window", type=float, default=DEFAULT_BATCH_WINDOW * 1000,
+                        help=f"ポジティブ変換をまとめる時間窓 [ミリ秒]。0でバッチ化しない (既定: {DEFAULT_BATCH_WINDOW * 1000:g})")
+    parser.add_argument("--batch-max-items", type=int, default=DEFAULT_BATCH_MAX_ITEMS,
+                        help=f"1回のAPI呼び出しにまとめる最大件数 (既定: {DEFAULT_BATCH_MAX_ITEMS})")
+    parser.add_argument("--llm", default="gemini",
+                        help="LLMバックエンド: gemini / fake (プロセス内のスタンドイン) / http://ホスト:ポート (python chat_llm.py で起動したスタンドイン) (既定: gemini)")
+    add_fake_arguments(parser)
+    parser.add_argument("--max-queue-frames", type=int, default=DEFAULT_MAX_QUEUE_FRAMES,
+                        help=f"クライアントごとの送信キューの最大フレーム数 (既定: {DEFAULT_MAX_QUEUE_FRAMES})")
+    parser.add_argument("--max-queue-bytes", type=int, default=DEFAULT_MAX_QUEUE_BYTES,
+                        help=f"クライアントごとの送信キューの最大バイト数 (既定: {DEFAULT_MAX_QUEUE_BYTES})")
+    parser.add_argument("--slow-consumer-policy", choices=SLOW_CONSUMER_POLICIES, default=POLICY_DROP_OLDEST,
+                        help=f"送信キューが一杯になったときの動作 (既定: {POLICY_DROP_OLDEST})")
+    parser.add_argument("--flush-delay-ms", type=float, default=DEFAULT_MAX_FLUSH_DELAY * 1000,
+                        help="送信が集中しているときに、まとめて送るために送信を遅らせる最大時間 [ミリ秒]。"
+                             f"0で遅らせない (既定: {DEFAULT_MAX_FLUSH_DELAY * 1000:g})")
+    parser.add_argument("--tcp-nodelay", action=argparse.BooleanOptionalAction, default=True,
+                        help="クライアント接続に TCP_NODELAY を設定する (Nagle を無効にする) (既定: 有効)")
+    parser.add_argument("--heartbeat-interval", type=float, default=DEFAULT_HEARTBEAT_INTERVAL,
+                        help=f"ハートビート (PING) を送る間隔 [秒]。0で送らない (既定: {DEFAULT_HEARTBEAT_INTERVAL:g})")
+    parser.add_argument("--idle-timeout", type=float, default=DEFAULT_IDLE_TIMEOUT,
+                        help=f"何も受信しない接続を切断するまでの時間 [秒]。0で切断しない (既定: {DEFAULT_IDLE_TIMEOUT:g})")
+    parser.add_argument("--write-timeout", type=float, default=DEFAULT_WRITE_TIMEOUT,
+                        help=f"送信が進まない接続を切断するまでの時間 [秒]。0で切断しない (既定: {DEFAULT_WRITE_TIMEOUT:g})")
+    parser.add_argument("--log-level", choices=list(LEVELS), default=DEFAULT_LOG_LEVEL,
+                        help=f"出力するログの最低レベル (既定: {DEFAULT_LOG_LEVEL})")
+    parser.add_argument("--log-file", default=None, help="ログを追記するファイル（標準出力にも出力する）")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="Prometheus形式のメトリクスを http://127.0.0.1:ポート/metrics で公開する")
+    parser.add_argument("--public-stats", action="store_true",
+                        help="/stats コマンドをローカルホスト以外の接続にも許可する")
+    for category, label in (("chat", "発言と一般コマンド"), ("pm", "個人メッセージ"), ("ai", "AIコマンド")):
+        rate, burst = DEFAULT_LIMITS[category]
+        parser.add_argument(f"--{category}-rate", type=float, default=rate,
+                            help=f"1接続あたりの{label}の毎秒件数の上限。0で制限しない (既定: {rate:g})")
+        parser.add_argument(f"--{category}-burst", type=int, default=burst,
+                            help=f"1接続あたりの{label}の連続送信の上限 (既定: {burst})")
+    parser.add_argument("--flood-action", choices=FLOOD_ACTIONS, default=ACTION_DROP,
+                        help=f"送信レートの上限を超えたときの動作: {ACTION_DELAY} (遅らせる) / {ACTION_DROP} (破棄して通知) / "
+                             f"{ACTION_DISCONNECT} (切断) (既定: {ACTION_DROP})")
+    parser.add_argument("--ai-qps", type=float, default=0,
+                        help="LLM API呼び出し全体の毎秒件数の上限（APIのクォータに合わせる）。0で制限しない (既定: 0)")
+    parser.add_argument("--ai-qps-burst", type=int, default=1,
+                        help="LLM API呼び出しの連続実行の上限 (既定: 1)")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="ワーカープロセス数。2以上でクラスタモード（同じポートを SO_REUSEPORT で共有し、"
+                             "ブローカー経由で配信・在室情報を共有する。Linux等のみ） (既定: 1)")
+    parser.add_argument("--cluster-socket", default=None,
+                        help="クラスタのブローカーのUnixソケットのパス (既定: 一時ディレクトリの chat_cluster_ポート.sock)")
+    parser.add_argument("--worker-id", type=int, default=None, help=argparse.SUPPRESS)  # スーパーバイザーが指定する
+    args = parser.parse_args(argv)
+    if not (1 <= args.port <= 65535):
+        parser.error("ポート番号は1から65535の間で指定してください。")
+    if args.workers < 1:
+        parser.error("--workers は1以上を指定してください。")
+    for category in CATEGORIES:
+        if getattr(args, f"{category}_burst") < 1:
+            parser.error(f"--{category}-burst は1以上を指定してください。")
+    return args
+
+
+def worker_arguments(args, index, socket_path):
+    """クラスタモードのワーカー index 用の追加オプション（元のオプションより後に置いて上書きする）
+
+    ファイルやポートを使う設定はワーカーごとに分け、APIの呼び出し上限はワーカー数で割る。
+    """
+    extra = ["--workers", "1", "--cluster-socket", socket_path, "--worker-id", str(index)]
+    if args.history_dir:
+        extra += ["--history-dir", os.path.join(args.history_dir, f"worker-{index}")]
+        # メッセージストアは全ワーカーで1つのファイルを共有する (WALモードで並行して書ける)
+        if args.message_store:
+            extra += ["--message-store", os.path.abspath(os.path.join(args.history_dir, args.message_store))]
+    if args.cache_file:
+        extra += ["--cache-file", f"{args.cache_file}.{index}"]
+    if args.metrics_port:
+        extra += ["--metrics-port", str(args.metrics_port + index)]
+    if args.ai_qps > 0:
+        extra += ["--ai-qps", f"{args.ai_qps / args.workers:g}"]
+    return extra
+
+
+def run_cluster(args, argv):
+    """--workers N: ブローカーを起動し、同じポートで待ち受けるワーカープロセスを N 個起動して監視する"""
+    logger = LogPipeline(level=args.log_level, path=args.log_file)
+    if not cluster_supported():
+        logger.log("このプラットフォームではクラスタモード (--workers) を利用できません。", "ERROR")
+        logger.close()
+        return 1
+    socket_path = args.cluster_socket or default_socket_path(args.port)
+    broker = ClusterBroker(socket_path, log=logger.log)
+    try:
+        broker.start()
+    except OSError as e:
+        logger.log(f"クラスタのブローカーを起動できません ({socket_path}): {e}", "ERROR")
+        logger.close()
+        return 1
+
+    def spawn(index):
+        command = [sys.executable, os.path.abspath(__file__)] + list(argv) + worker_arguments(args, index, socket_path)
+        return subprocess.Popen(command), time.monotonic()
+
+    workers = [spawn(index) for index in range(args.workers)]
+    logger.log(f"クラスタモードで起動しました (ワーカー {args.workers}、ブローカー {socket_path})。")
+
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    exit_code = 0
+    while not stop_event.wait(1.0):
+        for index, (process, started) in enumerate(workers):
+            if process.poll() is None:
+                continue
+            if time.monotonic() - started < WORKER_MIN_UPTIME:
+                logger.log(f"ワーカー {index} が起動直後に終了しました (終了コード {process.returncode})。"
+                           f"クラスタを停止します。", "ERROR")
+                exit_code = 1
+                stop_event.set()
+                break
+            logger.log(f"ワーカー {index} が終了しました (終了コード {process.returncode})。再起動します。", "WARN")
+            workers[index] = spawn(index)
+
+    for process, _ in workers:
+        if process.poll() is None:
+            process.terminate()
+    for process, _ in workers:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    broker.stop()
+    logger.log("クラスタを停止しました。")
+    logger.close()
+    return exit_code
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    args = parse_args(argv)
+    if args.workers > 1:
+        return run_cluster(args, argv)
+    server = ChatServer(
+        host=args.host, port=args.port, backlog=args.backlog, log_level=args.log_level, log_file=args.log_file,
+        max_queue_frames=args.max_queue_frames, max_queue_bytes=args.max_queue_bytes,
+        slow_consumer_policy=args.slow_consumer_policy, history_dir=args.history_dir or None,
+        ai_workers=args.ai_workers, ai_queue_size=args.ai_queue_size,
+        cache_size=args.cache_size, cache_ttl=args.cache_ttl, cache_file=args.cache_file,
+        cache_context_lines=args.cache_context_lines,
+        batch_window=args.batch_window / 1000, batch_max_items=args.batch_max_items,
+        llm_backend=args.llm, llm_options=fake_options_from_args(args) if args.llm == "fake" else None,
+        metrics_port=args.metrics_port, public_stats=args.public_stats,
+        rate_limits={category: (getattr(args, f"{category}_rate"), getattr(args, f"{category}_burst"))
+                     for category in CATEGORIES},
+        flood_action=args.flood_action, ai_qps=args.ai_qps, ai_qps_burst=args.ai_qps_burst,
+        tcp_nodelay=args.tcp_nodelay, max_flush_delay=args.flush_delay_ms / 1000,
+        join_backlog=args.join_backlog, history_compress=args.history_compress,
+        replay_frames=args.replay_frames, resume_ttl=args.resume_ttl,
+        heartbeat_interval=args.heartbeat_interval, idle_timeout=args.idle_timeout, write_timeout=args.write_timeout,
+        message_store=args.message_store,
+        reuse_port=args.worker_id is not None, cluster_socket=args.cluster_socket if args.worker_id is not None else None,
+        worker_id=args.worker_id or 0,
+    )
+    try:
+        server.start()
+    except Exception:
+        server.logger.close()
+        return 1
+
+    # systemd からの SIGTERM や Ctrl+C で停止する
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    signal.signal(signal.SIGINT, lambda signum, frame: stop_event.set())
+    while not stop_event.wait(1.0):
+        pass
+    server.stop()
+    server.logger.close()
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -0,0 +1,537 @@
+import os
+import selectors
+import socket
+import threading
+import collections
+import heapq
+import itertools
+import time
+
+from chat_protocol import ProtocolError, encode_frame, FRAME_SYSTEM, FRAME_PING, FRAME_PONG
+from chat_sessions import Session, SessionRegistry
+
+# イベントループ型のサーバーエンジン
+#
+# 1本のスレッドと selectors (Linuxでは epoll) で全ソケットの accept / 受信 /
+# 送信を担当する。クライアントごとのスレッドを持たないため、アイドル接続が
+# 数千〜数万あってもスレッド数は増えない。
+# 受信したフレームの解釈（コマンド処理など）はハンドラに委譲する。
+#
+# 送信は書き込みの集約を行う: send() / broadcast() はフレームを送信キューに積んで接続に印を付けるだけで、
+# ループの1周回の処理（受信・タイマー・コールバック）が終わった時点で、印の付いた接続ごとに
+# キュー内のフレームを1回の sendmsg() (writev) でまとめて送る。フレームの bytes は全受信者で共有し、複製しない。
+# 負荷が軽いとき（前回の送信から max_flush_delay 以上空いている）は周回の終わりにすぐ送り、
+# 送信が続いているとき（バースト）は前回の送信から max_flush_delay 秒後まで送信を遅らせて、
+# 1回のシステムコールで送るフレーム数を増やす。
+# Nagle による遅延を避けるため、接続には TCP_NODELAY を設定する。
+#
+# 死んだ接続（スリープしたPC、NATのタイムアウトなどで相手が消えた半開きのTCP接続）は、タイマーで
+# 定期的に全接続をまとめて調べて切断する: idle_timeout 秒何も受信していない接続と、送信が write_timeout 秒
+# 進まない接続。全接続には heartbeat_interval 秒ごとに FRAME_PING を送り、相手は FRAME_PONG を返す
+# (これで生きている接続は無受信にならず、クライアント側も受信が途絶えたことでサーバーとの切断に気付ける)。
+# PING / PONG はエンジンが処理し、ハンドラには渡さない。
+#
+# ハンドラが実装するメソッド（すべてイベントループのスレッドで呼ばれる）:
+#   on_frame(conn, frame_type, payload)  フレームを1つ受信した
+#   on_close(conn)                       接続が閉じられた
+
+RECV_SIZE = 65536
+
+# 送信キューが上限に達した（受信の遅いクライアント）ときの動作
+POLICY_DROP_OLDEST = "drop_oldest"  # 最も古い未送信フレームを捨てる
+POLICY_COALESCE = "coalesce"        # 未送信フレームをまとめて捨て、省略件数の通知1件に置き換える
+POLICY_DISCONNECT = "disconnect"    # 接続を切断する
+SLOW_CONSUMER_POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE, POLICY_DISCONNECT)
+
+DEFAULT_MAX_QUEUE_FRAMES = 1000
+DEFAULT_MAX_QUEUE_BYTES = 4 * 1024 * 1024
+
+DEFAULT_MAX_FLUSH_DELAY = 0.002  # バースト時に送信を遅らせる最大時間 (秒)
+MAX_SEND_BYTES = 1024 * 1024     # 1回の sendmsg() で渡す最大バイト数
+try:
+    IOV_MAX = os.sysconf("SC_IOV_MAX")
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+HAS_SENDMSG = hasattr(socket.socket, "sendmsg")  # Windows にはない（1フレームずつ send() する）
+
+DEFAULT_HEARTBEAT_INTERVAL = 30.0  # FRAME_PING を送る間隔 (秒)
+DEFAULT_IDLE_TIMEOUT = 90.0        # これだけ何も受信しなければ切断する (秒)
+DEFAULT_WRITE_TIMEOUT = 60.0       # 送信がこれだけ進まなければ切断する (秒)
+REAP_INTERVAL = 5.0                # 接続を調べる間隔の上限 (秒)
+# 切断の理由
+REAP_IDLE = "idle"
+REAP_WRITE = "write"
+
+
+class TimerHandle:
+    """call_later() の戻り値。cancel() で実行を取り消す"""
+
+    __slots__ = ("when", "seq", "callback", "args", "cancelled")
+
+    def __init__(self, when, seq, callback, args):
+        self.when = when
+        self.seq = seq
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def __lt__(self, other):
+        return (self.when, self.seq) < (other.when, other.seq)
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class ChatServerEngine:
+    def __init__(self, handler, host="", port=50000, backlog=128,
+                 max_queue_frames=DEFAULT_MAX_QUEUE_FRAMES, max_queue_bytes=DEFAULT_MAX_QUEUE_BYTES,
+                 slow_consumer_policy=POLICY_DROP_OLDEST, log=None, fanout_histogram=None, reuse_port=False,
+                 tcp_nodelay=True, max_flush_delay=DEFAULT_MAX_FLUSH_DELAY,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL, idle_timeout=DEFAULT_IDLE_TIMEOUT,
+                 write_timeout=DEFAULT_WRITE_TIMEOUT):
+        if slow_consumer_policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"不明な送信キューポリシー: {slow_consumer_policy}")
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+        self.reuse_port = reuse_port  # 複数プロセスで同じポートを待ち受ける (SO_REUSEPORT)
+        self.tcp_nodelay = tcp_nodelay
+        self.max_flush_delay = max_flush_delay
+        # 死んだ接続の検出（それぞれ0以下で無効）。接続を調べる間隔は最短の設定値の半分 (最大 REAP_INTERVAL)
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.write_timeout = write_timeout
+        self.reap_interval = min([REAP_INTERVAL] + [value / 2 for value in (heartbeat_interval, idle_timeout, write_timeout)
+                                                    if value > 0])
+        self.max_queue_frames = max_queue_frames
+        self.max_queue_bytes = max_queue_bytes
+        self.slow_consumer_policy = slow_consumer_policy
+        self.log = log or (lambda message, level="INFO": None)
+        self.sessions = SessionRegistry()
+        self.is_running = False
+        # 統計（イベントループのスレッドだけが更新する）
+        self.fanout_histogram = fanout_histogram  # broadcast() 1回あたりの所要時間 (chat_metrics.Histogram)
+        self.accepted_connections = 0
+        self.frames_received = 0
+        self.bytes_received = 0
+        self.frames_queued = 0
+        self.bytes_sent = 0
+        self.dropped_frames = 0
+        self.slow_consumer_disconnects = 0
+        self.send_calls = 0        # 送信のシステムコール数 (frames_queued / send_calls が1回あたりのフレーム数)
+        self.flush_delay = 0.0     # 現在の送信の遅らせ時間 (秒)
+        self.heartbeats_sent = 0
+        self.reaped = {REAP_IDLE: 0, REAP_WRITE: 0}  # 応答がないため切断した接続数（理由ごと）
+
+        self._selector = None
+        self._server_socket = None
+        self._thread = None
+        self._loop_thread_id = None
+        self._callbacks = collections.deque()
+        self._timers = []  # TimerHandle のヒープ（イベントループのスレッドのみが操作する）
+        self._timer_seq = itertools.count()
+        self._wakeup_recv = None
+        self._wakeup_send = None
+        self._dirty = []             # 送信待ちのフレームがある接続（周回の終わりにまとめて送る）
+        self._flush_deadline = None  # 送信を遅らせている場合の送信時刻
+        self._last_flush = 0.0       # 前回まとめて送った時刻
+
+    # ------------------------------------------------------------------
+    # 起動・停止
+    # ------------------------------------------------------------------
+    def start(self):
+        """待ち受けソケットを作成し、イベントループのスレッドを起動する"""
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        try:
+            server_socket.bind((self.host, self.port))
+            server_socket.listen(self.backlog)
+            server_socket.setblocking(False)
+        except Exception:
+            server_socket.close()
+            raise
+
+        self._server_socket = server_socket
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(server_socket, selectors.EVENT_READ, None)
+
+        # 他スレッドからループを起こすためのソケットペア
+        self._wakeup_recv, self._wakeup_send = socket.socketpair()
+        self._wakeup_recv.setblocking(False)
+        self._wakeup_send.setblocking(False)
+        self._selector.register(self._wakeup_recv, selectors.EVENT_READ, self._wakeup_recv)
+
+        self.is_running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        """イベントループを停止し、全接続を閉じる（未送信データは可能な範囲で送る）"""
+        if not self.is_running:
+            return
+        self.call_soon(self._begin_shutdown)
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join(timeout=timeout)
+
+    def _begin_shutdown(self):
+        self.is_running = False
+
+    # ------------------------------------------------------------------
+    # 他スレッドから利用するAPI
+    # ------------------------------------------------------------------
+    def in_loop_thread(self):
+        return threading.get_ident() == self._loop_thread_id
+
+    def call_soon(self, callback, *args):
+        """callback をイベントループのスレッドで実行する（スレッドセーフ）"""
+        self._callbacks.append((callback, args))
+        try:
+            self._wakeup_send.send(b"\0")
+        except (BlockingIOError, AttributeError, OSError):
+            pass  # 既に起床要求が溜まっている、または停止済み
+
+    def call_later(self, delay, callback, *args):
+        """delay 秒後に callback をイベントループのスレッドで実行する（ループのスレッドから呼ぶ）"""
+        handle = TimerHandle(time.monotonic() + delay, next(self._timer_seq), callback, args)
+        heapq.heappush(self._timers, handle)
+        return handle
+
+    def send(self, conn, frame):
+        """接続の送信キューにエンコード済みフレームを積み、送れる分だけ送る"""
+        if not self.in_loop_thread():
+            self.call_soon(self.send, conn, frame)
+            return
+        if conn.closed:
+            return
+        if self._enqueue(conn, frame):
+            self._mark_dirty(conn)
+
+    def broadcast(self, frame, exclude=None, members=None):
+        """全接続（HELLO済み）にフレームを送信する。exclude の接続は除く
+
+        members (接続の集合、ルームのメンバーなど) を指定した場合はその接続にだけ送る。
+        フレームはエンコード済みの bytes を全員で共有し、受信者ごとには複製しない。
+        各接続のキューに積んだあと、それぞれ送れる分だけ送る。受信の遅い
+        クライアントがいても他のクライアントへの配信は待たされない。
+        """
+        if not self.in_loop_thread():
+            self.call_soon(self.broadcast, frame, exclude, members)
+            return
+        started = time.perf_counter()
+        # 送信中の切断で members が変わることがあるため、スナップショットを辿る
+        targets = self.sessions.named_sessions() if members is None else list(members)
+        for conn in targets:
+            if conn is not exclude and not conn.closed:
+                if self._enqueue(conn, frame):
+                    self._mark_dirty(conn)
+        if self.fanout_histogram is not None:
+            self.fanout_histogram.observe(time.perf_counter() - started)
+
+    def close_connection(self, conn):
+        """接続を閉じてハンドラに通知する"""
+        if not self.in_loop_thread():
+            self.call_soon(self.close_connection, conn)
+            return
+        if conn.closed:
+            return
+        conn.closed = True
+        self.sessions.remove(conn)
+        try:
+            self._selector.unregister(conn.socket)
+        except (KeyError, ValueError):
+            pass
+        try:
+            conn.socket.close()
+        except OSError:
+            pass
+        self.handler.on_close(conn)
+
+    # ------------------------------------------------------------------
+    # イベントループ
+    # ------------------------------------------------------------------
+    def _run(self):
+        self._loop_thread_id = threading.get_ident()
+        if self.heartbeat_interval > 0 or self.idle_timeout > 0 or self.write_timeout > 0:
+            self.call_later(self.reap_interval, self._reap)
+        try:
+            while self.is_running:
+                for key, events in self._selector.select(timeout=self._select_timeout()):
+                    if key.data is None:
+                        self._accept()
+                    elif key.data is self._wakeup_recv:
+                        self._drain_wakeup()
+                    else:
+                        conn = key.data
+                        if events & selectors.EVENT_READ:
+                            self._read(conn)
+                        if events & selectors.EVENT_WRITE and not conn.closed:
+                            self._flush(conn)
+                self._run_timers()
+                self._run_callbacks()
+                if self._dirty:
+                    self._flush_dirty()
+        finally:
+            self._cleanup()
+
+    def _drain_wakeup(self):
+        try:
+            while self._wakeup_recv.recv(4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _select_timeout(self):
+        if self._callbacks:
+            return 0
+        timeout = 1.0
+        if self._timers:
+            timeout = min(timeout, self._timers[0].when - time.monotonic())
+        if self._flush_deadline is not None:
+            timeout = min(timeout, self._flush_deadline - time.monotonic())
+        return max(0.0, timeout)
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self._timers and self._timers[0].when <= now:
+            handle = heapq.heappop(self._timers)
+            if not handle.cancelled:
+                self._callbacks.append((handle.callback, handle.args))
+
+    def _run_callbacks(self):
+        # 実行中に追加されたコールバックは次の周回で処理する
+        for _ in range(len(self._callbacks)):
+            callback, args = self._callbacks.popleft()
+            try:
+                callback(*args)
+            except Exception as e:
+                # 1つのコールバックの失敗でイベントループを止めない
+                self.log(f"イベントループのコールバックでエラーが発生しました: {e}", "ERROR")
+
+    def _accept(self):
+        # 溜まっている接続要求をまとめて受け付ける
+        while True:
+            try:
+                client_socket, client_address = self._server_socket.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            client_socket.setblocking(False)
+            if self.tcp_nodelay:
+                try:
+                    client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                except OSError:
+                    pass
+            self.accepted_connections += 1
+            conn = Session(client_socket, client_address)
+            self.sessions.add(conn)
+            self._selector.register(client_socket, selectors.EVENT_READ, conn)
+
+    def _read(self, conn):
+        try:
+            data = conn.socket.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self.close_connection(conn)
+            return
+        if not data:
+            self.close_connection(conn)
+            return
+        conn.last_received = time.monotonic()
+        self.bytes_received += len(data)
+        error = None
+        try:
+            frames = conn.decoder.feed(data)
+        except ProtocolError as e:
+            # 不正なデータより前に届いていたフレームは処理してから切断する
+            frames, error = e.frames, e
+        self.frames_received += len(frames)
+        for frame_type, payload in frames:
+            if conn.closed:
+                break
+            if frame_type == FRAME_PING:
+                self.send(conn, encode_frame(FRAME_PONG, payload))
+                continue
+            if frame_type == FRAME_PONG:
+                continue  # 受信時刻の更新だけでよい
+            try:
+                self.handler.on_frame(conn, frame_type, payload)
+            except Exception as e:
+                # ハンドラの例外はその接続だけを切断し、他の接続には影響させない
+                self.log(f"クライアントハンドラエラー ({conn.username}): {e}", "ERROR")
+                self.close_connection(conn)
+        if error is not None:
+            self.close_connection(conn)
+
+    def _reap(self):
+        """全接続をまとめて調べ、応答のない接続を切断してハートビートを送る（イベントループのタイマー）"""
+        now = time.monotonic()
+        dead = []
+        ping = encode_frame(FRAME_PING) if self.heartbeat_interval > 0 else None
+        for conn in self.sessions.sessions():
+            if self.idle_timeout > 0 and now - conn.last_received > self.idle_timeout:
+                dead.append((conn, REAP_IDLE))
+            elif (self.write_timeout > 0 and conn.write_blocked_since is not None and
+                  now - conn.write_blocked_since > self.write_timeout):
+                dead.append((conn, REAP_WRITE))
+            elif ping is not None and now - conn.last_ping >= self.heartbeat_interval:
+                conn.last_ping = now
+                self.heartbeats_sent += 1
+                self.send(conn, ping)
+        for conn, reason in dead:
+            self.reaped[reason] += 1
+            self.close_connection(conn)
+        if dead:
+            idle = sum(1 for _, reason in dead if reason == REAP_IDLE)
+            self.log(f"応答のない接続を切断しました (無受信 {idle}件, 送信停滞 {len(dead) - idle}件)", "INFO")
+        self.call_later(self.reap_interval, self._reap)
+
+    def _enqueue(self, conn, frame):
+        """送信キューにフレームを追加する。上限超過時はポリシーに従う
+
+        接続を切断した場合は False を返す。
+        """
+        queue = conn.outqueue
+        if conn.flush_pending and (len(queue) >= self.max_queue_frames or
+                                   conn.outqueue_bytes + len(frame) > self.max_queue_bytes):
+            # 集約のために送信を遅らせている分で溢れる場合は、捨てる前にいったん送る
+            self._flush(conn)
+            if conn.closed:
+                return False
+        if len(queue) >= self.max_queue_frames or conn.outqueue_bytes + len(frame) > self.max_queue_bytes:
+            if self.slow_consumer_policy == POLICY_DISCONNECT:
+                self.slow_consumer_disconnects += 1
+                self.close_connection(conn)
+                return False
+            # 送信途中の先頭フレームは捨てられないので残す
+            keep = 1 if conn.out_offset else 0
+            if self.slow_consumer_policy == POLICY_COALESCE:
+                dropped = len(queue) - keep
+                while len(queue) > keep:
+                    conn.outqueue_bytes -= len(queue.pop())
+                if dropped:
+                    notice = encode_frame(FRAME_SYSTEM, f"受信が追いつかないため、{dropped} 件のメッセージを省略しました。")
+                    queue.append(notice)
+                    conn.outqueue_bytes += len(notice)
+            else:
+                dropped = 0
+                while len(queue) > keep and (len(queue) >= self.max_queue_frames or
+                                             conn.outqueue_bytes + len(frame) > self.max_queue_bytes):
+                    old = queue[keep]
+                    del queue[keep]
+                    conn.outqueue_bytes -= len(old)
+                    dropped += 1
+            conn.dropped_frames += dropped
+            self.dropped_frames += dropped
+        queue.append(frame)
+        conn.outqueue_bytes += len(frame)
+        self.frames_queued += 1
+        return True
+
+    def _mark_dirty(self, conn):
+        """接続に送信待ちの印を付ける（実際の送信は周回の終わりの _flush_dirty() で行う）"""
+        if not conn.flush_pending:
+            conn.flush_pending = True
+            self._dirty.append(conn)
+
+    def _flush_dirty(self):
+        """印の付いた接続の送信キューをまとめて送る
+
+        前回の送信から max_flush_delay 以上空いていれば（軽負荷）すぐに送る。送信が続いている
+        （バースト）ときは前回の送信から max_flush_delay 後まで待ち、その間に積まれたフレームも
+        同じ sendmsg() で送る。待ち時間は送信の間隔に応じて 0〜max_flush_delay の間で変わる。
+        """
+        now = time.monotonic()
+        if self._flush_deadline is None:
+            self.flush_delay = max(0.0, self._last_flush + self.max_flush_delay - now)
+            if self.flush_delay > 0:
+                self._flush_deadline = now + self.flush_delay
+                return
+        elif now < self._flush_deadline:
+            return
+        self._flush_deadline = None
+        self._last_flush = now
+        dirty, self._dirty = self._dirty, []
+        for conn in dirty:
+            conn.flush_pending = False
+            if not conn.closed:
+                self._flush(conn)
+
+    def _flush(self, conn):
+        """送信キューの先頭から、ソケットが受け付けるだけ送信する
+
+        複数のフレームは sendmsg() で1回のシステムコールにまとめる（先頭フレームの送信途中の
+        位置からの memoryview と、残りのフレームの bytes をそのまま渡すためコピーしない）。
+        """
+        queue = conn.outqueue
+        progressed = False
+        try:
+            while queue:
+                if HAS_SENDMSG and len(queue) > 1:
+                    buffers = [memoryview(queue[0])[conn.out_offset:]]
+                    total = len(buffers[0])
+                    for index in range(1, min(len(queue), IOV_MAX)):
+                        if total >= MAX_SEND_BYTES:
+                            break
+                        buffers.append(queue[index])
+                        total += len(queue[index])
+                    sent = conn.socket.sendmsg(buffers)
+                else:
+                    total = len(queue[0]) - conn.out_offset
+                    if conn.out_offset:
+                        sent = conn.socket.send(memoryview(queue[0])[conn.out_offset:])
+                    else:
+                        sent = conn.socket.send(queue[0])
+                self.send_calls += 1
+                self.bytes_sent += sent
+                progressed = progressed or sent > 0
+                # 送り切ったフレームをキューから外す
+                remaining = sent + conn.out_offset
+                while queue and remaining >= len(queue[0]):
+                    frame = queue.popleft()
+                    remaining -= len(frame)
+                    conn.outqueue_bytes -= len(frame)
+                conn.out_offset = remaining
+                if sent < total:
+                    break  # カーネルの送信バッファが一杯
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError:
+            self.close_connection(conn)
+            return
+        # 送信が進まない時間を測る（送り切るか、少しでも送れたら測り直す）
+        if not queue:
+            conn.write_blocked_since = None
+        elif progressed or conn.write_blocked_since is None:
+            conn.write_blocked_since = time.monotonic()
+        # 未送信データがあるときだけ書き込み可能イベントを監視する
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if queue else 0)
+        try:
+            if self._selector.get_key(conn.socket).events != events:
+                self._selector.modify(conn.socket, events, conn)
+        except (KeyError, ValueError):
+            pass
+
+    def _cleanup(self):
+        self.is_running = False
+        self._run_callbacks()
+        for conn in self.sessions.sessions():
+            # 停止直前に積まれた通知（シャットダウン等）をできるだけ送る
+            if conn.outqueue:
+                try:
+                    conn.socket.settimeout(0.1)
+                    conn.socket.sendall(memoryview(conn.outqueue.popleft())[conn.out_offset:])
+                    for frame in conn.outqueue:
+                        conn.socket.sendall(frame)
+                except OSError:
+                    pass
+            self.close_connection(conn)
+        self._selector.close()
+        self._server_socket.close()
+        self._wakeup_recv.close()
+        self._wakeup_send.close()
+        self._server_socket = None
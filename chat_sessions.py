@@ -0,0 +1,128 @@
+import collections
+import threading
+import time
+
+from chat_protocol import FrameDecoder
+
+# 接続中クライアントのセッション管理
+#
+# セッションはソケット (fileno) とユーザー名の両方から O(1) で引けるように
+# 2つの辞書で管理する。更新はイベントループのスレッドから行うが、
+# AIワーカーなど他スレッドからの参照もあるためロックで保護する。
+
+
+class Session:
+    """1クライアント接続の状態"""
+
+    # 数千接続を保持するため、インスタンス辞書を持たない
+    __slots__ = (
+        "socket", "address", "fileno", "decoder",
+        "outqueue", "outqueue_bytes", "out_offset", "dropped_frames",
+        "username", "closed",
+        "rate_buckets", "deferred", "last_limit_notice", "room", "flush_pending",
+        "token", "client_seq",
+        "last_received", "last_ping", "write_blocked_since",
+        "page_cursor",
+    )
+
+    def __init__(self, sock, address):
+        self.socket = sock
+        self.address = address
+        self.fileno = sock.fileno()
+        self.decoder = FrameDecoder()
+        self.outqueue = collections.deque()  # 未送信フレーム (bytes)
+        self.outqueue_bytes = 0              # キュー内の合計バイト数
+        self.out_offset = 0                  # 先頭フレームの送信済みバイト数
+        self.dropped_frames = 0              # 上限超過で捨てたフレーム数
+        self.username = None                 # HELLO受信後に設定される
+        self.closed = False
+        self.rate_buckets = {}               # 送信レート制限のトークンバケット (種類 -> TokenBucket)
+        self.deferred = None                 # レート制限で処理を遅らせているメッセージ (deque)
+        self.last_limit_notice = 0.0         # 最後にレート制限の通知を送った時刻
+        self.room = None                     # 所属しているルーム (chat_rooms.Room)
+        self.flush_pending = False           # 周回の終わりにまとめて送信する接続の一覧に入っている
+        self.token = None                    # 再開用トークン (chat_resume.ResumeRegistry)
+        self.client_seq = 0                  # 処理済みの発言のメッセージIDの最大値（これ以下は重複として捨てる）
+        now = time.monotonic()
+        self.last_received = now             # 最後にデータを受信した時刻（無受信の接続の切断に使う）
+        self.last_ping = now                 # 最後に FRAME_PING を送った時刻
+        self.write_blocked_since = None      # 送信が進まなくなった時刻（カーネルの送信バッファが一杯の間）
+        self.page_cursor = None              # /search・/history の続き (/more で読む chat_store.PageCursor)
+
+    def __repr__(self):
+        return f"<Session {self.username} {self.address[0]}:{self.address[1]}>"
+
+
+class SessionRegistry:
+    """fileno とユーザー名で索引付けしたセッションの一覧"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_fileno = {}
+        self._by_username = {}       # 入室順を保持する
+        self._name_suffixes = {}     # 重複時に次に試す連番 (元の名前 -> 番号)
+
+    def __len__(self):
+        return len(self._by_fileno)
+
+    def add(self, session):
+        with self._lock:
+            self._by_fileno[session.fileno] = session
+
+    def remove(self, session):
+        """セッションを削除する。登録されていなかった場合は False を返す"""
+        with self._lock:
+            if self._by_fileno.get(session.fileno) is not session:
+                return False
+            del self._by_fileno[session.fileno]
+            if session.username is not None and self._by_username.get(session.username) is session:
+                del self._by_username[session.username]
+            return True
+
+    def get_by_fileno(self, fileno):
+        return self._by_fileno.get(fileno)
+
+    def get(self, username):
+        """ユーザー名からセッションを取得する（入室済みのみ）"""
+        return self._by_username.get(username)
+
+    def claim_username(self, session, desired, taken=None):
+        """desired を基にした重複しないユーザー名をセッションに割り当て、その名前を返す
+
+        既に使われている場合は "名前_1", "名前_2" ... の形にする。
+        taken(名前) が True を返す名前（他のワーカープロセスのユーザーなど）も使用中とみなす。
+        """
+        def in_use(name):
+            return name in self._by_username or (taken is not None and taken(name))
+
+        with self._lock:
+            username = desired
+            if not in_use(username):
+                self._name_suffixes.pop(desired, None)
+            else:
+                count = self._name_suffixes.get(desired, 1)
+                username = f"{desired}_{count}"
+                while in_use(username):
+                    count += 1
+                    username = f"{desired}_{count}"
+                self._name_suffixes[desired] = count + 1
+            session.username = username
+            self._by_username[username] = session
+            return username
+
+    def sessions(self):
+        """全セッション（入室前を含む）のスナップショット"""
+        with self._lock:
+            return list(self._by_fileno.values())
+
+    def named_sessions(self):
+        """入室済みセッションのスナップショット（入室順）"""
+        with self._lock:
+            return list(self._by_username.values())
+
+    def usernames(self):
+        with self._lock:
+            return list(self._by_username)
+
+    def user_count(self):
+        return len(self._by_username)
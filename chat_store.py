@@ -0,0 +1,360 @@
+import collections
+import datetime
+import os
+import re
+import sqlite3
+import threading
+import time
+
+# メッセージストア（SQLite）
+#
+# ルームの発言を SQLite (WALモード) に永続化し、/search と /history の問い合わせに答える。
+# append() は行をキューに積むだけで戻り、書き込みは専用のスレッドが batch_size 件または
+# flush_interval 秒ごとに1トランザクションでまとめて行う（配信の処理はディスクを待たない）。
+# 問い合わせも同じスレッドで、溜まっている書き込みを済ませてから実行し、結果を callback に渡す。
+#
+# 発言は時刻・送信者・ルームの索引に加えて FTS5 の全文検索索引に登録する。
+# 日本語は空白で区切られないため、使えれば trigram トークナイザを使う（3文字以上の語は索引で引き、
+# それより短い語は索引で絞り込んだ結果、または直近 SEARCH_SCAN_ROWS 件の中から探す）。
+# FTS5 が使えない SQLite では、常に直近 SEARCH_SCAN_ROWS 件の中から探す。
+#
+# 結果は1回に PAGE_SIZE 件ずつ返し、続きは PageCursor（最後に返した行の位置）から読む。
+# どの問い合わせもルームと時刻（または FTS の rowid）の索引を範囲で読むため、ログ全体は走査しない。
+
+DEFAULT_MESSAGE_STORE = "messages.db"  # history_dir からの相対パス
+DEFAULT_BATCH_SIZE = 500               # 1トランザクションで書き込む最大件数
+DEFAULT_FLUSH_INTERVAL = 0.2           # 書き込みスレッドがキューを取り出す間隔 (秒)
+MAX_PENDING_ROWS = 100000              # 書き込みが追いつかない場合はこれを超えた古い行から捨てる
+PAGE_SIZE = 20                         # 1回に返す件数
+MAX_HISTORY_ROWS = 1000                # /history N の N の上限
+SEARCH_SCAN_ROWS = 5000                # 索引を使えない検索で調べる直近の件数
+MIN_TRIGRAM_TERM = 3                   # trigram 索引で引ける語の最小文字数
+
+KIND_SEARCH = "search"
+KIND_RECENT = "recent"  # /history N: 新しい方から N 件（続きはより古い方へ）
+KIND_SINCE = "since"    # /history 時刻: 指定の時刻から（続きはより新しい方へ）
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    ts REAL NOT NULL,
+    room TEXT NOT NULL,
+    sender TEXT,
+    body TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_room_ts ON messages (room, ts);
+CREATE INDEX IF NOT EXISTS messages_sender_ts ON messages (sender, ts);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (ts);
+"""
+
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    body, content='messages', content_rowid='id', tokenize='{tokenizer}'
+);
+CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, body) VALUES (new.id, new.body);
+END;
+"""
+
+_RELATIVE_SINCE = re.compile(r"^(\d+)\s*(s|m|h|d|秒|分|時間|日)$")
+_RELATIVE_UNITS = {"s": 1, "秒": 1, "m": 60, "分": 60, "h": 3600, "時間": 3600, "d": 86400, "日": 86400}
+_ABSOLUTE_FORMATS = ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M",
+                     "%Y-%m-%d", "%Y/%m/%d %H:%M", "%Y/%m/%d")
+
+
+class StoreError(Exception):
+    pass
+
+
+class PageCursor:
+    """問い合わせの条件と、次のページの開始位置"""
+
+    __slots__ = ("kind", "room", "terms", "sender", "position", "remaining")
+
+    def __init__(self, kind, room, terms=(), sender=None, position=None, remaining=None):
+        self.kind = kind
+        self.room = room
+        self.terms = tuple(terms)
+        self.sender = sender
+        self.position = position    # 最後に返した行の (ts, id)。全文検索索引を使う検索は id
+        self.remaining = remaining  # /history N の残り件数
+
+
+class StoredMessage:
+    __slots__ = ("id", "ts", "sender", "body")
+
+    def __init__(self, id, ts, sender, body):
+        self.id = id
+        self.ts = ts
+        self.sender = sender
+        self.body = body
+
+    def format(self):
+        when = datetime.datetime.fromtimestamp(self.ts).strftime("%m-%d %H:%M")
+        return f"[{when}] {self.body}"
+
+
+def parse_since(text, now=None):
+    """/history の時刻指定を UNIX 時刻にする。解釈できなければ None
+
+    「30m」「2h」「1d」（30分前など）、「HH:MM」（今日。未来なら前日）、「YYYY-MM-DD [HH:MM]」を受け付ける。
+    """
+    text = text.strip()
+    now = time.time() if now is None else now
+    match = _RELATIVE_SINCE.match(text)
+    if match:
+        return now - int(match.group(1)) * _RELATIVE_UNITS[match.group(2)]
+    for fmt in _ABSOLUTE_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).timestamp()
+        except ValueError:
+            pass
+    try:
+        clock = datetime.datetime.strptime(text, "%H:%M").time()
+    except ValueError:
+        return None
+    today = datetime.datetime.fromtimestamp(now)
+    when = datetime.datetime.combine(today.date(), clock)
+    if when > today:
+        when -= datetime.timedelta(days=1)
+    return when.timestamp()
+
+
+def parse_search(text):
+    """/search の引数を (検索語のタプル, 送信者) にする。「from:名前」で送信者を絞り込む"""
+    terms = []
+    sender = None
+    for word in text.split():
+        if word.startswith("from:") and len(word) > 5:
+            sender = word[5:]
+        else:
+            terms.append(word)
+    return tuple(terms), sender
+
+
+class MessageStore:
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL, log=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.log = log or (lambda message, level="INFO": None)
+        self.fts = None          # 全文検索索引のトークナイザ（使えない場合は None）
+        self.written = 0         # 書き込んだ行数
+        self.batches = 0         # 書き込みのトランザクション数
+        self.dropped = 0         # 書き込みが追いつかずに捨てた行数
+        self.errors = 0          # 書き込みに失敗した回数
+        self.queries = 0         # 実行した問い合わせの数
+        self._rows = collections.deque(maxlen=MAX_PENDING_ROWS)  # (ts, room, sender, body)
+        self._queries = collections.deque()                      # (cursor, limit, callback)
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._db = None
+        self._thread = None
+
+    def start(self):
+        """データベースを開いてスキーマを用意し、書き込みスレッドを起動する。失敗した場合は例外を送出する"""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.execute("PRAGMA busy_timeout=5000")  # クラスタモードでは複数のワーカーが同じファイルに書く
+            db.executescript(SCHEMA)
+            self.fts = self._setup_fts(db)
+        except sqlite3.Error:
+            db.close()
+            raise
+        self._db = db
+        self._thread = threading.Thread(target=self._run, name="message-store", daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _setup_fts(db):
+        row = db.execute("SELECT sql FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+        if row is not None:
+            return "trigram" if "trigram" in row[0] else "unicode61"
+        for tokenizer in ("trigram", "unicode61"):
+            try:
+                db.executescript(FTS_SCHEMA.format(tokenizer=tokenizer))
+            except sqlite3.OperationalError:
+                continue
+            # 索引を作る前に書かれていた行も登録する
+            db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            db.commit()
+            return tokenizer
+        return None
+
+    def append(self, room, sender, body, ts=None):
+        """行を書き込みキューに積む（どのスレッドからでも呼べる。ディスクは待たない）"""
+        rows = self._rows
+        if len(rows) == rows.maxlen:
+            self.dropped += 1
+        rows.append((time.time() if ts is None else ts, room, sender, body))
+        if len(rows) >= self.batch_size:
+            self._wake.set()
+
+    def pending(self):
+        return len(self._rows)
+
+    def query(self, cursor, callback, limit=PAGE_SIZE):
+        """cursor の次のページを書き込みスレッドで読み、callback(行の一覧, 続きの PageCursor または None, エラー) を呼ぶ
+
+        行は古い順に並べて渡す。それまでに append() した行は結果に含まれる。
+        """
+        self._queries.append((cursor, limit, callback))
+        self._wake.set()
+
+    def close(self):
+        """溜まっている行を書き込んでからデータベースを閉じる"""
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout=5.0)
+        self._thread = None
+
+    def _run(self):
+        db = self._db
+        try:
+            while True:
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                self._write(db)
+                while self._queries:
+                    self._answer(db, *self._queries.popleft())
+                if self._stop.is_set():
+                    self._write(db)
+                    break
+        finally:
+            db.close()
+            self._db = None
+
+    def _write(self, db):
+        rows = self._rows
+        while rows:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(rows.popleft())
+            except IndexError:
+                pass
+            try:
+                with db:
+                    db.executemany("INSERT INTO messages (ts, room, sender, body) VALUES (?, ?, ?, ?)", batch)
+            except sqlite3.Error as e:
+                self.errors += 1
+                self.log(f"メッセージストアへの書き込みに失敗しました ({len(batch)}件を破棄): {e}", "ERROR")
+                continue
+            self.written += len(batch)
+            self.batches += 1
+
+    def _answer(self, db, cursor, limit, callback):
+        self.queries += 1
+        try:
+            if cursor.kind == KIND_SEARCH:
+                rows, next_cursor = self._search(db, cursor, limit)
+            elif cursor.kind == KIND_RECENT:
+                rows, next_cursor = self._recent(db, cursor, limit)
+            elif cursor.kind == KIND_SINCE:
+                rows, next_cursor = self._since(db, cursor, limit)
+            else:
+                raise StoreError(f"不明な問い合わせです: {cursor.kind}")
+        except (sqlite3.Error, StoreError) as e:
+            self.log(f"メッセージストアの問い合わせに失敗しました ({cursor.kind}): {e}", "WARN")
+            rows, next_cursor, error = [], None, e
+        else:
+            error = None
+        try:
+            callback(rows, next_cursor, error)
+        except Exception as e:
+            self.log(f"メッセージストアの問い合わせ結果の処理でエラー: {e}", "ERROR")
+
+    @staticmethod
+    def _page(cursor, records, limit, position):
+        """limit + 1 件読んだ records から1ページ分の行と、続きがあれば次の PageCursor を返す"""
+        more = len(records) > limit
+        records = records[:limit]
+        rows = [StoredMessage(*record) for record in records]
+        if not more or not rows:
+            return rows, None
+        return rows, PageCursor(cursor.kind, cursor.room, cursor.terms, cursor.sender,
+                                position(rows[-1]), cursor.remaining)
+
+    def _recent(self, db, cursor, limit):
+        limit = min(limit, cursor.remaining)
+        sql = "SELECT id, ts, sender, body FROM messages WHERE room = ?"
+        params = [cursor.room]
+        if cursor.position is not None:
+            sql += " AND (ts, id) < (?, ?)"
+            params += cursor.position
+        sql += " ORDER BY ts DESC, id DESC LIMIT ?"
+        records = db.execute(sql, params + [limit + 1]).fetchall()
+        remaining = cursor.remaining - min(len(records), limit)
+        rows, next_cursor = self._page(cursor, records, limit, lambda row: (row.ts, row.id))
+        if next_cursor is not None:
+            if remaining <= 0:
+                next_cursor = None
+            else:
+                next_cursor.remaining = remaining
+        rows.reverse()
+        return rows, next_cursor
+
+    def _since(self, db, cursor, limit):
+        sql = "SELECT id, ts, sender, body FROM messages WHERE room = ? AND (ts, id) > (?, ?)"
+        sql += " ORDER BY ts, id LIMIT ?"
+        records = db.execute(sql, [cursor.room, *cursor.position, limit + 1]).fetchall()
+        return self._page(cursor, records, limit, lambda row: (row.ts, row.id))
+
+    def _search(self, db, cursor, limit):
+        position = cursor.position
+        indexed = [term for term in cursor.terms if self._indexable(term)]
+        filtered = [term for term in cursor.terms if term not in indexed]
+        sender = cursor.sender
+        params = []
+        if indexed:
+            # 索引で引ける語で絞り込み、短い語は本文の部分一致で確かめる
+            sql = ("SELECT m.id, m.ts, m.sender, m.body FROM messages_fts JOIN messages AS m ON m.id = messages_fts.rowid"
+                   " WHERE messages_fts MATCH ? AND m.room = ?")
+            params += [" ".join('"' + term.replace('"', '""') + '"' for term in indexed), cursor.room]
+            if position is not None:
+                sql += " AND messages_fts.rowid < ?"
+                params.append(position)
+            order = " ORDER BY messages_fts.rowid DESC"
+            key = lambda row: row.id
+        elif cursor.sender is not None and not filtered:
+            # 送信者だけの指定は送信者の索引を新しい方から読む
+            sql = "SELECT id, ts, sender, body FROM messages AS m WHERE sender = ? AND room = ?"
+            params += [sender, cursor.room]
+            sender = None
+            if position is not None:
+                sql += " AND (ts, id) < (?, ?)"
+                params += position
+            order = " ORDER BY ts DESC, id DESC"
+            key = lambda row: (row.ts, row.id)
+        else:
+            # 索引で引けない語だけの場合は、ルームの直近 SEARCH_SCAN_ROWS 件に限って探す
+            sql = ("SELECT id, ts, sender, body FROM (SELECT id, ts, sender, body FROM messages"
+                   " WHERE room = ? ORDER BY ts DESC, id DESC LIMIT ?) AS m WHERE 1")
+            params += [cursor.room, SEARCH_SCAN_ROWS]
+            if position is not None:
+                sql += " AND (ts, id) < (?, ?)"
+                params += position
+            order = " ORDER BY ts DESC, id DESC"
+            key = lambda row: (row.ts, row.id)
+        for term in filtered:
+            sql += " AND instr(m.body, ?) > 0"
+            params.append(term)
+        if sender is not None:
+            sql += " AND m.sender = ?"
+            params.append(sender)
+        records = db.execute(sql + order + " LIMIT ?", params + [limit + 1]).fetchall()
+        rows, next_cursor = self._page(cursor, records, limit, key)
+        rows.reverse()
+        return rows, next_cursor
+
+    def _indexable(self, term):
+        if self.fts == "trigram":
+            return len(term) >= MIN_TRIGRAM_TERM
+        return self.fts is not None
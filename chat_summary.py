@@ -0,0 +1,69 @@
+import threading
+
+# /summarize_gemini 用のインクリメンタル要約
+#
+# これまでの要約と「どこまで要約したか」(履歴の通し番号 = ウォーターマーク) を保持し、
+# 要約の更新時はウォーターマーク以降の新しい発言だけを送る。
+# 新しい発言がなければGeminiを呼ばずに保持している要約を返す。
+
+
+class RollingSummarizer:
+    def __init__(self, max_lines):
+        self.max_lines = max_lines  # 1回の更新で送る最大行数 (SUMMARY_LINES_FOR_GEMINI)
+        self.summary = ""
+        self.watermark = 0
+        self._lock = threading.Lock()  # 同時に要求されても更新は1回ずつ
+        self.updates = 0
+        self.cached_replies = 0
+
+    def reset(self):
+        with self._lock:
+            self.summary = ""
+            self.watermark = 0
+
+    def is_current(self, history):
+        """保持している要約が最新か（新しい発言がないか）"""
+        return bool(self.summary) and self.watermark >= history.total
+
+    def summarize(self, history, generate):
+        """要約を返す。新しい発言があれば generate(prompt) で要約を更新する
+
+        戻り値は (要約, キャッシュから返したか)。
+        """
+        with self._lock:
+            new_lines, next_watermark = history.since(self.watermark, limit=self.max_lines)
+            if not new_lines:
+                if self.summary:
+                    self.cached_replies += 1
+                    return self.summary, True
+                return "", True
+            prompt = build_summary_prompt(self.summary, new_lines)
+            self.summary = generate(prompt).strip()
+            self.watermark = next_watermark
+            self.updates += 1
+            return self.summary, False
+
+
+def build_summary_prompt(previous_summary, new_lines):
+    messages = "\n".join(new_lines)
+    if previous_summary:
+        return f"""あなたはチャットの内容を要約するAIです。
+これまでの会話の要約と、その後に追加された新しい発言があります。
+新しい発言の内容を取り込んで、会話全体の要約を更新してください。
+
+これまでの要約:
+{previous_summary}
+
+新しい発言:
+{messages}
+
+更新後の要約だけを、箇条書きで簡潔に日本語で出力してください。絵文字は使用しないでください。
+"""
+    return f"""あなたはチャットの内容を要約するAIです。
+次のチャットの発言を要約してください。
+
+発言:
+{messages}
+
+要約だけを、箇条書きで簡潔に日本語で出力してください。絵文字は使用しないでください。
+"""
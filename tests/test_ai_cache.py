@@ -0,0 +1,50 @@
+import os
+import tempfile
+import unittest
+
+from chat_ai_cache import TransformCache, context_fingerprint, normalize_message
+
+
+class TransformCacheTest(unittest.TestCase):
+    def test_keys_absorb_spelling_variants(self):
+        cache = TransformCache()
+        fingerprint = context_fingerprint("model", 1)
+        self.assertEqual(cache.make_key("ＵＲＵＳＡＩ  ！", fingerprint), cache.make_key(" urusai !", fingerprint))
+        self.assertEqual(normalize_message("  疲れた　 です "), "疲れた です")
+
+    def test_keys_depend_on_context(self):
+        cache = TransformCache()
+        self.assertNotEqual(cache.make_key("うるさい", context_fingerprint("model", 1)),
+                            cache.make_key("うるさい", context_fingerprint("model", 2)))
+        self.assertNotEqual(context_fingerprint("ab", "c"), context_fingerprint("a", "bc"))
+
+    def test_long_or_empty_messages_are_not_cached(self):
+        cache = TransformCache(max_text_length=8)
+        self.assertIsNone(cache.make_key("x" * 9, "fp"))
+        self.assertIsNone(cache.make_key("   ", "fp"))
+        cache.put(None, "ignored")
+        self.assertIsNone(cache.get(None))
+        self.assertEqual(len(cache), 0)
+
+    def test_counts_hits_and_misses(self):
+        cache = TransformCache()
+        key = cache.make_key("うるさい", "fp")
+        self.assertIsNone(cache.get(key))
+        cache.put(key, "盛り上げてくれてありがとう")
+        self.assertEqual(cache.get(key), "盛り上げてくれてありがとう")
+        self.assertEqual((cache.hits, cache.misses, cache.hit_rate()), (1, 1, 0.5))
+
+    def test_entries_survive_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "cache.json")
+            cache = TransformCache(path=path)
+            key = cache.make_key("疲れた", "fp")
+            cache.put(key, "今日もお疲れ様でした")
+            cache.save()
+            self.assertEqual(TransformCache(path=path).get(key), "今日もお疲れ様でした")
+            # 期限の短いキャッシュでは、保存時刻が古いエントリを読み込まない
+            self.assertIsNone(TransformCache(path=path, ttl=-1).get(key))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import queue
+import socket
+import tempfile
+import time
+import unittest
+
+from chat_cluster import (
+    ClusterLink, cluster_supported, decode_relay, encode_relay,
+    MAX_RELAY_FRAME_SIZE, RELAY_CLAIM, RELAY_CLAIMED,
+)
+from chat_protocol import FrameDecoder, ProtocolError, HEADER
+
+
+@unittest.skipUnless(cluster_supported(), "Unixソケットと SO_REUSEPORT が必要")
+class ClusterLinkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, "broker.sock")
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+        self.callbacks = queue.Queue()  # イベントループの代わり
+        self.logs = []
+        self.link = ClusterLink(path, 1, None, lambda callback, *args: self.callbacks.put((callback, args)),
+                                log=lambda message, level="INFO": self.logs.append((level, message)))
+        self.link.start()
+        self.broker, _ = self.listener.accept()
+
+    def tearDown(self):
+        self.link.close()
+        self.broker.close()
+        self.listener.close()
+        self.directory.cleanup()
+
+    def run_callbacks(self, until):
+        deadline = time.monotonic() + 5.0
+        while not until():
+            callback, args = self.callbacks.get(timeout=max(0.0, deadline - time.monotonic()))
+            callback(*args)
+
+    def claim(self, desired):
+        results = []
+        self.link.claim_username(desired, results.append)
+        return results
+
+    def test_claim_round_trip(self):
+        results = self.claim("alice")
+        decoder, frames = FrameDecoder(), []
+        while len(frames) < 2:  # HELLO と CLAIM
+            frames += decoder.feed(self.broker.recv(65536))
+        kind, payload = frames[1]
+        header, _ = decode_relay(payload)
+        self.assertEqual((kind, header["user"]), (RELAY_CLAIM, "alice"))
+        self.broker.sendall(encode_relay(RELAY_CLAIMED, {"request": header["request"], "user": "alice_1"}))
+        self.run_callbacks(lambda: results)
+        self.assertEqual(results, ["alice_1"])
+
+    def test_oversized_frame_marks_link_dead_and_fails_claims(self):
+        results = self.claim("alice")
+        self.broker.sendall(HEADER.pack(MAX_RELAY_FRAME_SIZE + 1, RELAY_CLAIMED))
+        self.run_callbacks(lambda: results)
+        self.assertEqual(results, [None])
+        self.assertTrue(self.link.dead)
+        self.assertTrue(any(level == "ERROR" for level, _ in self.logs))
+        self.assertEqual(self.claim("bob"), [None])
+
+    def test_frames_before_corrupt_data_are_still_dispatched(self):
+        results = self.claim("alice")
+        self.broker.sendall(encode_relay(RELAY_CLAIMED, {"request": 1, "user": "alice"})
+                            + HEADER.pack(MAX_RELAY_FRAME_SIZE + 1, RELAY_CLAIMED))
+        self.run_callbacks(lambda: self.link.dead and self.callbacks.empty())
+        self.assertEqual(results, ["alice"])
+
+    def test_malformed_relay_header_marks_link_dead_and_fails_claims(self):
+        results = self.claim("alice")
+        payload = b"{not json\n"
+        self.broker.sendall(HEADER.pack(len(payload), RELAY_CLAIMED) + payload)
+        self.run_callbacks(lambda: results)
+        self.assertEqual(results, [None])
+        self.assertTrue(self.link.dead)
+
+
+class DecodeRelayTest(unittest.TestCase):
+    def test_round_trip(self):
+        frame = encode_relay(RELAY_CLAIM, {"user": "ボブ"}, b"body")
+        [(kind, payload)] = FrameDecoder().feed(frame)
+        self.assertEqual((kind, decode_relay(payload)), (RELAY_CLAIM, ({"user": "ボブ"}, b"body")))
+
+    def test_rejects_malformed_payloads(self):
+        for payload in (b"no newline", b"{oops\n", b"[1, 2]\n"):
+            with self.assertRaises(ProtocolError):
+                decode_relay(payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+import zlib
+
+from chat_protocol import (
+    FrameDecoder, ProtocolError, encode_frame, decode_text,
+    encode_stream_frame, decode_stream_payload, encode_sequenced_frame, decode_sequenced_payload,
+    encode_history_frame, decode_history_payload,
+    FRAME_CHAT, FRAME_HELLO, FRAME_HISTORY, FRAME_SEQUENCED, FRAME_SYSTEM, HEADER, HEADER_SIZE,
+    HISTORY_PLAIN, HISTORY_ZLIB, MAX_FRAME_SIZE, STREAM_CHUNK,
+)
+
+
+class FrameDecoderTest(unittest.TestCase):
+    def test_decodes_frames_split_at_every_byte(self):
+        data = encode_frame(FRAME_HELLO, "alice") + encode_frame(FRAME_CHAT, "こんにちは") + encode_frame(FRAME_SYSTEM)
+        decoder = FrameDecoder()
+        frames = []
+        for i in range(len(data)):
+            frames += decoder.feed(data[i:i + 1])
+        self.assertEqual(frames, [(FRAME_HELLO, b"alice"), (FRAME_CHAT, "こんにちは".encode('utf-8')), (FRAME_SYSTEM, b"")])
+        self.assertEqual(decoder.pending_bytes(), 0)
+
+    def test_keeps_incomplete_frame_until_rest_arrives(self):
+        frame = encode_frame(FRAME_CHAT, "hello")
+        decoder = FrameDecoder()
+        self.assertEqual(decoder.feed(frame + frame[:3]), [(FRAME_CHAT, b"hello")])
+        self.assertEqual(decoder.pending_bytes(), 3)
+        self.assertEqual(decoder.feed(frame[3:]), [(FRAME_CHAT, b"hello")])
+        self.assertEqual(decoder.pending_bytes(), 0)
+
+    def test_rejects_oversized_length(self):
+        decoder = FrameDecoder(max_frame_size=16)
+        with self.assertRaises(ProtocolError):
+            decoder.feed(HEADER.pack(17, FRAME_CHAT))
+
+    def test_error_carries_frames_decoded_before_it(self):
+        frame = encode_frame(FRAME_CHAT, "hello")
+        decoder = FrameDecoder(max_frame_size=16)
+        with self.assertRaises(ProtocolError) as raised:
+            decoder.feed(frame + frame + HEADER.pack(17, FRAME_CHAT))
+        self.assertEqual(raised.exception.frames, [(FRAME_CHAT, b"hello")] * 2)
+        self.assertEqual(decoder.pending_bytes(), HEADER.size)
+
+    def test_encode_rejects_oversized_payload(self):
+        with self.assertRaises(ProtocolError):
+            encode_frame(FRAME_CHAT, b"x" * (MAX_FRAME_SIZE + 1))
+
+
+class PayloadTest(unittest.TestCase):
+    def test_stream_round_trip(self):
+        frame = encode_stream_frame(42, STREAM_CHUNK, "続き")
+        [(_, payload)] = FrameDecoder().feed(frame)
+        self.assertEqual(decode_stream_payload(payload), (42, STREAM_CHUNK, "続き"))
+
+    def test_stream_payload_too_short(self):
+        with self.assertRaises(ProtocolError):
+            decode_stream_payload(b"\x00")
+
+    def test_sequenced_round_trip(self):
+        inner = encode_frame(FRAME_CHAT, "bob: hi")
+        [(frame_type, payload)] = FrameDecoder().feed(encode_sequenced_frame(7, inner))
+        self.assertEqual(frame_type, FRAME_SEQUENCED)
+        seq, inner_type, inner_payload = decode_sequenced_payload(payload)
+        self.assertEqual((seq, inner_type, decode_text(inner_payload)), (7, FRAME_CHAT, "bob: hi"))
+
+    def test_sequenced_length_mismatch(self):
+        payload = encode_sequenced_frame(1, encode_frame(FRAME_CHAT, "abc"))[HEADER_SIZE:]
+        with self.assertRaises(ProtocolError):
+            decode_sequenced_payload(payload[:-1])
+
+
+class HistoryFrameTest(unittest.TestCase):
+    def decode(self, frame):
+        [(frame_type, payload)] = FrameDecoder().feed(frame)
+        self.assertEqual(frame_type, FRAME_HISTORY)
+        return payload
+
+    def test_small_history_is_not_compressed(self):
+        payload = self.decode(encode_history_frame("lobby", ["a: 1", "b: 2"]))
+        self.assertEqual(payload[0], HISTORY_PLAIN)
+        self.assertEqual(decode_history_payload(payload), ("lobby", ["a: 1", "b: 2"]))
+
+    def test_large_history_is_compressed(self):
+        lines = [f"user{i}: メッセージ {i}" for i in range(200)]
+        payload = self.decode(encode_history_frame("dev", lines))
+        self.assertEqual(payload[0], HISTORY_ZLIB)
+        self.assertEqual(decode_history_payload(payload), ("dev", lines))
+        payload = self.decode(encode_history_frame("dev", lines, compress=False))
+        self.assertEqual(payload[0], HISTORY_PLAIN)
+
+    def test_drops_oldest_lines_to_fit_one_frame(self):
+        lines = [f"{i:06d}" + "x" * 4000 for i in range(400)]
+        room, decoded = decode_history_payload(self.decode(encode_history_frame("big", lines, compress=False)))
+        self.assertLess(len(decoded), len(lines))
+        self.assertEqual(decoded, lines[-len(decoded):])
+
+    def test_rejects_malformed_payloads(self):
+        for payload in (b"", bytes((9,)) + b"{}", bytes((HISTORY_ZLIB,)) + b"not zlib",
+                        bytes((HISTORY_PLAIN,)) + b'{"room": "x"}', bytes((HISTORY_PLAIN,)) + b'{"room": "x", "lines": [1]}'):
+            with self.assertRaises(ProtocolError):
+                decode_history_payload(payload)
+
+    def test_rejects_decompression_bomb(self):
+        bomb = zlib.compress(b"[" + b" " * (9 * MAX_FRAME_SIZE) + b"]")
+        with self.assertRaises(ProtocolError):
+            decode_history_payload(bytes((HISTORY_ZLIB,)) + bomb)
+
+
+if __name__ == "__main__":
+    unittest.main()
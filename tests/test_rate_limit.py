@@ -0,0 +1,70 @@
+import contextlib
+import io
+import types
+import unittest
+
+from chat_rate_limit import (
+    ClientRateLimiter, TokenBucket, message_category,
+    ACTION_DROP, CATEGORY_AI, CATEGORY_CHAT, CATEGORY_PM,
+)
+from chat_server import parse_args
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_allows_burst_then_reports_wait(self):
+        bucket = TokenBucket(rate=2.0, burst=3, now=0.0)
+        self.assertEqual([bucket.acquire(now=0.0) for _ in range(3)], [0.0, 0.0, 0.0])
+        self.assertAlmostEqual(bucket.acquire(now=0.0), 0.5)
+
+    def test_refills_at_rate_up_to_burst(self):
+        bucket = TokenBucket(rate=2.0, burst=3, now=0.0)
+        for _ in range(3):
+            bucket.acquire(now=0.0)
+        self.assertEqual(bucket.acquire(now=0.5), 0.0)
+        self.assertAlmostEqual(bucket.acquire(now=0.5), 0.5)
+        bucket.acquire(now=100.0)
+        self.assertAlmostEqual(bucket.tokens, 2.0)
+
+    def test_clock_going_backwards_does_not_refill(self):
+        bucket = TokenBucket(rate=1.0, burst=1, now=10.0)
+        bucket.acquire(now=10.0)
+        self.assertGreater(bucket.acquire(now=5.0), 0.0)
+
+
+class ClientRateLimiterTest(unittest.TestCase):
+    def test_limits_each_category_separately(self):
+        limiter = ClientRateLimiter({CATEGORY_CHAT: (1.0, 1), CATEGORY_PM: (1.0, 2), CATEGORY_AI: (0, 1)}, ACTION_DROP)
+        conn = types.SimpleNamespace(rate_buckets={})
+        self.assertEqual(limiter.acquire(conn, CATEGORY_CHAT, now=0.0), 0.0)
+        self.assertGreater(limiter.acquire(conn, CATEGORY_CHAT, now=0.0), 0.0)
+        self.assertEqual(limiter.acquire(conn, CATEGORY_PM, now=0.0), 0.0)
+        self.assertEqual(limiter.acquire(conn, CATEGORY_PM, now=0.0), 0.0)
+        # rate が0の種類は制限しない
+        self.assertTrue(all(limiter.acquire(conn, CATEGORY_AI, now=0.0) == 0.0 for _ in range(10)))
+
+    def test_burst_below_one_still_admits_one_message(self):
+        limiter = ClientRateLimiter({CATEGORY_CHAT: (1.0, 0)}, ACTION_DROP)
+        conn = types.SimpleNamespace(rate_buckets={})
+        self.assertEqual(limiter.acquire(conn, CATEGORY_CHAT, now=0.0), 0.0)
+        self.assertAlmostEqual(limiter.acquire(conn, CATEGORY_CHAT, now=0.0), 1.0)
+        self.assertEqual(limiter.acquire(conn, CATEGORY_CHAT, now=1.0), 0.0)
+
+    def test_command_line_rejects_burst_below_one(self):
+        with contextlib.redirect_stderr(io.StringIO()), self.assertRaises(SystemExit):
+            parse_args(["--pm-burst", "0"])
+        self.assertEqual(parse_args(["--pm-burst", "1"]).pm_burst, 1)
+
+    def test_rejects_unknown_action(self):
+        with self.assertRaises(ValueError):
+            ClientRateLimiter(action="ignore")
+
+    def test_message_category(self):
+        self.assertEqual(message_category("/w bob hi"), CATEGORY_PM)
+        self.assertEqual(message_category("/ask_gemini 天気は?"), CATEGORY_AI)
+        self.assertEqual(message_category(" /summarize_gemini "), CATEGORY_AI)
+        self.assertEqual(message_category("/users"), CATEGORY_CHAT)
+        self.assertEqual(message_category("こんにちは"), CATEGORY_CHAT)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import types
+import unittest
+
+from chat_protocol import FRAME_CHAT, FrameDecoder, decode_sequenced_payload, decode_text, encode_frame
+from chat_resume import ReplayBuffer, ResumeRegistry
+
+
+def make_conn(username="alice", room_name="lobby", client_seq=0):
+    room = types.SimpleNamespace(name=room_name) if room_name is not None else None
+    return types.SimpleNamespace(username=username, room=room, client_seq=client_seq, token=None)
+
+
+class ReplayBufferTest(unittest.TestCase):
+    def stamp(self, replay, room_name, text, sender=None):
+        return replay.stamp(room_name, encode_frame(FRAME_CHAT, text), sender)
+
+    def texts(self, frames):
+        result = []
+        for frame in frames:
+            [(_, payload)] = FrameDecoder().feed(frame)
+            seq, _, inner = decode_sequenced_payload(payload)
+            result.append((seq, decode_text(inner)))
+        return result
+
+    def test_stamps_increasing_sequence_numbers(self):
+        replay = ReplayBuffer(10)
+        frames = [self.stamp(replay, "lobby", f"m{i}") for i in range(3)]
+        self.assertEqual(self.texts(frames), [(1, "m0"), (2, "m1"), (3, "m2")])
+        self.assertEqual(replay.seq, 3)
+
+    def test_since_returns_only_the_gap_for_the_room(self):
+        replay = ReplayBuffer(10)
+        self.stamp(replay, "lobby", "a")
+        self.stamp(replay, "dev", "b")
+        self.stamp(replay, "lobby", "c")
+        self.stamp(replay, "lobby", "d", sender="alice")
+        self.stamp(replay, "lobby", "e")
+        self.assertEqual(self.texts(replay.since(1, "lobby", "alice")), [(3, "c"), (5, "e")])
+        self.assertEqual(self.texts(replay.since(0, "lobby", "bob")), [(1, "a"), (3, "c"), (4, "d"), (5, "e")])
+        self.assertEqual(replay.since(5, "lobby", "alice"), [])
+
+    def test_since_returns_none_when_gap_was_evicted(self):
+        replay = ReplayBuffer(3)
+        for i in range(5):
+            self.stamp(replay, "lobby", f"m{i}")
+        self.assertIsNone(replay.since(0, "lobby", "alice"))
+        self.assertIsNone(replay.since(1, "lobby", "alice"))
+        self.assertEqual(self.texts(replay.since(2, "lobby", "alice")), [(3, "m2"), (4, "m3"), (5, "m4")])
+
+    def test_since_rejects_sequence_from_the_future(self):
+        replay = ReplayBuffer(3)
+        self.stamp(replay, "lobby", "m")
+        self.assertIsNone(replay.since(2, "lobby", "alice"))
+
+
+class ResumeRegistryTest(unittest.TestCase):
+    def test_detached_state_can_be_claimed_once(self):
+        registry = ResumeRegistry(ttl=60)
+        conn = make_conn(client_seq=4)
+        token = registry.attach(conn)
+        self.assertIs(registry.live(token), conn)
+        registry.detach(conn, now=100.0)
+        self.assertIsNone(registry.live(token))
+        self.assertEqual(len(registry), 1)
+        state = registry.claim(token, now=130.0)
+        self.assertEqual((state.username, state.room_name, state.client_seq), ("alice", "lobby", 4))
+        self.assertIsNone(registry.claim(token, now=130.0))
+
+    def test_state_expires_after_ttl(self):
+        registry = ResumeRegistry(ttl=60)
+        first, second = make_conn("a"), make_conn("b")
+        first_token, second_token = registry.attach(first), registry.attach(second)
+        registry.detach(first, now=100.0)
+        registry.detach(second, now=150.0)
+        self.assertIsNone(registry.claim(first_token, now=161.0))
+        self.assertEqual(len(registry), 1)
+        self.assertEqual(registry.claim(second_token, now=161.0).username, "b")
+
+    def test_zero_ttl_keeps_nothing(self):
+        registry = ResumeRegistry(ttl=0)
+        conn = make_conn()
+        token = registry.attach(conn)
+        registry.detach(conn, now=1.0)
+        self.assertIsNone(registry.claim(token, now=1.0))
+
+    def test_detach_ignores_connection_replaced_by_resume(self):
+        registry = ResumeRegistry(ttl=60)
+        old, new = make_conn(), make_conn()
+        token = registry.attach(old)
+        registry.attach(new, token)
+        registry.detach(old, now=1.0)
+        self.assertIs(registry.live(token), new)
+        self.assertEqual(len(registry), 0)
+
+    def test_foreign_tokens_are_detected_by_prefix(self):
+        registry = ResumeRegistry(ttl=60, prefix="w1.")
+        token = registry.attach(make_conn())
+        self.assertTrue(token.startswith("w1."))
+        self.assertFalse(registry.foreign(token))
+        self.assertTrue(registry.foreign("w0.abc"))
+        self.assertFalse(ResumeRegistry(ttl=60).foreign("w0.abc"))
+
+
+if __name__ == "__main__":
+    unittest.main()
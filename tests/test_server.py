@@ -0,0 +1,219 @@
+import collections
+import itertools
+import json
+import unittest
+
+from chat_ai_batch import PendingTransform
+from chat_protocol import (
+    FrameDecoder, decode_text, decode_sequenced_payload,
+    FRAME_AI_POSITIVE, FRAME_CHAT, FRAME_SEQUENCED, FRAME_SESSION, FRAME_SYSTEM,
+)
+from chat_server import ChatServer
+from chat_sessions import Session, SessionRegistry
+
+
+class FakeSocket:
+    _filenos = itertools.count(100)
+
+    def __init__(self):
+        self._fileno = next(self._filenos)
+
+    def fileno(self):
+        return self._fileno
+
+
+class FakeEngine:
+    """送信したフレームを接続ごとに記録するだけのエンジン（すべて呼び出したスレッドで即座に処理する）"""
+
+    def __init__(self):
+        self.sessions = SessionRegistry()
+        self.sent = collections.defaultdict(list)
+
+    def in_loop_thread(self):
+        return True
+
+    def call_soon(self, callback, *args):
+        callback(*args)
+
+    def call_later(self, delay, callback, *args):
+        pass
+
+    def send(self, conn, frame):
+        self.sent[conn].append(frame)
+
+    def broadcast(self, frame, exclude=None, members=None):
+        for conn in list(members if members is not None else self.sessions.sessions()):
+            if conn is not exclude:
+                self.send(conn, frame)
+
+    def close_connection(self, conn):
+        conn.closed = True
+
+
+class FakeCluster:
+    """ブローカーへの名前の予約を、テストが応答するまで保留するクラスタリンク"""
+
+    def __init__(self):
+        self.remote_users = {}
+        self.claims = []
+        self.presence = []
+
+    def claim_username(self, desired, callback):
+        self.claims.append((desired, callback))
+
+    def grant(self, name=None):
+        desired, callback = self.claims.pop(0)
+        callback(name or desired)
+
+    def publish_presence(self, username, room_name):
+        self.presence.append((username, room_name))
+
+    def publish_broadcast(self, room_name, history_line, frame):
+        pass
+
+
+class ScriptedLLM:
+    """generate() の応答を順に返す（例外なら送出する）LLMバックエンド"""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.prompts = []
+
+    def generate(self, prompt):
+        self.prompts.append(prompt)
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+
+def make_server(**options):
+    server = ChatServer(history_dir=None, llm_backend="fake", **options)
+    server.logger.stdout = False
+    server.engine = FakeEngine()
+    return server
+
+
+def connect(server):
+    conn = Session(FakeSocket(), ("127.0.0.1", 40000))
+    server.engine.sessions.add(conn)
+    return conn
+
+
+def received(server, conn):
+    """conn に送ったフレームを (種類, 文字列) の一覧にする（通し番号付きのフレームは中身を取り出す）"""
+    frames = []
+    for frame in server.engine.sent[conn]:
+        for frame_type, payload in FrameDecoder().feed(frame):
+            if frame_type == FRAME_SEQUENCED:
+                _, frame_type, payload = decode_sequenced_payload(payload)
+            frames.append((frame_type, decode_text(payload)))
+    return frames
+
+
+class ClusterEnterTest(unittest.TestCase):
+    def setUp(self):
+        self.server = make_server(cluster_socket="/nonexistent/cluster.sock", worker_id=1)
+        self.cluster = self.server.cluster = FakeCluster()
+
+    def tearDown(self):
+        self.server.logger.close()
+
+    def enter(self, username):
+        conn = connect(self.server)
+        self.server.enter(conn, username)
+        self.cluster.grant()
+        return conn
+
+    def test_resume_replays_broadcasts_sent_while_name_is_reserved(self):
+        server = self.server
+        alice, bob = self.enter("alice"), self.enter("bob")
+        server.broadcast_message(FRAME_CHAT, "bob: one", bob, bob.room)
+        last_seq = server.replay.seq
+        token = alice.token
+        alice.closed = True
+        server.on_close(alice)
+        server.engine.sessions.remove(alice)
+
+        again = connect(server)
+        server.handle_resume(again, json.dumps({"username": "alice", "token": token,
+                                                "epoch": server.replay.epoch, "seq": last_seq}).encode("utf-8"))
+        server.broadcast_message(FRAME_CHAT, "bob: two", bob, bob.room)  # ブローカーの応答待ちの間の発言
+        self.cluster.grant()
+        server.broadcast_message(FRAME_CHAT, "bob: three", bob, bob.room)
+
+        frames = received(server, again)
+        session = json.loads(next(text for frame_type, text in frames if frame_type == FRAME_SESSION))
+        self.assertTrue(session["resumed"])
+        self.assertEqual([text for frame_type, text in frames if frame_type == FRAME_CHAT], ["bob: two", "bob: three"])
+
+    def test_local_rename_releases_the_reserved_name(self):
+        server = self.server
+        server.engine.sessions.claim_username(connect(server), "alice")  # このワーカーだけが知っている名前
+        alice = self.enter("alice")
+        self.assertEqual(alice.username, "alice_1")
+        self.assertIn(("alice", None), self.cluster.presence)
+        self.assertEqual(self.cluster.presence[-1], ("alice_1", alice.room.name))
+
+    def test_frames_received_while_name_is_reserved_are_handled_after_entering(self):
+        server = self.server
+        bob = self.enter("bob")
+        carol = connect(server)
+        server.enter(carol, "carol")
+        server.on_frame(carol, FRAME_CHAT, "hello".encode("utf-8"))
+        self.assertNotIn((FRAME_CHAT, "carol: hello"), received(server, bob))
+        self.cluster.grant()
+        self.assertIn((FRAME_CHAT, "carol: hello"), received(server, bob))
+
+
+class PositiveTransformTest(unittest.TestCase):
+    FAILURE_NOTICE = (FRAME_SYSTEM, "AIポジティブ変換に失敗しました。しばらくしてからもう一度お試しください。")
+
+    def setUp(self):
+        self.server = make_server()
+        self.alice, self.bob, self.carol = (self.enter(name) for name in ("alice", "bob", "carol"))
+
+    def tearDown(self):
+        self.server.logger.close()
+
+    def enter(self, username):
+        conn = connect(self.server)
+        self.server.enter(conn, username)
+        return conn
+
+    def item(self, conn, message):
+        return PendingTransform(conn, conn.username, message, None, conn.room)
+
+    def transformed(self, conn):
+        return [text for frame_type, text in received(self.server, conn) if frame_type == FRAME_AI_POSITIVE]
+
+    def test_single_request_failure_notifies_the_requester(self):
+        self.server.llm = ScriptedLLM(RuntimeError("quota"))
+        self.server.execute_positive_transform_batch([self.item(self.alice, "うるさい")])
+        self.assertIn(self.FAILURE_NOTICE, received(self.server, self.alice))
+        self.assertNotIn(self.FAILURE_NOTICE, received(self.server, self.bob))
+
+    def test_batch_failure_notifies_every_requester(self):
+        self.server.llm = ScriptedLLM(RuntimeError("quota"))
+        self.server.execute_positive_transform_batch([self.item(self.alice, "うるさい"), self.item(self.bob, "疲れた")])
+        self.assertEqual(len(self.server.llm.prompts), 1)
+        self.assertIn(self.FAILURE_NOTICE, received(self.server, self.alice))
+        self.assertIn(self.FAILURE_NOTICE, received(self.server, self.bob))
+        self.assertNotIn(self.FAILURE_NOTICE, received(self.server, self.carol))
+
+    def test_missing_batch_results_are_transformed_individually(self):
+        self.server.llm = ScriptedLLM('[{"id": 1, "text": "盛り上げてくれてありがとう"}]', "今日もお疲れ様でした")
+        self.server.execute_positive_transform_batch([self.item(self.alice, "うるさい"), self.item(self.bob, "疲れた")])
+        self.assertEqual(self.transformed(self.carol),
+                         ["alice : 盛り上げてくれてありがとう", "bob : 今日もお疲れ様でした"])
+
+    def test_failed_individual_fallback_notifies_only_that_requester(self):
+        self.server.llm = ScriptedLLM('[{"id": 1, "text": "盛り上げてくれてありがとう"}]', RuntimeError("timeout"))
+        self.server.execute_positive_transform_batch([self.item(self.alice, "うるさい"), self.item(self.bob, "疲れた")])
+        self.assertEqual(self.transformed(self.carol), ["alice : 盛り上げてくれてありがとう"])
+        self.assertIn(self.FAILURE_NOTICE, received(self.server, self.bob))
+        self.assertNotIn(self.FAILURE_NOTICE, received(self.server, self.alice))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,130 @@
+import datetime
+import os
+import tempfile
+import threading
+import unittest
+
+from chat_store import (
+    MessageStore, PageCursor, parse_search, parse_since,
+    KIND_RECENT, KIND_SEARCH, KIND_SINCE,
+)
+
+BASE_TIME = 1_700_000_000.0
+
+
+class MessageStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "messages.db")
+        self.store = self.open_store()
+        # lobby と dev に交互に書く。i 番目の発言の時刻は BASE_TIME + i
+        for i in range(100):
+            room = "lobby" if i % 2 == 0 else "dev"
+            sender = f"user{i % 3}"
+            self.store.append(room, sender, f"{sender}: 会議メモ number{i:03d}", ts=BASE_TIME + i)
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def open_store(self):
+        store = MessageStore(self.path, flush_interval=0.01)
+        store.start()
+        return store
+
+    def query(self, cursor, limit=10, store=None):
+        done = threading.Event()
+        result = []
+
+        def callback(rows, next_cursor, error):
+            result.extend((rows, next_cursor, error))
+            done.set()
+
+        (store or self.store).query(cursor, callback, limit=limit)
+        self.assertTrue(done.wait(5), "問い合わせの結果が返りません")
+        rows, next_cursor, error = result
+        self.assertIsNone(error)
+        return rows, next_cursor
+
+    def read_all(self, cursor, limit=10):
+        """続きがなくなるまでページを読み、ページごとの本文のリストを返す"""
+        pages = []
+        while cursor is not None:
+            rows, cursor = self.query(cursor, limit)
+            pages.append([row.body for row in rows])
+            self.assertLess(len(pages), 50)
+        return pages
+
+    def test_rows_are_written_in_batches(self):
+        self.query(PageCursor(KIND_RECENT, "lobby", remaining=1))
+        self.assertEqual(self.store.written, 100)
+        self.assertEqual(self.store.pending(), 0)
+        self.assertLessEqual(self.store.batches, 100)
+
+    def test_recent_pages_backwards_without_overlap(self):
+        pages = self.read_all(PageCursor(KIND_RECENT, "lobby", remaining=25))
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        # 各ページは古い順、ページはより古い方へ進む
+        self.assertEqual(pages[0][0], "user2: 会議メモ number080")
+        self.assertEqual(pages[0][-1], "user2: 会議メモ number098")
+        numbers = [int(body[-3:]) for page in reversed(pages) for body in page]
+        self.assertEqual(numbers, list(range(50, 100, 2)))
+
+    def test_since_pages_forwards(self):
+        pages = self.read_all(PageCursor(KIND_SINCE, "dev", position=(BASE_TIME + 60, 0)))
+        numbers = [int(body[-3:]) for page in pages for body in page]
+        self.assertEqual(numbers, list(range(61, 100, 2)))
+        self.assertEqual([len(page) for page in pages], [10, 10])
+
+    def test_search_with_full_text_terms(self):
+        rows, next_cursor = self.query(PageCursor(KIND_SEARCH, "lobby", *parse_search("number04")))
+        self.assertEqual([row.body[-3:] for row in rows], ["040", "042", "044", "046", "048"])
+        self.assertIsNone(next_cursor)
+
+    def test_search_with_short_term_and_sender_pages(self):
+        pages = self.read_all(PageCursor(KIND_SEARCH, "dev", *parse_search("会議 from:user1")))
+        numbers = [int(body[-3:]) for page in reversed(pages) for body in page]
+        self.assertEqual(numbers, [i for i in range(100) if i % 2 == 1 and i % 3 == 1])
+
+    def test_search_by_sender_only(self):
+        pages = self.read_all(PageCursor(KIND_SEARCH, "lobby", *parse_search("from:user0")))
+        numbers = [int(body[-3:]) for page in reversed(pages) for body in page]
+        self.assertEqual(numbers, [i for i in range(100) if i % 2 == 0 and i % 3 == 0])
+
+    def test_search_without_match(self):
+        rows, next_cursor = self.query(PageCursor(KIND_SEARCH, "lobby", ("存在しない語",)))
+        self.assertEqual((rows, next_cursor), ([], None))
+
+    def test_rows_survive_reopen(self):
+        self.query(PageCursor(KIND_RECENT, "lobby", remaining=1))
+        self.store.close()
+        self.store = self.open_store()
+        rows, _ = self.query(PageCursor(KIND_SEARCH, "dev", ("number099",)))
+        self.assertEqual([row.sender for row in rows], ["user0"])
+
+
+class ParseTest(unittest.TestCase):
+    def test_parse_search(self):
+        self.assertEqual(parse_search("会議  資料 from:bob"), (("会議", "資料"), "bob"))
+        self.assertEqual(parse_search("from:"), (("from:",), None))
+
+    def test_parse_since_relative(self):
+        self.assertEqual(parse_since("30m", now=10000.0), 10000.0 - 1800)
+        self.assertEqual(parse_since("2時間", now=10000.0), 10000.0 - 7200)
+
+    def test_parse_since_absolute(self):
+        self.assertEqual(parse_since("2024-05-01 09:30"), datetime.datetime(2024, 5, 1, 9, 30).timestamp())
+        self.assertEqual(parse_since("2024-05-01"), datetime.datetime(2024, 5, 1).timestamp())
+
+    def test_parse_since_clock_is_today_or_yesterday(self):
+        now = datetime.datetime(2024, 5, 1, 12, 0).timestamp()
+        self.assertEqual(parse_since("09:00", now=now), datetime.datetime(2024, 5, 1, 9, 0).timestamp())
+        self.assertEqual(parse_since("13:00", now=now), datetime.datetime(2024, 4, 30, 13, 0).timestamp())
+
+    def test_parse_since_invalid(self):
+        for text in ("", "abc", "25:00", "²"):
+            self.assertIsNone(parse_since(text))
+
+
+if __name__ == "__main__":
+    unittest.main()